@@ -0,0 +1,177 @@
+from dataclasses import asdict, dataclass
+from enum import Enum
+import io
+import logging
+import os
+import shutil
+import subprocess
+import tarfile
+import threading
+from time import time
+from typing import BinaryIO, List, Union
+
+
+logger = logging.getLogger(__name__)
+Writable = Union[BinaryIO, io.RawIOBase]  # e.g. a local file or an upload stream
+ZSTD_LEVEL = 3  # zstd's default, fast with a decent ratio for text
+
+
+class Compression(Enum):
+    NONE = "none"  # stored, for media that is compressed already (jpg, npz, mp3)
+    GZIP = "gzip"  # single threaded (the original .tar.gz output)
+    ZSTD = "zstd"  # multi-threaded, via the zstd CLI
+
+
+# the file extension tells downstream readers how to unpack an archive
+ARCHIVE_EXTENSIONS = {
+    Compression.NONE: ".tar",
+    Compression.GZIP: ".tar.gz",
+    Compression.ZSTD: ".tar.zst",
+}
+
+
+@dataclass
+class ArchiveStats:
+    compression: str
+    file_count: int = 0
+    uncompressed_bytes: int = 0  # total size of the archived files
+    compressed_bytes: int = 0  # size of the archive
+    compression_time_ms: float = -1
+
+    @property
+    def compression_ratio(self) -> float:
+        if not self.compressed_bytes:
+            return -1
+        return round(self.uncompressed_bytes / self.compressed_bytes, 3)
+
+    def to_json(self) -> dict:
+        return {**asdict(self), "compression_ratio": self.compression_ratio}
+
+
+def get_compression(archive_name: str) -> Compression:
+    # check the longest extensions first (.tar.gz before .tar)
+    for compression, extension in sorted(
+        ARCHIVE_EXTENSIONS.items(), key=lambda item: -len(item[1])
+    ):
+        if archive_name.endswith(extension):
+            return compression
+    raise ValueError(f"Not a known archive type: {archive_name}")
+
+
+# opens an archive for reading, e.g. after downloading it from S3
+def open_archive(archive_path: str) -> tarfile.TarFile:
+    compression = get_compression(archive_path)
+    if compression != Compression.ZSTD:
+        return tarfile.open(archive_path, "r:*")
+    process = subprocess.run(
+        ["zstd", "-d", "-q", "-c", archive_path], capture_output=True, check=True
+    )
+    return tarfile.open(fileobj=io.BytesIO(process.stdout), mode="r:")
+
+
+def write_archive(
+    fileobj: Writable,
+    file_list: List[str],
+    compression: Compression,
+    zstd_threads: int = 0,  # 0: one thread per core
+    base_dir: str = "",
+) -> ArchiveStats:
+    """Writes a tar of file_list (files or dirs) into fileobj, which only needs
+    to support write(), so it can be a local file or an upload stream. With a
+    base_dir, file_list holds every entry itself (e.g. from the output manifest),
+    added under its path relative to base_dir, so dirs are not walked"""
+    start_time = time()
+    output = _CountingWriter(fileobj)
+    stats = ArchiveStats(compression.value)
+    if compression == Compression.ZSTD:
+        _write_zstd_tar(output, file_list, zstd_threads, stats, base_dir)
+    else:
+        mode = "w|gz" if compression == Compression.GZIP else "w|"
+        with tarfile.open(fileobj=output, mode=mode) as tar:  # type: ignore
+            _add_to_tar(tar, file_list, stats, base_dir)
+    stats.compressed_bytes = output.bytes_written
+    stats.compression_time_ms = (time() - start_time) * 1000
+    logger.info(f"Archived {stats.file_count} files: {stats.to_json()}")
+    return stats
+
+
+def _add_to_tar(
+    tar: tarfile.TarFile, file_list: List[str], stats: ArchiveStats, base_dir: str = ""
+):
+    def count(tarinfo: tarfile.TarInfo) -> tarfile.TarInfo:
+        if tarinfo.isfile():
+            stats.file_count += 1
+            stats.uncompressed_bytes += tarinfo.size
+        return tarinfo
+
+    for item in file_list:
+        if base_dir:
+            tar.add(
+                item,
+                arcname=os.path.relpath(item, base_dir),
+                recursive=False,
+                filter=count,
+            )
+        else:
+            tar.add(item, arcname=os.path.basename(item), filter=count)
+
+
+# the tar is piped through the zstd CLI, its output is copied to the destination
+def _write_zstd_tar(
+    output: "_CountingWriter",
+    file_list: List[str],
+    zstd_threads: int,
+    stats: ArchiveStats,
+    base_dir: str = "",
+) -> None:
+    process = subprocess.Popen(
+        ["zstd", f"-T{zstd_threads}", f"-{ZSTD_LEVEL}", "-q", "-c"],
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+    )
+    errors: List[Exception] = []
+
+    def copy_output():
+        try:
+            shutil.copyfileobj(process.stdout, output)
+        except Exception as e:  # e.g. a failing upload, stop zstd as well
+            errors.append(e)
+            process.kill()
+
+    copy_thread = threading.Thread(target=copy_output, daemon=True)
+    copy_thread.start()
+    try:
+        with tarfile.open(fileobj=process.stdin, mode="w|") as tar:
+            _add_to_tar(tar, file_list, stats, base_dir)
+    except BrokenPipeError:
+        pass  # zstd was stopped, see errors below
+    except Exception:
+        process.kill()
+        raise
+    finally:
+        assert process.stdin
+        try:
+            process.stdin.close()
+        except BrokenPipeError:
+            pass
+        copy_thread.join()
+        process.wait()
+    if errors:
+        raise errors[0]
+    if process.returncode != 0:
+        raise OSError(f"zstd exited with code {process.returncode}")
+
+
+class _CountingWriter(io.RawIOBase):
+    def __init__(self, fileobj: Writable):
+        super().__init__()
+        self.fileobj = fileobj
+        self.bytes_written = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self.fileobj.write(data)
+        self.bytes_written += len(data)
+        return len(data)
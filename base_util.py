@@ -5,6 +5,8 @@ import os
 from pathlib import Path
 import logging
 import hashlib
+from archive_util import Compression
+from models import OutputType
 
 
 LOG_FORMAT = "%(asctime)s|%(levelname)s|%(process)d|%(module)s|%(funcName)s|%(lineno)d|%(message)s"
@@ -63,6 +65,12 @@ def validate_config(config: CfgNode, validate_file_paths: bool = True) -> bool:
         assert check_setting(
             config.FILE_SYSTEM.OUTPUT_DIR, str
         ), "FILE_SYSTEM.OUTPUT_DIR"
+        assert check_setting(
+            config.FILE_SYSTEM.SCRATCH_DIR, str, True
+        ), "FILE_SYSTEM.SCRATCH_DIR"
+        assert check_setting(
+            config.FILE_SYSTEM.SCRATCH_MAX_BYTES, int
+        ), "FILE_SYSTEM.SCRATCH_MAX_BYTES"
 
         # Settings for this DANE worker
         assert config.VISXP_PREP, "VISXP_PREP sub-config missing"
@@ -78,23 +86,141 @@ def validate_config(config: CfgNode, validate_file_paths: bool = True) -> bool:
         assert check_setting(
             config.VISXP_PREP.SPECTROGRAM_SAMPLERATE_HZ, list
         ), "VISXP_PREP.SPECTROGRAM_SAMPLERATE_HZ"
+        assert check_setting(
+            config.VISXP_PREP.SPECTROGRAM_ENGINE, str
+        ) and config.VISXP_PREP.SPECTROGRAM_ENGINE in [
+            "python_speech_features",  # see spectrogram.SPECTROGRAM_ENGINES
+            "numpy",
+        ], "VISXP_PREP.SPECTROGRAM_ENGINE"
+        assert (
+            check_setting(config.VISXP_PREP.METADATA_FORMATS, list)
+            and config.VISXP_PREP.METADATA_FORMATS
+            and set(config.VISXP_PREP.METADATA_FORMATS) <= {"text", "npz"}
+        ), "VISXP_PREP.METADATA_FORMATS"
+        assert check_setting(
+            config.VISXP_PREP.KEYFRAME_DEDUP, str
+        ) and config.VISXP_PREP.KEYFRAME_DEDUP in [
+            "none",  # see dedup_util.DEDUP_MODES
+            "mark",
+            "drop",
+        ], "VISXP_PREP.KEYFRAME_DEDUP"
+        assert check_setting(
+            config.VISXP_PREP.KEYFRAME_DEDUP_MAX_DISTANCE, int
+        ), "VISXP_PREP.KEYFRAME_DEDUP_MAX_DISTANCE"
+        assert check_setting(
+            config.VISXP_PREP.FINGERPRINT_INDEX, str
+        ), "VISXP_PREP.FINGERPRINT_INDEX"
         assert check_setting(
             config.VISXP_PREP.TEST_INPUT_FILE, str, True
         ), "VISXP_PREP.TEST_INPUT_FILE"
 
+        # settings for processing tasks concurrently
+        assert config.WORKER, "WORKER"
+        assert check_setting(
+            config.WORKER.PROCESS_POOL_SIZE, int
+        ), "WORKER.PROCESS_POOL_SIZE"
+        assert (
+            check_setting(config.WORKER.PREFETCH_COUNT, int)
+            and config.WORKER.PREFETCH_COUNT > 0
+            # without a pool, tasks run in the worker process, sharing cfg & dirs
+            and (
+                config.WORKER.PROCESS_POOL_SIZE > 0 or config.WORKER.PREFETCH_COUNT == 1
+            )
+        ), "WORKER.PREFETCH_COUNT"
+        assert check_setting(
+            config.WORKER.PRELOAD_MODULES, list
+        ), "WORKER.PRELOAD_MODULES"
+        assert check_setting(
+            config.WORKER.MAX_TASKS_PER_PROCESS, int
+        ), "WORKER.MAX_TASKS_PER_PROCESS"
+        assert check_setting(
+            config.WORKER.MAX_PROCESS_RSS_BYTES, int
+        ), "WORKER.MAX_PROCESS_RSS_BYTES"
+        assert check_setting(
+            config.WORKER.CPU_THREADS_PER_JOB, int
+        ), "WORKER.CPU_THREADS_PER_JOB"
+        assert check_setting(config.WORKER.CPU_AFFINITY, list) and all(
+            type(cpu) is int for cpu in config.WORKER.CPU_AFFINITY
+        ), "WORKER.CPU_AFFINITY"
+        assert check_setting(config.WORKER.METRICS_PORT, int), "WORKER.METRICS_PORT"
+
+        # settings for splitting long assets into time ranges
+        assert config.SPLIT, "SPLIT"
+        assert check_setting(config.SPLIT.MIN_DURATION_MS, int), "SPLIT.MIN_DURATION_MS"
+        assert (
+            check_setting(config.SPLIT.RANGE_DURATION_MS, int)
+            and config.SPLIT.RANGE_DURATION_MS > 0
+        ), "SPLIT.RANGE_DURATION_MS"
+        assert check_setting(config.SPLIT.OVERLAP_MS, int), "SPLIT.OVERLAP_MS"
+        assert check_setting(config.SPLIT.JOBS_DIR, str), "SPLIT.JOBS_DIR"
+        assert (
+            check_setting(config.SPLIT.CLAIM_TIMEOUT_S, int)
+            and config.SPLIT.CLAIM_TIMEOUT_S > 0
+        ), "SPLIT.CLAIM_TIMEOUT_S"
+        assert check_setting(
+            config.SPLIT.HELPER_PROCESSES, int
+        ), "SPLIT.HELPER_PROCESSES"
+
+        # settings for estimating the cost of processing (dry runs)
+        assert config.ESTIMATE, "ESTIMATE"
+        assert check_setting(
+            config.ESTIMATE.CALIBRATION_FILE, str
+        ), "ESTIMATE.CALIBRATION_FILE"
+
         # settings for input & output handling
         assert config.INPUT, "INPUT"
         assert check_setting(
             config.INPUT.DELETE_ON_COMPLETION, bool
         ), "INPUT.DELETE_ON_COMPLETION"
+        assert check_setting(config.INPUT.HTTP_TIMEOUT_S, int), "INPUT.HTTP_TIMEOUT_S"
+        assert check_setting(
+            config.INPUT.HTTP_MAX_RETRIES, int
+        ), "INPUT.HTTP_MAX_RETRIES"
+        assert check_setting(
+            config.INPUT.HTTP_CHUNK_SIZE_BYTES, int
+        ), "INPUT.HTTP_CHUNK_SIZE_BYTES"
+        assert check_setting(
+            config.INPUT.HTTP_PARALLEL_CONNECTIONS, int
+        ), "INPUT.HTTP_PARALLEL_CONNECTIONS"
+        assert check_setting(
+            config.INPUT.HTTP_PARALLEL_THRESHOLD_BYTES, int
+        ), "INPUT.HTTP_PARALLEL_THRESHOLD_BYTES"
+        assert check_setting(
+            config.INPUT.PIPELINED_DOWNLOAD, bool
+        ), "INPUT.PIPELINED_DOWNLOAD"
+        assert check_setting(
+            config.INPUT.CACHE_QUOTA_BYTES, int
+        ), "INPUT.CACHE_QUOTA_BYTES"
+        assert check_setting(
+            config.INPUT.CACHE_VERIFY_CHECKSUM, bool
+        ), "INPUT.CACHE_VERIFY_CHECKSUM"
 
         assert config.OUTPUT, "OUTPUT"
         assert check_setting(
             config.OUTPUT.DELETE_ON_COMPLETION, bool
         ), "OUTPUT.DELETE_ON_COMPLETION"
+        assert check_setting(config.OUTPUT.WRITER_THREADS, int), "OUTPUT.WRITER_THREADS"
+        assert (
+            check_setting(config.OUTPUT.WRITER_QUEUE_SIZE, int)
+            and config.OUTPUT.WRITER_QUEUE_SIZE > 0
+        ), "OUTPUT.WRITER_QUEUE_SIZE"
+        assert check_setting(config.OUTPUT.FSYNC, bool), "OUTPUT.FSYNC"
         assert check_setting(
             config.OUTPUT.TRANSFER_ON_COMPLETION, bool
         ), "OUTPUT.TRANSFER_ON_COMPLETION"
+        # S3 client settings, also used when downloading input from S3
+        assert check_setting(
+            config.OUTPUT.S3_MAX_POOL_CONNECTIONS, int
+        ), "OUTPUT.S3_MAX_POOL_CONNECTIONS"
+        assert check_setting(
+            config.OUTPUT.MULTIPART_THRESHOLD_BYTES, int
+        ), "OUTPUT.MULTIPART_THRESHOLD_BYTES"
+        assert check_setting(
+            config.OUTPUT.MULTIPART_PART_SIZE_BYTES, int
+        ), "OUTPUT.MULTIPART_PART_SIZE_BYTES"
+        assert check_setting(
+            config.OUTPUT.MULTIPART_MAX_CONCURRENCY, int
+        ), "OUTPUT.MULTIPART_MAX_CONCURRENCY"
         if config.OUTPUT.TRANSFER_ON_COMPLETION:
             # required only in case output must be transferred
             assert check_setting(
@@ -104,6 +230,38 @@ def validate_config(config: CfgNode, validate_file_paths: bool = True) -> bool:
             assert check_setting(
                 config.OUTPUT.S3_FOLDER_IN_BUCKET, str
             ), "OUTPUT.S3_FOLDER_IN_BUCKET"
+            assert check_setting(
+                config.OUTPUT.STREAMING_UPLOAD, bool
+            ), "OUTPUT.STREAMING_UPLOAD"
+            assert __check_output_compression(
+                config.OUTPUT.COMPRESSION
+            ), "OUTPUT.COMPRESSION"
+            assert check_setting(config.OUTPUT.ZSTD_THREADS, int), "OUTPUT.ZSTD_THREADS"
+            assert check_setting(
+                config.OUTPUT.INCREMENTAL_UPLOAD, bool
+            ), "OUTPUT.INCREMENTAL_UPLOAD"
+            # shards are for small assets, incremental uploads for large ones
+            assert check_setting(config.OUTPUT.SHARD_UPLOAD, bool) and not (
+                config.OUTPUT.SHARD_UPLOAD and config.OUTPUT.INCREMENTAL_UPLOAD
+            ), "OUTPUT.SHARD_UPLOAD"
+            assert check_setting(
+                config.OUTPUT.SHARD_MAX_ASSET_BYTES, int
+            ), "OUTPUT.SHARD_MAX_ASSET_BYTES"
+            assert (
+                check_setting(config.OUTPUT.SHARD_MAX_BYTES, int)
+                and config.OUTPUT.SHARD_MAX_BYTES > 0
+            ), "OUTPUT.SHARD_MAX_BYTES"
+            assert (
+                check_setting(config.OUTPUT.SHARD_MAX_AGE_S, int)
+                and config.OUTPUT.SHARD_MAX_AGE_S > 0
+            ), "OUTPUT.SHARD_MAX_AGE_S"
+            assert (
+                check_setting(config.OUTPUT.SHARD_UPLOAD_TIMEOUT_S, int)
+                and config.OUTPUT.SHARD_UPLOAD_TIMEOUT_S > 0
+            ), "OUTPUT.SHARD_UPLOAD_TIMEOUT_S"
+            assert check_setting(
+                config.OUTPUT.SHARD_SPOOL_DIR, str, True
+            ), "OUTPUT.SHARD_SPOOL_DIR"
 
         if "DANE_DEPENDENCIES" in config:
             assert __check_dane_dependencies(
@@ -151,6 +309,14 @@ def check_setting(setting: Any, t: type, optional=False) -> bool:
     )
 
 
+def __check_output_compression(policy: Any) -> bool:
+    return isinstance(policy, dict) and all(
+        output_type in [ot.value for ot in OutputType]
+        and compression in [c.value for c in Compression]
+        for output_type, compression in policy.items()
+    )
+
+
 def __check_dane_dependencies(deps: Any) -> bool:
     deps_to_check: list = deps if type(deps) is list else []
     deps_allowed = ["DOWNLOAD"]
@@ -179,9 +345,12 @@ def run_shell_command(cmd: str) -> bytes:
         )
 
         stdout, stderr = process.communicate()
+        if process.returncode != 0:
+            logger.error(stderr)
         assert process.returncode == 0
         logger.debug(stdout)
-        logger.error(stderr)
+        if stderr:
+            logger.debug(stderr)
         logger.info("Process is done: return stdout")
         return stdout
 
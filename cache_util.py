@@ -0,0 +1,218 @@
+from contextlib import contextmanager
+import fcntl
+import json
+import logging
+import os
+import threading
+from time import time
+from typing import IO, Dict, Iterator, List, Optional, Tuple
+import uuid
+
+from http_util import get_file_checksum
+
+
+logger = logging.getLogger(__name__)
+INDEX_FILE = ".input_cache.json"
+INDEX_LOCK_FILE = ".input_cache.lock"
+LOCK_FILE_SUFFIX = ".lock"
+REFS_DIR = ".refs"  # a lock file per reference, see _add_ref()
+
+
+class InputCache:
+    """Keeps downloaded input media around for other tasks (and the other workers on
+    the node sharing the cache dir). The index is a JSON file, guarded by a file
+    lock, holding per file: size, checksum, last use and its references. Each
+    reference is a file the referencing process keeps locked, so references of
+    processes that died (on any host or in any container) are recognized by their
+    lock being free. Only files added after a complete download are used;
+    unreferenced files are evicted, least recently used first, whenever the total
+    exceeds the quota"""
+
+    def __init__(self, cache_dir: str, quota_bytes: int, verify_checksum: bool):
+        self.cache_dir = cache_dir
+        self.quota_bytes = quota_bytes
+        self.verify_checksum = verify_checksum  # on each hit, otherwise size only
+        self._file_locks: Dict[str, list] = {}  # name -> [RLock, depth, lock file]
+        self._file_locks_guard = threading.Lock()
+        # name -> the references of this process: (ref ID, locked ref file)
+        self._refs: Dict[str, List[Tuple[str, IO]]] = {}
+        self._refs_guard = threading.Lock()
+        os.makedirs(os.path.join(cache_dir, REFS_DIR), exist_ok=True)
+
+    # exclusive per file across processes (reentrant within this one), so only one
+    # worker downloads a file while the others wait for it to enter the cache
+    @contextmanager
+    def lock(self, file_path: str) -> Iterator[None]:
+        name = os.path.basename(file_path)
+        with self._file_locks_guard:
+            file_lock = self._file_locks.setdefault(name, [threading.RLock(), 0, None])
+        with file_lock[0]:
+            if file_lock[1] == 0:
+                file_lock[2] = open(
+                    os.path.join(self.cache_dir, f".{name}{LOCK_FILE_SUFFIX}"), "a"
+                )
+                fcntl.flock(file_lock[2], fcntl.LOCK_EX)
+            file_lock[1] += 1
+            try:
+                yield
+            finally:
+                file_lock[1] -= 1
+                if file_lock[1] == 0:
+                    fcntl.flock(file_lock[2], fcntl.LOCK_UN)
+                    file_lock[2].close()
+
+    # True if file_path is in the cache (without using it)
+    def contains(self, file_path: str) -> bool:
+        with self._index() as index:
+            return self._get_valid_entry(index, file_path, False) is not None
+
+    # on a hit, references the file (see release) and returns its checksum
+    def acquire(self, file_path: str) -> Optional[str]:
+        with self._index() as index:
+            entry = self._get_valid_entry(index, file_path, self.verify_checksum)
+            if entry is None:
+                return None
+            entry["refs"].append(self._add_ref(file_path))
+            entry["last_used"] = time()
+            index["stats"]["hits"] += 1
+            logger.info(f"Input cache hit: {file_path}")
+            return entry["checksum"]
+
+    # adds a completely downloaded file (counted as a miss), referenced by this process
+    def add(self, file_path: str, checksum: str) -> None:
+        with self._index() as index:
+            index["files"][os.path.basename(file_path)] = {
+                "size": os.path.getsize(file_path),
+                "checksum": checksum or get_file_checksum(file_path),
+                "last_used": time(),
+                "refs": [self._add_ref(file_path)],
+            }
+            index["stats"]["misses"] += 1
+            self._evict(index)
+
+    # returns False if the file is not managed by the cache
+    def release(self, file_path: str) -> bool:
+        with self._index() as index:
+            entry = index["files"].get(os.path.basename(file_path))
+            if entry is None:
+                return False
+            ref_id = self._remove_ref(file_path)
+            if ref_id in entry["refs"]:
+                entry["refs"].remove(ref_id)
+            entry["last_used"] = time()
+            self._evict(index)
+            return True
+
+    def get_stats(self) -> Dict[str, int]:
+        with self._index() as index:
+            return {
+                **index["stats"],
+                "files": len(index["files"]),
+                "size_bytes": sum(e["size"] for e in index["files"].values()),
+            }
+
+    # loads the index under an exclusive lock and writes it back afterwards
+    @contextmanager
+    def _index(self) -> Iterator[dict]:
+        index_file = os.path.join(self.cache_dir, INDEX_FILE)
+        with open(os.path.join(self.cache_dir, INDEX_LOCK_FILE), "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            index = {"files": {}, "stats": {"hits": 0, "misses": 0, "evictions": 0}}
+            if os.path.exists(index_file):
+                try:
+                    with open(index_file) as f:
+                        index = json.load(f)
+                except ValueError:
+                    logger.warning(f"Corrupt input cache index, resetting {index_file}")
+            yield index
+            with open(f"{index_file}.tmp", "w") as f:
+                json.dump(index, f)
+            os.replace(f"{index_file}.tmp", index_file)
+
+    def _get_valid_entry(
+        self, index: dict, file_path: str, verify_checksum: bool
+    ) -> Optional[dict]:
+        name = os.path.basename(file_path)
+        entry = index["files"].get(name)
+        if entry is None:
+            return None
+        path = os.path.join(self.cache_dir, name)
+        if (
+            os.path.exists(path)
+            and os.path.getsize(path) == entry["size"]
+            and (not verify_checksum or get_file_checksum(path) == entry["checksum"])
+        ):
+            return entry
+        logger.warning(f"Dropping invalid input cache entry: {name}")
+        self._remove(index, name)
+        return None
+
+    # removes the least recently used files nobody references until within quota
+    def _evict(self, index: dict) -> None:
+        files = index["files"]
+        for entry in files.values():  # forget references of processes that died
+            entry["refs"] = [
+                ref_id for ref_id in entry["refs"] if self._is_held(ref_id)
+            ]
+        total_size = sum(entry["size"] for entry in files.values())
+        for name, entry in sorted(files.items(), key=lambda i: i[1]["last_used"]):
+            if total_size <= self.quota_bytes:
+                return
+            if entry["refs"]:
+                continue
+            logger.info(f"Evicting {name} from the input cache")
+            total_size -= entry["size"]
+            self._remove(index, name)
+            index["stats"]["evictions"] += 1
+        if total_size > self.quota_bytes:
+            logger.warning(
+                f"Input cache over quota ({total_size} bytes), all files are in use"
+            )
+
+    # creates a reference of this process, held until _remove_ref() (or until the
+    # process dies): a lock on a new ref file. Call with the index locked, so the
+    # ref file is locked before the index lists it
+    def _add_ref(self, file_path: str) -> str:
+        ref_id = uuid.uuid4().hex
+        ref_file = open(self._get_ref_file(ref_id), "a")
+        fcntl.flock(ref_file, fcntl.LOCK_EX)
+        with self._refs_guard:
+            self._refs.setdefault(os.path.basename(file_path), []).append(
+                (ref_id, ref_file)
+            )
+        return ref_id
+
+    # drops the last reference of this process to file_path, returns its ID
+    def _remove_ref(self, file_path: str) -> Optional[str]:
+        with self._refs_guard:
+            refs = self._refs.get(os.path.basename(file_path))
+            if not refs:
+                return None
+            ref_id, ref_file = refs.pop()
+        os.remove(self._get_ref_file(ref_id))
+        ref_file.close()  # releases the lock
+        return ref_id
+
+    # False if the process holding the reference released it or died
+    def _is_held(self, ref_id: str) -> bool:
+        ref_file_path = self._get_ref_file(ref_id)
+        if not os.path.exists(ref_file_path):
+            return False
+        with open(ref_file_path, "a") as ref_file:
+            try:
+                fcntl.flock(ref_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return True
+        logger.info(f"Dropping the input cache reference of a dead process: {ref_id}")
+        os.remove(ref_file_path)
+        return False
+
+    def _get_ref_file(self, ref_id: str) -> str:
+        return os.path.join(self.cache_dir, REFS_DIR, ref_id)
+
+    def _remove(self, index: dict, name: str) -> None:
+        index["files"].pop(name, None)
+        try:
+            os.remove(os.path.join(self.cache_dir, name))
+        except FileNotFoundError:
+            pass
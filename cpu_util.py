@@ -0,0 +1,66 @@
+import logging
+import os
+import sys
+from typing import Dict, List, Optional
+
+
+logger = logging.getLogger(__name__)
+# the budget is passed on to child processes (e.g. the process pool) via the env
+CPU_THREADS_ENV_VAR = "VISXP_PREP_CPU_THREADS"
+# read by the BLAS/OpenMP libraries (used by NumPy) when they are loaded
+BLAS_THREADS_ENV_VARS = [
+    "OMP_NUM_THREADS",
+    "OPENBLAS_NUM_THREADS",
+    "MKL_NUM_THREADS",
+    "BLIS_NUM_THREADS",
+    "VECLIB_MAXIMUM_THREADS",
+    "NUMEXPR_NUM_THREADS",
+]
+
+
+# limits the threads each job uses (0: the libraries' defaults, i.e. one per core)
+# and optionally pins this process (and its children) to the given cores. Call this
+# before NumPy is imported, since the BLAS libraries only read their limit once
+def apply_cpu_budget(threads: int, cpu_affinity: Optional[List[int]] = None) -> None:
+    if cpu_affinity:
+        os.sched_setaffinity(0, cpu_affinity)
+        logger.info(f"Pinned process {os.getpid()} to CPUs {cpu_affinity}")
+    if threads <= 0:
+        return
+    logger.info(f"Limiting each job to {threads} threads")
+    os.environ[CPU_THREADS_ENV_VAR] = str(threads)
+    for env_var in BLAS_THREADS_ENV_VARS:
+        os.environ[env_var] = str(threads)
+    if "numpy" in sys.modules:
+        logger.warning("NumPy was imported already, its BLAS threads are not limited")
+    if "cv2" in sys.modules:
+        limit_opencv_threads()
+
+
+# 0: no budget
+def get_cpu_threads() -> int:
+    try:
+        return max(int(os.environ.get(CPU_THREADS_ENV_VAR, 0)), 0)
+    except ValueError:
+        return 0
+
+
+# e.g. ["-threads", "2"], to put in front of the ffmpeg input (decoding threads)
+def get_ffmpeg_thread_args() -> List[str]:
+    threads = get_cpu_threads()
+    return ["-threads", str(threads)] if threads else []
+
+
+# the same for ffmpeg-python, e.g. ffmpeg.input(file, **get_ffmpeg_input_options())
+def get_ffmpeg_input_options() -> Dict[str, int]:
+    threads = get_cpu_threads()
+    return {"threads": threads} if threads else {}
+
+
+# OpenCV otherwise uses a thread per core for e.g. resizing & encoding keyframes
+def limit_opencv_threads() -> None:
+    threads = get_cpu_threads()
+    if threads:
+        import cv2  # type: ignore
+
+        cv2.setNumThreads(threads)
@@ -0,0 +1,199 @@
+import json
+import logging
+import os
+from time import time
+from typing import Dict, List, Tuple
+
+import cv2  # type: ignore
+import numpy as np
+
+from cpu_util import limit_opencv_threads
+from fingerprint_util import FingerprintIndex
+from manifest_util import ManifestRecorder, write_output_file
+from metadata_util import get_shots_file, read_keyframe_timestamps, read_shot_table
+from models import OutputType, ScenedetectOutput, StageProvenance
+from resource_util import get_resource_usage_since, take_resource_snapshot
+
+
+logger = logging.getLogger(__name__)
+limit_opencv_threads()
+HASH_SIZE = 8  # a difference hash of 8x8 = 64 bits
+DEDUP_MODES = ["none", "mark", "drop"]  # see cfg.VISXP_PREP.KEYFRAME_DEDUP
+# in the metadata dir: the timestamp of each duplicate -> that of its representative
+KEYFRAME_DUPLICATES_FILE = "keyframe_duplicates_ms.json"
+# ... and of each keyframe seen in another asset -> that asset's ID & timestamp
+KEYFRAME_MATCHES_FILE = "keyframe_matches_ms.json"
+
+
+# difference hash (dHash) of each image: whether each pixel is brighter than its
+# right neighbour, in a 9x8 grayscale thumbnail. The JPEGs are decoded at 1/8 of
+# their size, which is plenty for a thumbnail
+def get_perceptual_hashes(image_paths: List[str]) -> np.ndarray:
+    if not image_paths:
+        return np.zeros(0, np.uint64)
+    thumbnails = np.zeros((len(image_paths), HASH_SIZE, HASH_SIZE + 1), np.float32)
+    for i, image_path in enumerate(image_paths):
+        image = cv2.imread(image_path, cv2.IMREAD_REDUCED_GRAYSCALE_8)
+        if image is None:
+            raise ValueError(f"Could not read keyframe {image_path}")
+        thumbnails[i] = cv2.resize(
+            image, (HASH_SIZE + 1, HASH_SIZE), interpolation=cv2.INTER_AREA
+        )
+    bits = thumbnails[:, :, 1:] > thumbnails[:, :, :-1]
+    packed = np.packbits(bits.reshape(len(image_paths), -1), axis=1)
+    return packed.view(">u8").ravel().astype(np.uint64)
+
+
+def hamming_distance(a: int, b: int) -> int:
+    return (int(a) ^ int(b)).bit_count()
+
+
+# maps each keyframe that is within max_distance of the representative (the first
+# keyframe) of the run of near-identical keyframes it is in, to that representative.
+# Only neighbours are compared: a shot that returns later is not a duplicate
+def find_duplicates(
+    timestamps: List[int], hashes: np.ndarray, max_distance: int
+) -> Dict[int, int]:
+    duplicates: Dict[int, int] = {}
+    if not timestamps:
+        return duplicates
+    representative = 0
+    for i in range(1, len(timestamps)):
+        if hamming_distance(hashes[i], hashes[representative]) <= max_distance:
+            duplicates[timestamps[i]] = timestamps[representative]
+        else:
+            representative = i
+    return duplicates
+
+
+# finds near-duplicate keyframes among the output of scenedetect_util.run(). With
+# mode "drop" they are deleted and left out of the keyframe timestamps, with "mark"
+# they are only listed. Either way each duplicate's timestamp is mapped to its
+# representative in the metadata, so every shot still resolves to a keyframe.
+# With an index_path, the remaining keyframes are also looked up in (and then added
+# to) the FingerprintIndex of all assets processed before, to reference recurring
+# content such as leaders, jingles and commercials
+def run(
+    output_dir: str,
+    source_id: str,
+    mode: str,
+    max_distance: int,
+    index_path: str = "",
+) -> StageProvenance:
+    start_time = time()
+    resource_snapshot = take_resource_snapshot()
+    keyframe_dir = os.path.join(output_dir, OutputType.KEYFRAMES.value)
+    metadata_dir = os.path.join(output_dir, OutputType.METADATA.value)
+    timestamps_path = os.path.join(
+        metadata_dir, ScenedetectOutput.KEYFRAME_TIMESTAMPS.value
+    )
+    timestamps = sorted(read_keyframe_timestamps(output_dir))
+    logger.info(f"Looking for near-duplicates among {len(timestamps)} keyframes")
+
+    hashes = get_perceptual_hashes(
+        [os.path.join(keyframe_dir, f"{ts}.jpg") for ts in timestamps]
+    )
+    output_data: dict = {}
+    duplicates: Dict[int, int] = {}
+    recorder = ManifestRecorder(output_dir, "dedup")
+    if mode != "none":
+        duplicates = find_duplicates(timestamps, hashes, max_distance)
+        output_data["keyframe_duplicates"] = os.path.join(
+            metadata_dir, KEYFRAME_DUPLICATES_FILE
+        )
+        write_output_file(
+            output_data["keyframe_duplicates"],
+            json.dumps({str(ts): rep for ts, rep in duplicates.items()}).encode(),
+            recorder,
+        )
+        output_data["duplicate_keyframes"] = len(duplicates)
+        # the share of the keyframes that is (or, with "mark", could be) left out
+        output_data["keyframe_reduction_rate"] = (
+            len(duplicates) / len(timestamps) if timestamps else 0.0
+        )
+        logger.info(f"{len(duplicates)} of {len(timestamps)} keyframes are duplicates")
+    if mode == "drop":
+        for ts in duplicates:
+            os.remove(os.path.join(keyframe_dir, f"{ts}.jpg"))
+            recorder.remove(os.path.join(keyframe_dir, f"{ts}.jpg"))
+        if os.path.exists(timestamps_path):
+            write_output_file(
+                timestamps_path,
+                str([ts for ts in timestamps if ts not in duplicates]).encode(),
+                recorder,
+            )
+        if os.path.exists(get_shots_file(output_dir)):
+            _point_shots_to_representatives(output_dir, duplicates, recorder)
+
+    if index_path:
+        fingerprints = [
+            (int(h), ts) for h, ts in zip(hashes, timestamps) if ts not in duplicates
+        ]
+        output_data.update(
+            _match_recurring_keyframes(
+                index_path, source_id, fingerprints, metadata_dir, recorder
+            )
+        )
+    recorder.save()
+
+    return StageProvenance(
+        activity_name="Keyframe deduplication",
+        activity_description=(
+            "Drop or mark near-duplicate neighbouring keyframes, "
+            "reference keyframes seen in other assets"
+        ),
+        start_time_unix=start_time,
+        processing_time_ms=(time() - start_time) * 1000,
+        parameters={
+            "mode": mode,
+            "max_distance": max_distance,
+            "hash": "dhash64",
+            "fingerprint_index": index_path,
+        },
+        input_data={"keyframe_timestamps": timestamps_path},
+        output_data=output_data,
+        resource_usage=get_resource_usage_since(resource_snapshot),
+    )
+
+
+# the shots of dropped keyframes get the keyframe of their representative instead
+def _point_shots_to_representatives(
+    output_dir: str, duplicates: Dict[int, int], recorder: ManifestRecorder
+):
+    shot_table = read_shot_table(output_dir)
+    frames = dict(zip(shot_table.keyframe_ms.tolist(), shot_table.keyframe_frame))
+    for shot, keyframe_ms in enumerate(shot_table.keyframe_ms.tolist()):
+        if keyframe_ms in duplicates:
+            representative = duplicates[keyframe_ms]
+            shot_table.keyframe_ms[shot] = representative
+            shot_table.keyframe_frame[shot] = frames[representative]
+    shot_table.save(get_shots_file(output_dir), recorder)
+
+
+# writes the keyframes (timestamp -> source_id & timestamp) with an exact match in
+# other assets, then adds the keyframes of this asset to the index
+def _match_recurring_keyframes(
+    index_path: str,
+    source_id: str,
+    fingerprints: List[Tuple[int, int]],
+    metadata_dir: str,
+    recorder: ManifestRecorder,
+) -> dict:
+    with FingerprintIndex(index_path) as index:
+        matches = index.lookup([h for h, _ in fingerprints], source_id)
+        index.add(source_id, fingerprints)
+    recurring = {
+        str(ts): {"source_id": matches[h][0], "timestamp_ms": matches[h][1]}
+        for h, ts in fingerprints
+        if h in matches
+    }
+    matches_path = os.path.join(metadata_dir, KEYFRAME_MATCHES_FILE)
+    write_output_file(matches_path, json.dumps(recurring).encode(), recorder)
+    logger.info(f"{len(recurring)} of {len(fingerprints)} keyframes were seen before")
+    return {
+        "keyframe_matches": matches_path,
+        "recurring_keyframes": len(recurring),
+        "recurring_keyframe_rate": (
+            len(recurring) / len(fingerprints) if fingerprints else 0.0
+        ),
+    }
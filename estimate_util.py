@@ -0,0 +1,332 @@
+from dataclasses import asdict, dataclass, field
+from datetime import datetime, timezone
+import json
+import logging
+import os
+import platform
+import shutil
+from time import time
+from typing import Dict, List, Optional
+
+from dane.config import cfg
+from models import MediaFile, OutputType
+
+
+logger = logging.getLogger(__name__)
+# the estimated stages; downloading is left out, since it depends on the network
+# rather than on the node (its input bytes are reported though)
+SCENEDETECT = "scenedetect"
+SPECTROGRAM = "spectrogram"
+ARCHIVE = "archive"  # compressing the output, which is then uploaded to S3
+# per stage, the features its runtime and output bytes are a linear function of
+MODEL_FEATURES = {
+    f"{SCENEDETECT}.runtime_s": ["one", "megapixel_frames", "keyframes"],
+    f"{SCENEDETECT}.output_bytes": ["one", "keyframes", "keyframe_megapixels"],
+    f"{SPECTROGRAM}.runtime_s": ["one", "audio_seconds", "spectrograms"],
+    f"{SPECTROGRAM}.output_bytes": ["spectrograms"],
+    f"{ARCHIVE}.runtime_s": ["one", "output_megabytes"],
+    f"{ARCHIVE}.output_bytes": ["one", "output_megabytes"],
+}
+
+
+@dataclass
+class LinearModel:
+    features: List[str]
+    coefficients: List[float]
+
+    def predict(self, features: Dict[str, float]) -> float:
+        return max(
+            sum(
+                c * features.get(f, 0) for f, c in zip(self.features, self.coefficients)
+            ),
+            0,
+        )
+
+    # least squares fit of targets on the given features of each sample
+    @classmethod
+    def fit(
+        cls, features: List[str], samples: List[Dict[str, float]], targets: List[float]
+    ) -> "LinearModel":
+        import numpy as np
+
+        if len(samples) < len(features):
+            logger.warning(f"Only {len(samples)} samples to fit {features}")
+        x = np.array([[s.get(f, 0) for f in features] for s in samples], dtype=float)
+        coefficients, _, _, _ = np.linalg.lstsq(x, np.array(targets), rcond=None)
+        return cls(features, [float(c) for c in coefficients])
+
+
+@dataclass
+class Calibration:
+    """Per stage model (see MODEL_FEATURES) fitted on runs on the target hardware"""
+
+    keyframes_per_minute: float  # of video, depends on the material
+    models: Dict[str, LinearModel]
+    samples: int = 0  # the number of media files it was fitted on
+    hardware: dict = field(default_factory=dict)
+
+    def to_json(self) -> dict:
+        return asdict(self)
+
+    @classmethod
+    def from_json(cls, data: dict) -> "Calibration":
+        return cls(
+            keyframes_per_minute=data["keyframes_per_minute"],
+            models={
+                name: LinearModel(**model) for name, model in data["models"].items()
+            },
+            samples=data.get("samples", 0),
+            hardware=data.get("hardware", {}),
+        )
+
+
+@dataclass
+class StageEstimate:
+    runtime_s: float
+    output_bytes: int
+
+
+@dataclass
+class Estimate:
+    input_file_path: str
+    media_file: Optional[MediaFile] = None  # None: could not be probed
+    keyframes: int = 0
+    stages: Dict[str, StageEstimate] = field(default_factory=dict)
+
+    @property
+    def runtime_s(self) -> float:
+        return sum(stage.runtime_s for stage in self.stages.values())
+
+    # the archives (uploaded to S3), or else the local output
+    @property
+    def output_bytes(self) -> int:
+        if ARCHIVE in self.stages:
+            return self.stages[ARCHIVE].output_bytes
+        return sum(stage.output_bytes for stage in self.stages.values())
+
+    def to_json(self) -> dict:
+        return {
+            "input_file_path": self.input_file_path,
+            "media_file": asdict(self.media_file) if self.media_file else None,
+            "keyframes": self.keyframes,
+            "stages": {name: asdict(stage) for name, stage in self.stages.items()},
+            "runtime_s": self.runtime_s,
+            "output_bytes": self.output_bytes,
+        }
+
+
+def load_calibration(calibration_file: str) -> Calibration:
+    with open(calibration_file) as f:
+        return Calibration.from_json(json.load(f))
+
+
+def save_calibration(calibration: Calibration, calibration_file: str) -> None:
+    with open(calibration_file, "w") as f:
+        json.dump(calibration.to_json(), f, indent=4)
+        f.write("\n")
+    logger.info(f"Saved the calibration to {calibration_file}")
+
+
+# one input (file path, URL or S3 URI) per line, skipping empty lines & comments
+def read_manifest(manifest_file: str) -> List[str]:
+    with open(manifest_file) as f:
+        lines = [line.strip() for line in f]
+    return [line for line in lines if line and not line.startswith("#")]
+
+
+def get_features(
+    media_file: MediaFile,
+    keyframes: int,
+    sample_rates: List[int],
+    extract_keyframes: bool,
+) -> Dict[str, float]:
+    megapixels = media_file.width * media_file.height / 1e6
+    audio_channels = len(sample_rates) if media_file.has_audio else 0
+    return {
+        "one": 1,
+        "megapixel_frames": max(media_file.frame_count, 0) * megapixels,
+        "keyframes": keyframes,
+        "keyframe_megapixels": keyframes * megapixels if extract_keyframes else 0,
+        "audio_seconds": max(media_file.duration_ms, 0) / 1000 * audio_channels,
+        "spectrograms": keyframes * audio_channels,
+    }
+
+
+# estimates the stages main_data_processor.run() would run on this media file
+def estimate_media_file(media_file: MediaFile, calibration: Calibration) -> Estimate:
+    estimate = Estimate(media_file.file_path, media_file)
+    if media_file.has_video:
+        estimate.keyframes = round(
+            calibration.keyframes_per_minute * max(media_file.duration_ms, 0) / 60000
+        )
+    features = get_features(
+        media_file,
+        estimate.keyframes,
+        cfg.VISXP_PREP.SPECTROGRAM_SAMPLERATE_HZ,
+        cfg.VISXP_PREP.RUN_KEYFRAME_EXTRACTION,
+    )
+    stages = []
+    if media_file.has_video:
+        stages.append(SCENEDETECT)
+    if media_file.has_audio and cfg.VISXP_PREP.RUN_AUDIO_EXTRACTION:
+        stages.append(SPECTROGRAM)
+    for stage in stages:
+        estimate.stages[stage] = _estimate_stage(stage, features, calibration)
+    if cfg.OUTPUT.TRANSFER_ON_COMPLETION:
+        features["output_megabytes"] = estimate.output_bytes / 1e6
+        estimate.stages[ARCHIVE] = _estimate_stage(ARCHIVE, features, calibration)
+    return estimate
+
+
+def _estimate_stage(
+    stage: str, features: Dict[str, float], calibration: Calibration
+) -> StageEstimate:
+    return StageEstimate(
+        runtime_s=calibration.models[f"{stage}.runtime_s"].predict(features),
+        output_bytes=round(
+            calibration.models[f"{stage}.output_bytes"].predict(features)
+        ),
+    )
+
+
+# totals over the estimates of e.g. a manifest, per stage and overall. The node hours
+# are for processing one task at a time, as the calibration did
+def summarize(estimates: List[Estimate]) -> dict:
+    probed = [e for e in estimates if e.media_file]
+    stages: Dict[str, dict] = {}
+    for estimate in probed:
+        for name, stage in estimate.stages.items():
+            totals = stages.setdefault(name, {"runtime_s": 0.0, "output_bytes": 0})
+            totals["runtime_s"] += stage.runtime_s
+            totals["output_bytes"] += stage.output_bytes
+    return {
+        "assets": len(estimates),
+        "not_probed": [e.input_file_path for e in estimates if not e.media_file],
+        "media_hours": sum(
+            max(e.media_file.duration_ms, 0) for e in probed if e.media_file
+        )
+        / 3600000,
+        "input_bytes": sum(
+            max(e.media_file.file_size, 0) for e in probed if e.media_file
+        ),
+        "keyframes": sum(e.keyframes for e in probed),
+        "node_hours": sum(e.runtime_s for e in probed) / 3600,
+        "output_bytes": sum(e.output_bytes for e in probed),
+        "stages": stages,
+    }
+
+
+# runs the estimated stages on each (local) media file, representative for the
+# material to process, and fits the models on the measured runtimes & output sizes
+def calibrate(media_file_paths: List[str], work_dir: str) -> Calibration:
+    from archive_util import write_archive
+    from io_util import get_archive_groups, get_dir_size, get_zstd_threads
+    from media_file_util import validate_media_file
+    from metadata_util import read_keyframe_timestamps
+    import scenedetect_util
+    import spectrogram
+
+    sample_rates = list(cfg.VISXP_PREP.SPECTROGRAM_SAMPLERATE_HZ)
+    samples: Dict[str, List[Dict[str, float]]] = {name: [] for name in MODEL_FEATURES}
+    targets: Dict[str, List[float]] = {name: [] for name in MODEL_FEATURES}
+    total_keyframes, total_video_ms = 0, 0
+    for media_file_path in media_file_paths:
+        media_file = validate_media_file(media_file_path)
+        if not media_file:
+            logger.warning(f"Skipping {media_file_path}, not a valid media file")
+            continue
+        logger.info(f"Calibrating with {media_file_path}")
+        output_dir = os.path.join(work_dir, media_file.source_id)
+        output_dirs = {}
+        for output_type in OutputType:
+            output_dirs[output_type.value] = os.path.join(output_dir, output_type.value)
+            os.makedirs(output_dirs[output_type.value], exist_ok=True)
+
+        # the output is removed once measured, so the work_dir only ever holds that
+        # of one media file
+        try:
+            keyframe_timestamps: List[int] = []
+            measured: Dict[str, StageEstimate] = {}
+            if media_file.has_video:
+                provenance = scenedetect_util.run(media_file, output_dir, True)
+                keyframe_timestamps = read_keyframe_timestamps(output_dir)
+                total_keyframes += len(keyframe_timestamps)
+                total_video_ms += media_file.duration_ms
+                measured[SCENEDETECT] = StageEstimate(
+                    provenance.processing_time_ms / 1000,
+                    get_dir_size(output_dirs[OutputType.KEYFRAMES.value])
+                    + get_dir_size(output_dirs[OutputType.METADATA.value]),
+                )
+            if media_file.has_audio:
+                start_time = time()
+                for sample_rate in sample_rates:
+                    spectrogram.extract_audio_spectrograms(
+                        media_file=media_file.file_path,
+                        keyframe_timestamps=keyframe_timestamps,
+                        locations=output_dirs,
+                        sample_rate=sample_rate,
+                        window_size_ms=cfg.VISXP_PREP.SPECTROGRAM_WINDOW_SIZE_MS,
+                        generate_images=False,
+                        extract_audio=False,
+                        engine=cfg.VISXP_PREP.SPECTROGRAM_ENGINE,
+                    )
+                measured[SPECTROGRAM] = StageEstimate(
+                    time() - start_time,
+                    get_dir_size(output_dirs[OutputType.SPECTROGRAMS.value]),
+                )
+            features = get_features(
+                media_file, len(keyframe_timestamps), sample_rates, True
+            )
+            archive_groups = get_archive_groups()
+            features["output_megabytes"] = (
+                sum(
+                    get_dir_size(output_dirs[output_type.value])
+                    for output_types in archive_groups.values()
+                    for output_type in output_types
+                )
+                / 1e6
+            )
+            start_time = time()
+            archive_bytes = 0
+            for i, (compression, output_types) in enumerate(archive_groups.items()):
+                # next to (not in) the archived output dirs
+                with open(os.path.join(output_dir, f"{i}.tar"), "wb") as f:
+                    stats = write_archive(
+                        f,
+                        [
+                            output_dirs[output_type.value]
+                            for output_type in output_types
+                        ],
+                        compression,
+                        get_zstd_threads(),
+                    )
+                archive_bytes += stats.compressed_bytes
+            measured[ARCHIVE] = StageEstimate(time() - start_time, archive_bytes)
+
+            for stage, stage_estimate in measured.items():
+                for name, value in asdict(stage_estimate).items():
+                    samples[f"{stage}.{name}"].append(features)
+                    targets[f"{stage}.{name}"].append(value)
+        finally:
+            shutil.rmtree(output_dir, ignore_errors=True)
+
+    if not any(targets.values()):
+        raise ValueError("None of the media files could be used for calibration")
+    return Calibration(
+        keyframes_per_minute=total_keyframes * 60000 / max(total_video_ms, 1),
+        models={
+            name: (
+                LinearModel.fit(features, samples[name], targets[name])
+                if samples[name]
+                else LinearModel(features, [0.0] * len(features))
+            )
+            for name, features in MODEL_FEATURES.items()
+        },
+        samples=len(targets[f"{ARCHIVE}.runtime_s"]),
+        hardware={
+            "node": platform.node(),
+            "cpu_count": os.cpu_count(),
+            "processor": platform.processor(),
+            "calibrated_at": datetime.now(timezone.utc).isoformat(),
+        },
+    )
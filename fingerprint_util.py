@@ -0,0 +1,98 @@
+import logging
+import sqlite3
+from typing import Dict, Iterable, List, Tuple
+
+
+logger = logging.getLogger(__name__)
+# keyed by hash, so a lookup is a single B-tree search. WITHOUT ROWID stores the rows
+# in that tree itself, which keeps millions of entries compact
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS fingerprints (
+    hash INTEGER NOT NULL,
+    source_id TEXT NOT NULL,
+    timestamp_ms INTEGER NOT NULL,
+    PRIMARY KEY (hash, source_id, timestamp_ms)
+) WITHOUT ROWID
+"""
+LOOKUP_BATCH_SIZE = 500  # hashes per query, below SQLite's limit on parameters
+# hashes with (almost) all bits equal are of flat frames (e.g. black or grey
+# slates), which would match across all assets: those are not indexed
+MIN_HASH_BITS = 3
+MAX_HASH_BITS = 61
+BUSY_TIMEOUT_S = 30  # time a writer waits for another writer
+
+
+class FingerprintIndex:
+    """Persistent index of the perceptual hashes (see dedup_util.py) of the keyframes
+    of all processed assets, in a local SQLite file. In WAL mode, readers do not
+    block each other or the (single) writer, so several workers can share it. It
+    should be on a local disk though: SQLite's locking is not reliable on NFS"""
+
+    def __init__(self, db_path: str):
+        self._connection = sqlite3.connect(db_path, timeout=BUSY_TIMEOUT_S)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")  # durable per WAL sync
+        with self._connection:
+            self._connection.execute(SCHEMA)
+
+    def __enter__(self) -> "FingerprintIndex":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self._connection.close()
+
+    # adds the (hash, timestamp) of each keyframe of an asset, in one transaction
+    def add(self, source_id: str, fingerprints: Iterable[Tuple[int, int]]) -> None:
+        with self._connection:
+            self._connection.executemany(
+                "INSERT OR IGNORE INTO fingerprints VALUES (?, ?, ?)",
+                (
+                    (_to_signed(h), source_id, timestamp_ms)
+                    for h, timestamp_ms in fingerprints
+                    if is_distinctive(h)
+                ),
+            )
+
+    # per hash that was seen in another asset: the first (source_id, timestamp_ms).
+    # Hashes that are not distinctive are never matched
+    def lookup(
+        self, hashes: List[int], exclude_source_id: str = ""
+    ) -> Dict[int, Tuple[str, int]]:
+        matches: Dict[int, Tuple[str, int]] = {}
+        signed = sorted({_to_signed(h) for h in hashes if is_distinctive(h)})
+        for i in range(0, len(signed), LOOKUP_BATCH_SIZE):
+            batch = signed[i : i + LOOKUP_BATCH_SIZE]
+            # SQLite takes the bare columns from the row with the MIN()
+            rows = self._connection.execute(
+                "SELECT hash, source_id, MIN(timestamp_ms) FROM fingerprints "
+                f"WHERE hash IN ({', '.join('?' * len(batch))}) AND source_id != ? "
+                "GROUP BY hash",
+                batch + [exclude_source_id],
+            )
+            for h, source_id, timestamp_ms in rows:
+                matches[_to_unsigned(h)] = (source_id, timestamp_ms)
+        return matches
+
+    def count(self) -> int:
+        (count,) = self._connection.execute(
+            "SELECT COUNT(*) FROM fingerprints"
+        ).fetchone()
+        return count
+
+
+# False for the hashes of flat frames, see MIN_HASH_BITS
+def is_distinctive(h: int) -> bool:
+    return MIN_HASH_BITS <= int(h).bit_count() <= MAX_HASH_BITS
+
+
+# SQLite integers are signed 64 bit, the hashes unsigned
+def _to_signed(h: int) -> int:
+    h = int(h)
+    return h - (1 << 64) if h >= 1 << 63 else h
+
+
+def _to_unsigned(h: int) -> int:
+    return h + (1 << 64) if h < 0 else h
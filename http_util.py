@@ -0,0 +1,327 @@
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+import hashlib
+import logging
+import os
+import threading
+from typing import List, Optional, Tuple
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+logger = logging.getLogger(__name__)
+PARTIAL_DOWNLOAD_SUFFIX = ".part"  # data is streamed into <file>.part, then renamed
+CHECKSUM_ALGORITHM = "sha256"
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+DEFAULT_TIMEOUT_S = 60
+DEFAULT_POOL_SIZE = 10
+
+_http_session: Optional[requests.Session] = None
+_http_session_lock = threading.Lock()
+
+
+class HttpDownloadException(Exception):
+    pass
+
+
+@dataclass
+class HttpDownloadSettings:
+    chunk_size: int = DEFAULT_CHUNK_SIZE
+    timeout_s: float = DEFAULT_TIMEOUT_S  # connect & read timeout
+    max_retries: int = 3  # max. number of resumes after an interruption
+    parallel_connections: int = 1  # 1 disables parallel range requests
+    parallel_threshold_bytes: int = 256 * 1024 * 1024  # min. size to go parallel
+
+
+@dataclass
+class HttpDownloadInfo:
+    file_path: str
+    content_length: int
+    mime_type: str
+    checksum: str  # hex digest (see CHECKSUM_ALGORITHM)
+    resumes: int = 0  # number of times an interrupted transfer was resumed
+    connections: int = 1
+
+
+# one pooled session per worker process, shared by all downloads (and their threads)
+def get_http_session(pool_size: int = DEFAULT_POOL_SIZE) -> requests.Session:
+    global _http_session
+    with _http_session_lock:
+        if _http_session is None:
+            logger.info(f"Creating pooled HTTP session (pool size={pool_size})")
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            _http_session = session
+        return _http_session
+
+
+def download_file(
+    url: str,
+    output_file: str,
+    settings: Optional[HttpDownloadSettings] = None,
+) -> HttpDownloadInfo:
+    """Streams url into output_file (atomically renamed when complete).
+    Interrupted transfers are resumed with HTTP Range requests; large files
+    are fetched over several connections if the server supports ranges.
+    :raises HttpDownloadException if the file could not be downloaded"""
+    settings = settings or HttpDownloadSettings()
+    session = get_http_session(max(DEFAULT_POOL_SIZE, settings.parallel_connections))
+    part_file = output_file + PARTIAL_DOWNLOAD_SUFFIX
+    content_length, accepts_ranges, mime_type, validator = _get_remote_file_info(
+        session, url, settings.timeout_s
+    )
+
+    if (
+        accepts_ranges
+        and settings.parallel_connections > 1
+        and content_length >= settings.parallel_threshold_bytes
+    ):
+        info = _parallel_range_download(
+            session, url, part_file, content_length, mime_type, validator, settings
+        )
+    else:
+        info = _streaming_download(
+            session, url, part_file, mime_type, validator, settings
+        )
+
+    if content_length >= 0 and info.content_length != content_length:
+        os.remove(part_file)  # so a next attempt doesn't resume from it
+        raise HttpDownloadException(
+            f"Expected {content_length} bytes, but received {info.content_length}"
+        )
+    os.replace(part_file, output_file)
+    info.file_path = output_file
+    return info
+
+
+def _get_remote_file_info(
+    session: requests.Session, url: str, timeout_s: float
+) -> Tuple[int, bool, str, str]:
+    try:
+        response = session.head(url, allow_redirects=True, timeout=timeout_s)
+        response.raise_for_status()
+    except requests.RequestException:
+        logger.warning(f"HEAD request failed for {url}, size unknown")
+        return -1, False, "unknown", ""
+    return (
+        int(response.headers.get("Content-Length", -1)),
+        response.headers.get("Accept-Ranges", "none").lower() == "bytes",
+        response.headers.get("Content-Type", "unknown"),
+        _get_validator(response),
+    )
+
+
+# a strong ETag or else Last-Modified, to send as If-Range: the server then only
+# returns the requested range if the file did not change ("" if neither is there)
+def _get_validator(response: requests.Response) -> str:
+    etag = response.headers.get("ETag", "")
+    if etag and not etag.startswith("W/"):  # If-Range needs a strong validator
+        return etag
+    return response.headers.get("Last-Modified", "")
+
+
+def _get_range_headers(byte_range: str, validator: str) -> dict:
+    headers = {"Range": f"bytes={byte_range}"}
+    if validator:
+        headers["If-Range"] = validator
+    return headers
+
+
+def _streaming_download(
+    session: requests.Session,
+    url: str,
+    part_file: str,
+    mime_type: str,
+    validator: str,  # of the file the bytes in part_file are from (see If-Range)
+    settings: HttpDownloadSettings,
+) -> HttpDownloadInfo:
+    hasher = hashlib.new(CHECKSUM_ALGORITHM)
+    hashed_bytes = 0  # number of bytes of part_file that went into the hasher
+    resumes = 0
+    while True:
+        offset = os.path.getsize(part_file) if os.path.exists(part_file) else 0
+        headers = _get_range_headers(f"{offset}-", validator) if offset else {}
+        try:
+            with session.get(
+                url, stream=True, timeout=settings.timeout_s, headers=headers
+            ) as response:
+                if offset and response.status_code == 416:
+                    # nothing left to download, or part_file is larger than the file
+                    if _get_total_size(response) == offset:
+                        logger.info(f"Download of {url} was already complete")
+                        if hashed_bytes != offset:
+                            hasher, hashed_bytes = _hash_file(part_file), offset
+                        return HttpDownloadInfo(
+                            part_file, offset, mime_type, hasher.hexdigest(), resumes
+                        )
+                    logger.info(f"Partial download of {url} is too large, restarting")
+                    os.remove(part_file)
+                    continue
+                if offset and response.status_code == 206:
+                    range_start = _get_range_start(response)
+                    if range_start != offset:
+                        os.remove(part_file)  # so the retry starts from scratch
+                        raise requests.ConnectionError(
+                            f"Asked to resume at byte {offset}, got {range_start}"
+                        )
+                    logger.info(f"Resuming download of {url} at byte {offset}")
+                    if hashed_bytes != offset:  # e.g. left behind by an earlier run
+                        hasher, hashed_bytes = _hash_file(part_file), offset
+                    mode = "ab"
+                else:
+                    response.raise_for_status()
+                    if offset:  # or the file changed, see If-Range
+                        logger.info("Server ignored the Range header, restarting")
+                    validator = _get_validator(response) or validator
+                    hasher, hashed_bytes, mode = (
+                        hashlib.new(CHECKSUM_ALGORITHM),
+                        0,
+                        "wb",
+                    )
+                expected_size = _get_total_size(response)
+                with open(part_file, mode) as f:
+                    for chunk in response.iter_content(chunk_size=settings.chunk_size):
+                        f.write(chunk)
+                        hasher.update(chunk)
+                        hashed_bytes += len(chunk)
+            if expected_size >= 0 and hashed_bytes < expected_size:
+                raise requests.ConnectionError(
+                    f"Connection closed after {hashed_bytes}/{expected_size} bytes"
+                )
+            return HttpDownloadInfo(
+                part_file, hashed_bytes, mime_type, hasher.hexdigest(), resumes
+            )
+        except (
+            requests.ConnectionError,
+            requests.Timeout,
+            requests.exceptions.ChunkedEncodingError,
+        ) as e:
+            if resumes >= settings.max_retries:
+                raise HttpDownloadException(f"Giving up on {url}: {e}")
+            resumes += 1
+            logger.warning(f"Download interrupted ({e}), retry {resumes}")
+        except requests.HTTPError as e:
+            raise HttpDownloadException(f"Failed to download {url}: {e}")
+
+
+def _parallel_range_download(
+    session: requests.Session,
+    url: str,
+    part_file: str,
+    content_length: int,
+    mime_type: str,
+    validator: str,
+    settings: HttpDownloadSettings,
+) -> HttpDownloadInfo:
+    ranges = split_into_ranges(content_length, settings.parallel_connections)
+    logger.info(f"Downloading {url} in {len(ranges)} parallel ranges")
+    with open(part_file, "wb") as f:
+        f.truncate(content_length)  # every range is written in place
+    try:
+        with ThreadPoolExecutor(max_workers=len(ranges)) as pool:
+            resumes = sum(
+                pool.map(
+                    lambda r: _download_range(
+                        session, url, part_file, r, validator, settings
+                    ),
+                    ranges,
+                )
+            )
+    except Exception:
+        # it has the full size already, so a next attempt could not resume it
+        os.remove(part_file)
+        raise
+    # NOTE: the ranges arrive out of order, so the checksum is computed afterwards
+    return HttpDownloadInfo(
+        part_file,
+        os.path.getsize(part_file),
+        mime_type,
+        _hash_file(part_file).hexdigest(),
+        resumes,
+        len(ranges),
+    )
+
+
+# returns the number of resumes needed to download the (inclusive) byte range
+def _download_range(
+    session: requests.Session,
+    url: str,
+    part_file: str,
+    byte_range: Tuple[int, int],
+    validator: str,  # a changed file is not partial content, so the download fails
+    settings: HttpDownloadSettings,
+) -> int:
+    position, end = byte_range
+    resumes = 0
+    with open(part_file, "r+b") as f:
+        while position <= end:
+            try:
+                with session.get(
+                    url,
+                    stream=True,
+                    timeout=settings.timeout_s,
+                    headers=_get_range_headers(f"{position}-{end}", validator),
+                ) as response:
+                    if response.status_code != 206:
+                        raise HttpDownloadException(
+                            f"Expected partial content, got {response.status_code}"
+                        )
+                    f.seek(position)
+                    for chunk in response.iter_content(chunk_size=settings.chunk_size):
+                        f.write(chunk[: end + 1 - position])
+                        position += len(chunk)
+                if position <= end:
+                    raise requests.ConnectionError(f"Range ended at byte {position}")
+            except (
+                requests.ConnectionError,
+                requests.Timeout,
+                requests.exceptions.ChunkedEncodingError,
+            ) as e:
+                if resumes >= settings.max_retries:
+                    raise HttpDownloadException(f"Giving up on range {byte_range}: {e}")
+                resumes += 1
+                logger.warning(f"Range {byte_range} interrupted ({e}), retrying")
+    return resumes
+
+
+# splits content_length bytes into (at most) n inclusive byte ranges
+def split_into_ranges(content_length: int, n: int) -> List[Tuple[int, int]]:
+    n = max(1, min(n, content_length))
+    size = -(-content_length // n)  # ceil division
+    return [
+        (start, min(start + size, content_length) - 1)
+        for start in range(0, content_length, size)
+    ]
+
+
+# total size of the remote file, from either Content-Range or Content-Length
+def _get_total_size(response: requests.Response) -> int:
+    content_range = response.headers.get("Content-Range", "")
+    if "/" in content_range and not content_range.endswith("*"):
+        return int(content_range.split("/")[-1])
+    return int(response.headers.get("Content-Length", -1))
+
+
+# first byte of a partial response, from Content-Range (-1 if missing)
+def _get_range_start(response: requests.Response) -> int:
+    content_range = response.headers.get("Content-Range", "")
+    try:
+        return int(content_range.split()[1].split("-")[0])
+    except (IndexError, ValueError):
+        return -1
+
+
+def _hash_file(file_path: str, chunk_size: int = DEFAULT_CHUNK_SIZE):
+    hasher = hashlib.new(CHECKSUM_ALGORITHM)
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            hasher.update(chunk)
+    return hasher
+
+
+# hex digest of a file, comparable to HttpDownloadInfo.checksum
+def get_file_checksum(file_path: str) -> str:
+    return _hash_file(file_path).hexdigest()
@@ -1,30 +1,52 @@
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import nullcontext
+import json
 import logging
 import os
 from pathlib import Path
-import requests
 import shutil
+import threading
 import time
-from typing import Dict, List, Optional
+from typing import TYPE_CHECKING, Any, ContextManager, Dict, List, Optional, Tuple
 from urllib.parse import urlparse
+from archive_util import ARCHIVE_EXTENSIONS, ArchiveStats, Compression, write_archive
+from cache_util import InputCache
+from cpu_util import get_cpu_threads
 from dane.config import cfg
 from dane.provenance import PROVENANCE_FILE, Provenance
-from dane.s3_util import S3Store, parse_s3_uri, validate_s3_uri
-from models import OutputType, DownloadResult
+from http_util import HttpDownloadException, HttpDownloadSettings, download_file
+from manifest_util import (
+    FRAGMENTS_DIR,
+    get_manifest_files,
+    get_manifest_path,
+    read_manifest,
+    set_run_id,
+    verify_manifest,
+)
+from models import OutputType, DownloadResult, StageProvenance
+from resource_util import (
+    ResourceSnapshot,
+    get_resource_usage_since,
+    take_resource_snapshot,
+)
+from s3_transfer_util import (
+    get_pooled_s3_client,
+    get_transfer_config,
+    stream_tar_to_s3,
+)
+from shard_util import ShardLocation, ShardSpool, get_byte_range
+
+if TYPE_CHECKING:  # boto3 is only imported once S3 is used
+    from boto3.s3.transfer import TransferConfig
 
 
 logger = logging.getLogger(__name__)
 DANE_DOWNLOAD_TASK_KEY = "DOWNLOAD"
 OUTPUT_FILE_BASE_NAME = "visxp_prep"
-S3_OUTPUT_TYPES: List[OutputType] = [OutputType.PROVENANCE, OutputType.METADATA]
-# only upload this output to S3
-if cfg.VISXP_PREP.RUN_KEYFRAME_EXTRACTION:
-    S3_OUTPUT_TYPES.append(OutputType.KEYFRAMES)
-if cfg.VISXP_PREP.RUN_AUDIO_EXTRACTION:
-    S3_OUTPUT_TYPES.append(OutputType.SPECTROGRAMS)
-if cfg.VISXP_PREP.GENERATE_SPECTROGRAM_IMAGES:
-    S3_OUTPUT_TYPES.append(OutputType.SPECTROGRAM_IMAGES)
-if cfg.VISXP_PREP.EXTRACT_AUDIO_SAMPLES:
-    S3_OUTPUT_TYPES.append(OutputType.AUDIO)
+_input_cache: Optional[InputCache] = None  # see get_input_cache()
+_shard_spool: Optional[ShardSpool] = None  # see get_shard_spool()
+SHARDS_FOLDER = "shards"  # in S3_FOLDER_IN_BUCKET
+SHARD_POLL_INTERVAL_S = 1
 
 
 # make sure the necessary base dirs are there
@@ -56,6 +78,8 @@ def validate_data_dirs() -> bool:
     except FileExistsError as e:
         logger.info(e)
 
+    if cfg.FILE_SYSTEM.SCRATCH_DIR:
+        os.makedirs(cfg.FILE_SYSTEM.SCRATCH_DIR, 0o755, exist_ok=True)
     return True
 
 
@@ -63,6 +87,11 @@ def get_download_dir():
     return os.path.join(cfg.FILE_SYSTEM.BASE_MOUNT, cfg.FILE_SYSTEM.INPUT_DIR)
 
 
+# time range jobs of long assets (see split_util), shared by all worker nodes
+def get_split_jobs_dir() -> str:
+    return os.path.join(cfg.FILE_SYSTEM.BASE_MOUNT, cfg.SPLIT.JOBS_DIR)
+
+
 def get_provenance_file(input_file_path: str) -> str:
     return os.path.join(
         get_base_output_dir(get_source_id(input_file_path)),
@@ -78,17 +107,130 @@ def get_source_id(input_file_path: str) -> str:
     return fn[0 : fn.rfind(".")] if "." in fn else fn
 
 
-# below this dir each processing module will put its output data in a subfolder
+# below this dir each processing module will put its output data in a subfolder:
+# the asset's scratch dir while it's being processed there, see generate_output_dirs()
 def get_base_output_dir(source_id: str = "") -> str:
+    if source_id and os.path.isdir(get_scratch_output_dir(source_id)):
+        return get_scratch_output_dir(source_id)
+    return get_shared_output_dir(source_id)
+
+
+# the output dir on the shared mount (BASE_MOUNT), where the output is kept
+def get_shared_output_dir(source_id: str = "") -> str:
     path_elements = [cfg.FILE_SYSTEM.BASE_MOUNT, cfg.FILE_SYSTEM.OUTPUT_DIR]
     if source_id:
         path_elements.append(source_id)
     return os.path.join(*path_elements)
 
 
-# output file name of the final tar.gz that will be uploaded to S3
-def get_output_file_name(source_id: str) -> str:
-    return f"{OUTPUT_FILE_BASE_NAME}__{source_id}.tar.gz"
+# the output dir on the fast local scratch path (if FILE_SYSTEM.SCRATCH_DIR is set)
+def get_scratch_output_dir(source_id: str) -> str:
+    if not cfg.FILE_SYSTEM.SCRATCH_DIR:
+        return ""
+    return os.path.join(cfg.FILE_SYSTEM.SCRATCH_DIR, source_id)
+
+
+# stages the output of a new asset in scratch, if there's room below the size limit
+# (FILE_SYSTEM.SCRATCH_MAX_BYTES, 0: no limit). Output that is on the shared mount
+# already (e.g. written before the media could be split) stays there
+def _use_scratch(source_id: str) -> bool:
+    scratch_dir = get_scratch_output_dir(source_id)
+    if not scratch_dir or os.path.isdir(get_shared_output_dir(source_id)):
+        return False
+    max_bytes = cfg.FILE_SYSTEM.SCRATCH_MAX_BYTES
+    used_bytes = get_dir_size(cfg.FILE_SYSTEM.SCRATCH_DIR) if max_bytes > 0 else 0
+    if max_bytes > 0 and used_bytes >= max_bytes:
+        logger.warning(
+            f"Scratch is full ({used_bytes} bytes), writing {source_id} to the shared "
+            "output dir"
+        )
+        return False
+    return True
+
+
+def get_dir_size(path: str) -> int:
+    size = 0
+    for root, _, files in os.walk(path):
+        for fn in files:
+            try:
+                size += os.path.getsize(os.path.join(root, fn))
+            except OSError:  # e.g. deleted by a task finishing in the meantime
+                pass
+    return size
+
+
+# moves the output from scratch to the shared output dir. It's copied to a temporary
+# dir next to it first, which is then renamed: readers never see partial output
+def publish_output(source_id: str) -> bool:
+    scratch_dir = get_scratch_output_dir(source_id)
+    if not scratch_dir or not os.path.isdir(scratch_dir):
+        return True  # not staged, so on the shared mount already
+    shared_dir = get_shared_output_dir(source_id)
+    tmp_dir = f"{shared_dir}.publishing-{os.getpid()}"
+    logger.info(f"Publishing {scratch_dir} to {shared_dir}")
+    try:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        shutil.copytree(scratch_dir, tmp_dir)
+        if os.path.isdir(shared_dir):  # e.g. the output of an earlier run
+            old_dir = f"{shared_dir}.old-{os.getpid()}"
+            os.rename(shared_dir, old_dir)
+            os.rename(tmp_dir, shared_dir)
+            shutil.rmtree(old_dir)
+        else:
+            os.rename(tmp_dir, shared_dir)
+        shutil.rmtree(scratch_dir)
+    except Exception:
+        logger.exception(f"Failed to publish {scratch_dir} to {shared_dir}")
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        return False
+    return True
+
+
+# output file name of an archive that will be uploaded to S3, the extension
+# (.tar, .tar.gz or .tar.zst) tells the downstream reader how to unpack it.
+# With incremental uploads each output type has its own archive
+def get_output_file_name(
+    source_id: str,
+    compression: Compression = Compression.GZIP,
+    output_type: Optional[OutputType] = None,
+) -> str:
+    suffix = f"__{output_type.value}" if output_type else ""
+    return (
+        f"{OUTPUT_FILE_BASE_NAME}__{source_id}{suffix}{ARCHIVE_EXTENSIONS[compression]}"
+    )
+
+
+# lists the archives of an incrementally uploaded asset, written last
+def get_manifest_file_name(source_id: str) -> str:
+    return f"{OUTPUT_FILE_BASE_NAME}__{source_id}.manifest.json"
+
+
+# only this output is uploaded to S3 (read from the config on use, not on import)
+def get_s3_output_types() -> List[OutputType]:
+    output_types = [OutputType.PROVENANCE, OutputType.METADATA]
+    if cfg.VISXP_PREP.RUN_KEYFRAME_EXTRACTION:
+        output_types.append(OutputType.KEYFRAMES)
+    if cfg.VISXP_PREP.RUN_AUDIO_EXTRACTION:
+        output_types.append(OutputType.SPECTROGRAMS)
+    if cfg.VISXP_PREP.GENERATE_SPECTROGRAM_IMAGES:
+        output_types.append(OutputType.SPECTROGRAM_IMAGES)
+    if cfg.VISXP_PREP.EXTRACT_AUDIO_SAMPLES:
+        output_types.append(OutputType.AUDIO)
+    return output_types
+
+
+# OUTPUT.COMPRESSION maps OutputType values to a Compression (default: gzip)
+def get_output_compression(output_type: OutputType) -> Compression:
+    policy = cfg.OUTPUT.get("COMPRESSION") or {}
+    return Compression(policy.get(output_type.value, Compression.GZIP.value))
+
+
+# the output types are uploaded as one archive per compression
+def get_archive_groups() -> Dict[Compression, List[OutputType]]:
+    groups: Dict[Compression, List[OutputType]] = {}
+    for output_type in get_s3_output_types():
+        groups.setdefault(get_output_compression(output_type), []).append(output_type)
+    return groups
 
 
 # e.g. s3://<bucket>/assets/<source_id>
@@ -96,18 +238,45 @@ def get_s3_base_uri(source_id: str) -> str:
     return f"s3://{os.path.join(cfg.OUTPUT.S3_BUCKET, cfg.OUTPUT.S3_FOLDER_IN_BUCKET, source_id)}"
 
 
+# e.g. s3://<bucket>/assets/<source_id>/visxp_prep__<source_id>.manifest.json
+def get_s3_manifest_uri(source_id: str) -> str:
+    return f"{get_s3_base_uri(source_id)}/{get_manifest_file_name(source_id)}"
+
+
 # e.g. s3://<bucket>/assets/<source_id>/visxp_prep__<source_id>.tar.gz
+# or, in case the output is split over several archives, s3://<bucket>/assets/<source_id>
+# (or the manifest, when uploading incrementally)
 def get_s3_output_file_uri(source_id: str) -> str:
-    return f"{get_s3_base_uri(source_id)}/{get_output_file_name(source_id)}"
+    if cfg.OUTPUT.INCREMENTAL_UPLOAD:
+        return get_s3_manifest_uri(source_id)
+    groups = get_archive_groups()
+    if len(groups) != 1:
+        return get_s3_base_uri(source_id)
+    compression = next(iter(groups))
+    return (
+        f"{get_s3_base_uri(source_id)}/{get_output_file_name(source_id, compression)}"
+    )
 
 
-# for each OutputType a subdir is created inside the base output dir
-def generate_output_dirs(source_id: str) -> Dict[str, str]:
+# for each OutputType a subdir is created inside the base output dir, which is in
+# scratch if configured & possible (use_scratch=False: only processes on this node
+# can write to it, e.g. not the helpers of a split asset). run_id: of the run that
+# writes the output, so the output manifest leaves out that of earlier runs
+def generate_output_dirs(
+    source_id: str, use_scratch: bool = True, run_id: str = ""
+) -> Dict[str, str]:
+    scratch_dir = get_scratch_output_dir(source_id)
+    if use_scratch and not os.path.isdir(scratch_dir) and _use_scratch(source_id):
+        logger.info(f"Staging the output in {scratch_dir}")
+        os.makedirs(scratch_dir)
     base_output_dir = get_base_output_dir(source_id)
+    if run_id:
+        set_run_id(base_output_dir, run_id)
     output_dirs = {}
-    logger.info(f"Creating output dirs for {S3_OUTPUT_TYPES}")
+    s3_output_types = get_s3_output_types()
+    logger.info(f"Creating output dirs for {s3_output_types}")
     for output_type in OutputType:
-        if output_type not in S3_OUTPUT_TYPES:
+        if output_type not in s3_output_types:
             # Only create it if you will, in the end, upload it too (experimental)
             continue
         output_dir = os.path.join(base_output_dir, output_type.value)
@@ -117,6 +286,17 @@ def generate_output_dirs(source_id: str) -> Dict[str, str]:
     return output_dirs
 
 
+# e.g. the output of a failed task, which is not kept
+def discard_scratch_output(source_id: str) -> None:
+    scratch_dir = get_scratch_output_dir(source_id)
+    if scratch_dir and os.path.isdir(scratch_dir):
+        logger.info(f"Discarding {scratch_dir}")
+        shutil.rmtree(scratch_dir, ignore_errors=True)
+
+
+# deletes the files in the output manifest (written once all stages are done, see
+# manifest_util.py) and the manifest itself, then the dirs that are left empty. Any
+# other files (not written by this worker) are kept
 def delete_local_output(source_id: str) -> bool:
     output_dir = get_base_output_dir(source_id)
     logger.info(f"Deleting output folder: {output_dir}")
@@ -124,24 +304,72 @@ def delete_local_output(source_id: str) -> bool:
         logger.warning(f"Rejected deletion of: {output_dir}")
         return False
 
-    if not _is_valid_visxp_output(output_dir):
+    manifest = read_manifest(output_dir)
+    if manifest is None:
         logger.warning(
             f"Tried to delete a dir that did not contain VisXP output: {output_dir}"
         )
         return False
 
     try:
-        shutil.rmtree(output_dir)
-        logger.info(f"Cleaned up folder {output_dir}")
+        for entry in manifest["files"]:
+            try:
+                os.remove(os.path.join(output_dir, entry["path"]))
+            except FileNotFoundError:
+                pass  # e.g. deleted by an earlier attempt
+        os.remove(get_manifest_path(output_dir))
+        shutil.rmtree(os.path.join(output_dir, FRAGMENTS_DIR), ignore_errors=True)
+        _remove_empty_dirs(output_dir)
     except Exception:
         logger.exception(f"Failed to delete output dir {output_dir}")
         return False
+    if os.path.isdir(output_dir):
+        logger.warning(f"Kept the files in {output_dir} that are not in the manifest")
+    else:
+        logger.info(f"Cleaned up folder {output_dir}")
     return True
 
 
-# TODO implement some more, now checks presence of provenance dir
-def _is_valid_visxp_output(output_dir: str) -> bool:
-    return os.path.exists(os.path.join(output_dir, OutputType.PROVENANCE.value))
+# bottom-up, including root itself
+def _remove_empty_dirs(root: str) -> None:
+    for dir_path, _, _ in os.walk(root, topdown=False):
+        try:
+            os.rmdir(dir_path)
+        except OSError:
+            pass  # not empty
+
+
+# checks that the files in the manifest are there with the right size (the dirs
+# are not listed), before the output is archived
+def _verify_output(source_id: str) -> bool:
+    output_dir = get_base_output_dir(source_id)
+    manifest = read_manifest(output_dir)
+    if manifest is None:
+        logger.warning(f"No output manifest in {output_dir}")
+        return True  # e.g. output of an older version of this worker
+    invalid = verify_manifest(output_dir, manifest)
+    if invalid:
+        logger.error(f"Output files missing or incomplete: {invalid}")
+    return not invalid
+
+
+# the output of these types to archive: the files in the manifest (and their
+# dirs), so the dirs are not walked. Or else, before the manifest is written (e.g.
+# an incremental upload), the whole dirs. Returns the items & their base dir
+def _get_archive_items(
+    source_id: str, output_types: List[OutputType]
+) -> Tuple[List[str], str]:
+    output_dir = get_base_output_dir(source_id)
+    manifest = read_manifest(output_dir)
+    if manifest is None:
+        return [os.path.join(output_dir, ot.value) for ot in output_types], ""
+    items = []
+    for output_type in output_types:
+        items.append(os.path.join(output_dir, output_type.value))
+        items.extend(get_manifest_files(output_dir, manifest, output_type))
+        if output_type == OutputType.PROVENANCE:  # it can't list itself
+            items.append(get_manifest_path(output_dir))
+    return items, output_dir
 
 
 def _validate_transfer_config() -> bool:
@@ -162,33 +390,295 @@ def _validate_transfer_config() -> bool:
     return True
 
 
-# compresses all desired output dirs into a single tar and uploads it to S3
-def transfer_output(source_id: str) -> bool:
+# archives the desired output dirs (one archive per compression) and uploads them
+# to S3. Returns the transfer provenance, or None in case of failure
+def transfer_output(
+    source_id: str, software_version: Optional[Dict[str, Any]] = None
+) -> Optional[StageProvenance]:
     output_dir = get_base_output_dir(source_id)
     logger.info(f"Transferring {output_dir} to S3 (asset={source_id})")
-    if not _validate_transfer_config():
-        return False
+    if not _validate_transfer_config() or not _verify_output(source_id):
+        return None
+
+    if _use_shard(source_id):
+        return _transfer_to_shard(source_id, software_version)
 
-    s3 = S3Store(cfg.OUTPUT.S3_ENDPOINT_URL)
-    file_list = [os.path.join(output_dir, ot.value) for ot in S3_OUTPUT_TYPES]
-    tar_file = os.path.join(output_dir, get_output_file_name(source_id))
-
-    success = s3.transfer_to_s3(
-        cfg.OUTPUT.S3_BUCKET,
-        os.path.join(
-            cfg.OUTPUT.S3_FOLDER_IN_BUCKET, source_id
-        ),  # assets/<program ID>__<carrier ID>
-        file_list,  # this list of subdirs will be compressed into the tar below
-        tar_file,  # this file will be uploaded
+    start_time = time.time()
+    resource_snapshot = take_resource_snapshot()
+    archives = {}
+    for compression, output_types in get_archive_groups().items():
+        file_name = get_output_file_name(source_id, compression)
+        stats = _transfer_archive(
+            source_id,
+            file_name,
+            *_get_archive_items(source_id, output_types),
+            compression,
+        )
+        if not stats:
+            logger.error(f"Failed to upload: {file_name}")
+            return None
+        archives[f"{get_s3_base_uri(source_id)}/{file_name}"] = stats.to_json()
+
+    return StageProvenance(
+        activity_name="Transfer VisXP output",
+        activity_description="Archive the output and upload it to S3",
+        start_time_unix=start_time,
+        processing_time_ms=(time.time() - start_time) * 1000,
+        software_version=software_version or {},
+        input_data={"output_dir": output_dir},
+        output_data={"archives": archives, "s3_client": get_s3_client_stats()},
+        resource_usage=get_resource_usage_since(resource_snapshot),
     )
-    if not success:
-        logger.error(f"Failed to upload: {tar_file}")
+
+
+# small output (OUTPUT.SHARD_MAX_ASSET_BYTES per the output manifest) is appended
+# to a shared shard object, instead of uploaded as separate (tiny) archives
+def _use_shard(source_id: str) -> bool:
+    if not cfg.OUTPUT.SHARD_UPLOAD:
         return False
-    return True
+    manifest = read_manifest(get_base_output_dir(source_id))
+    return (
+        manifest is not None
+        and manifest["total_bytes"] <= cfg.OUTPUT.SHARD_MAX_ASSET_BYTES
+    )
+
+
+# archives the output (one archive per compression, as transfer_output() does) in
+# the output dir and appends them to the open shard. The shard is uploaded once
+# it's full or old enough (see flush_output_shards), so the output is not readable
+# from S3 right away: see wait_for_shard_upload(). Returns the transfer provenance,
+# or None in case of failure
+def _transfer_to_shard(
+    source_id: str, software_version: Optional[Dict[str, Any]] = None
+) -> Optional[StageProvenance]:
+    output_dir = get_base_output_dir(source_id)
+    start_time = time.time()
+    resource_snapshot = take_resource_snapshot()
+    archives: Dict[str, str] = {}
+    stats: Dict[str, dict] = {}
+    try:
+        for compression, output_types in get_archive_groups().items():
+            file_name = get_output_file_name(source_id, compression)
+            archives[file_name] = os.path.join(output_dir, file_name)
+            file_list, base_dir = _get_archive_items(source_id, output_types)
+            with open(archives[file_name], "wb") as f:
+                stats[file_name] = write_archive(
+                    f, file_list, compression, get_zstd_threads(), base_dir
+                ).to_json()
+        location = get_shard_spool().append(source_id, archives)
+    except Exception:
+        logger.exception(f"Failed to append the output of {source_id} to a shard")
+        return None
+    finally:
+        for archive in archives.values():
+            if os.path.exists(archive):
+                os.remove(archive)
+
+    return StageProvenance(
+        activity_name="Transfer VisXP output",
+        activity_description="Archive the output and append it to a shard",
+        start_time_unix=start_time,
+        processing_time_ms=(time.time() - start_time) * 1000,
+        software_version=software_version or {},
+        input_data={"output_dir": output_dir},
+        output_data={
+            "archives": {
+                f"{location.uri}#{file_name}": {
+                    **stats[file_name],
+                    **location.archives[file_name],
+                }
+                for file_name in archives
+            },
+            "shard": location.to_json(),
+            "s3_client": get_s3_client_stats(),
+        },
+        resource_usage=get_resource_usage_since(resource_snapshot),
+    )
+
+
+# the location of the output in a shard, if it was transferred to one, from the
+# transfer step of a task's provenance (e.g. to save it to the DANE index)
+def get_shard_location(provenance: Optional[Provenance]) -> Optional[ShardLocation]:
+    for step in (provenance.steps or []) if provenance else []:
+        shard = (step.output_data or {}).get("shard")
+        if shard:
+            return ShardLocation(**shard)
+    return None
+
+
+class IncrementalOutputUpload:
+    """Uploads the output of each OutputType (as a separate archive) as soon as the
+    stage producing it is done, on a background pool, while processing continues.
+    finish() uploads the remaining output and then the manifest, which marks the
+    asset as complete"""
+
+    def __init__(self, source_id: str, max_workers: int):
+        self.source_id = source_id
+        self.start_time = time.time()
+        self._pool = ThreadPoolExecutor(max_workers=max_workers)
+        self._uploads: Dict[OutputType, Future] = {}
+
+    # call when the output of these types is complete
+    def upload(self, output_types: List[OutputType]) -> None:
+        s3_output_types = get_s3_output_types()
+        for output_type in output_types:
+            if output_type in s3_output_types and output_type not in self._uploads:
+                logger.info(f"Starting upload of {output_type.value}")
+                self._uploads[output_type] = self._pool.submit(
+                    self._upload_output_type, output_type
+                )
+
+    def _upload_output_type(self, output_type: OutputType) -> Optional[ArchiveStats]:
+        compression = get_output_compression(output_type)
+        return _transfer_archive(
+            self.source_id,
+            get_output_file_name(self.source_id, compression, output_type),
+            *_get_archive_items(self.source_id, [output_type]),
+            compression,
+        )
+
+    # waits for all uploads, returns the transfer provenance or None on failure
+    def finish(
+        self, software_version: Optional[Dict[str, Any]] = None
+    ) -> Optional[StageProvenance]:
+        if not _validate_transfer_config() or not _verify_output(self.source_id):
+            self.abort()
+            return None
+        self.upload(get_s3_output_types())  # whatever has not been uploaded yet
+        archives = {}
+        for output_type, upload in self._uploads.items():
+            stats = upload.result()
+            if not stats:
+                logger.error(f"Failed to upload {output_type.value}")
+                self.abort()
+                return None
+            compression = get_output_compression(output_type)
+            archives[output_type.value] = {
+                "file_name": get_output_file_name(
+                    self.source_id, compression, output_type
+                ),
+                **stats.to_json(),
+            }
+        self._pool.shutdown()
+
+        manifest = {"source_id": self.source_id, "archives": archives}
+        # so consumers can check the output files without downloading the archives
+        output_manifest = read_manifest(get_base_output_dir(self.source_id))
+        if output_manifest:
+            manifest["files"] = output_manifest["files"]
+        manifest_key = _get_s3_key(
+            self.source_id, get_manifest_file_name(self.source_id)
+        )
+        try:
+            get_s3_client().put_object(
+                Bucket=cfg.OUTPUT.S3_BUCKET,
+                Key=manifest_key,
+                Body=json.dumps(manifest, indent=4).encode("utf-8"),
+                ContentType="application/json",
+            )
+        except Exception:
+            logger.exception(f"Failed to upload the manifest: {manifest_key}")
+            return None
+        logger.info(f"Uploaded all output of {self.source_id}")
+        return StageProvenance(
+            activity_name="Transfer VisXP output",
+            activity_description="Upload the output per type while processing",
+            start_time_unix=self.start_time,
+            processing_time_ms=(time.time() - self.start_time) * 1000,
+            software_version=software_version or {},
+            input_data={"output_dir": get_base_output_dir(self.source_id)},
+            output_data={
+                "manifest": get_s3_manifest_uri(self.source_id),
+                **manifest,
+                "s3_client": get_s3_client_stats(),
+            },
+        )
+
+    # stops uploading, e.g. when processing failed (no manifest is written)
+    def abort(self) -> None:
+        logger.warning(f"Aborting the upload of {self.source_id}")
+        self._pool.shutdown(cancel_futures=True)
+
+
+# the (thread-safe) S3 client shared by all downloads and uploads of this process
+def get_s3_client():
+    return get_pooled_s3_client(
+        cfg.OUTPUT.S3_ENDPOINT_URL, cfg.OUTPUT.S3_MAX_POOL_CONNECTIONS
+    ).client
+
+
+def get_s3_client_stats() -> Dict[str, int]:
+    return get_pooled_s3_client(
+        cfg.OUTPUT.S3_ENDPOINT_URL, cfg.OUTPUT.S3_MAX_POOL_CONNECTIONS
+    ).get_stats()
+
+
+def get_s3_transfer_config() -> "TransferConfig":
+    return get_transfer_config(
+        cfg.OUTPUT.MULTIPART_THRESHOLD_BYTES,
+        cfg.OUTPUT.MULTIPART_PART_SIZE_BYTES,
+        cfg.OUTPUT.MULTIPART_MAX_CONCURRENCY,
+    )
+
+
+# by default, zstd uses one thread per core or the job's CPU budget
+def get_zstd_threads() -> int:
+    return cfg.OUTPUT.ZSTD_THREADS or get_cpu_threads()
+
+
+# e.g. assets/<program ID>__<carrier ID>/<file_name>
+def _get_s3_key(source_id: str, file_name: str) -> str:
+    return os.path.join(cfg.OUTPUT.S3_FOLDER_IN_BUCKET, source_id, file_name)
+
+
+# uploads a tar of file_list, streamed or via a temporary file in the output dir
+def _transfer_archive(
+    source_id: str,
+    file_name: str,
+    file_list: List[str],
+    base_dir: str,  # see write_archive()
+    compression: Compression,
+) -> Optional[ArchiveStats]:
+    key = _get_s3_key(source_id, file_name)
+    if cfg.OUTPUT.STREAMING_UPLOAD:
+        # no temporary tar on disk: compress straight into a multipart upload
+        return stream_tar_to_s3(
+            get_s3_client(),
+            cfg.OUTPUT.S3_BUCKET,
+            key,
+            file_list,
+            cfg.OUTPUT.MULTIPART_PART_SIZE_BYTES,
+            cfg.OUTPUT.MULTIPART_MAX_CONCURRENCY,
+            compression,
+            get_zstd_threads(),
+            base_dir,
+        )
+
+    tar_file = os.path.join(get_base_output_dir(source_id), file_name)
+    try:
+        with open(tar_file, "wb") as f:
+            stats = write_archive(
+                f, file_list, compression, get_zstd_threads(), base_dir
+            )
+        get_s3_client().upload_file(
+            Filename=tar_file,
+            Bucket=cfg.OUTPUT.S3_BUCKET,
+            Key=key,
+            Config=get_s3_transfer_config(),
+        )
+    except Exception:
+        logger.exception(f"Failed to upload {tar_file} to S3")
+        return None
+    logger.info(f"Uploaded {tar_file} to s3://{cfg.OUTPUT.S3_BUCKET}/{key}")
+    return stats
 
 
 def delete_input_file(input_file: str, actually_delete: bool) -> bool:
     logger.info(f"Verifying deletion of input file: {input_file}")
+    input_cache = get_input_cache()
+    if input_cache and input_cache.release(input_file):
+        logger.info("Input file is managed by the input cache, released it")
+        return True
     if actually_delete is False:
         logger.info("Configured to leave the input alone, skipping deletion")
         return True
@@ -204,7 +694,156 @@ def delete_input_file(input_file: str, actually_delete: bool) -> bool:
     return True  # return True even if empty dirs were not removed
 
 
+# shared by the workers on this node (if INPUT.CACHE_QUOTA_BYTES > 0)
+def get_input_cache() -> Optional[InputCache]:
+    global _input_cache
+    if cfg.INPUT.CACHE_QUOTA_BYTES <= 0:
+        return None
+    if _input_cache is None:
+        _input_cache = InputCache(
+            get_download_dir(),
+            cfg.INPUT.CACHE_QUOTA_BYTES,
+            cfg.INPUT.CACHE_VERIFY_CHECKSUM,
+        )
+    return _input_cache
+
+
+# shared by the worker's processes (and the workers on this node), if
+# OUTPUT.SHARD_UPLOAD. By default the spool is on the shared output mount, so the
+# other nodes upload the shards of a node that's gone
+def get_shard_spool() -> ShardSpool:
+    global _shard_spool
+    if _shard_spool is None:
+        _shard_spool = ShardSpool(
+            cfg.OUTPUT.SHARD_SPOOL_DIR
+            or os.path.join(get_shared_output_dir(), ".shards"),
+            f"s3://{os.path.join(cfg.OUTPUT.S3_BUCKET, _get_shards_prefix())}",
+            cfg.OUTPUT.SHARD_MAX_BYTES,
+            cfg.OUTPUT.SHARD_MAX_AGE_S,
+            _upload_shard_file,
+        )
+    return _shard_spool
+
+
+# uploads the shards that are full or old enough (force: all of them)
+def flush_output_shards(force: bool = False) -> List[str]:
+    try:
+        return get_shard_spool().flush(force)
+    except Exception:
+        logger.exception("Failed to flush the output shards")
+        return []
+
+
+# waits until the shard holding an asset's output was uploaded (flushing it once
+# it's due), so the location is readable before it's saved to the DANE index
+def wait_for_shard_upload(location: ShardLocation, timeout_s: float) -> bool:
+    deadline = time.time() + timeout_s
+    while not get_shard_spool().is_uploaded(location):
+        if time.time() >= deadline:
+            logger.error(f"Timed out waiting for the upload of {location.uri}")
+            return False
+        time.sleep(SHARD_POLL_INTERVAL_S)
+        flush_output_shards()
+    return True
+
+
+# flushes the shards every interval_s until stop is set, e.g. in the worker. The
+# first flush uploads what was left in the spool, e.g. by a worker that crashed
+def start_shard_flusher(stop: threading.Event, interval_s: float) -> threading.Thread:
+    def flush_until_stopped():
+        flush_output_shards()
+        while not stop.wait(interval_s):
+            flush_output_shards()
+
+    flusher = threading.Thread(
+        target=flush_until_stopped, name="shard-flusher", daemon=True
+    )
+    flusher.start()
+    return flusher
+
+
+# the bytes of an asset's archive in a shard (once uploaded), by a range request
+def read_shard_archive(location: ShardLocation, file_name: str) -> bytes:
+    from dane.s3_util import parse_s3_uri  # imports boto3
+
+    bucket, key = parse_s3_uri(location.uri)
+    archive = location.archives[file_name]
+    response = get_s3_client().get_object(
+        Bucket=bucket,
+        Key=key,
+        Range=get_byte_range(archive["offset"], archive["length"]),
+    )
+    return response["Body"].read()
+
+
+# e.g. assets/shards
+def _get_shards_prefix() -> str:
+    return os.path.join(cfg.OUTPUT.S3_FOLDER_IN_BUCKET, SHARDS_FOLDER)
+
+
+def _upload_shard_file(file_path: str, file_name: str) -> bool:
+    key = os.path.join(_get_shards_prefix(), file_name)
+    try:
+        get_s3_client().upload_file(
+            Filename=file_path,
+            Bucket=cfg.OUTPUT.S3_BUCKET,
+            Key=key,
+            Config=get_s3_transfer_config(),
+        )
+    except Exception:
+        logger.exception(f"Failed to upload {file_path} to S3")
+        return False
+    return True
+
+
+# makes sure only one worker at a time downloads input_file (no-op without cache)
+def input_cache_lock(input_file: str) -> ContextManager:
+    input_cache = get_input_cache()
+    return input_cache.lock(input_file) if input_cache else nullcontext()
+
+
+# True if input_file can be used without downloading it
+def is_input_available(input_file: str) -> bool:
+    input_cache = get_input_cache()
+    if input_cache:
+        return input_cache.contains(input_file)
+    return os.path.exists(input_file)
+
+
+# returns the cached input_file (referenced until delete_input_file) or None
+def get_cached_input(input_file: str) -> Optional[DownloadResult]:
+    start_time = time.time()
+    input_cache = get_input_cache()
+    if input_cache:
+        checksum = input_cache.acquire(input_file)
+        if checksum is None:
+            return None
+        return DownloadResult(
+            input_file,
+            (time.time() - start_time) * 1000,
+            content_length=os.path.getsize(input_file),
+            checksum=checksum,
+            cache_hit=True,
+        )
+    # download if the file is not present (preventing unnecessary downloads)
+    if os.path.exists(input_file):
+        logger.info(f"{input_file} already present, skipping download")
+        return DownloadResult(input_file, (time.time() - start_time) * 1000)
+    return None
+
+
+# registers a completed download in the input cache (if configured)
+def add_to_input_cache(download_result: DownloadResult) -> DownloadResult:
+    input_cache = get_input_cache()
+    if input_cache:
+        input_cache.add(download_result.file_path, download_result.checksum)
+        download_result.cache_hit = False
+    return download_result
+
+
 def download_uri(uri: str) -> Optional[DownloadResult]:
+    from dane.s3_util import validate_s3_uri  # imports boto3
+
     logger.info(f"Trying to download {uri}")
     if validate_s3_uri(uri):
         logger.info("URI seems to be an s3 uri")
@@ -212,31 +851,57 @@ def download_uri(uri: str) -> Optional[DownloadResult]:
     return http_download(uri)
 
 
-# TODO test this!
+def get_http_download_settings() -> HttpDownloadSettings:
+    return HttpDownloadSettings(
+        chunk_size=cfg.INPUT.HTTP_CHUNK_SIZE_BYTES,
+        timeout_s=cfg.INPUT.HTTP_TIMEOUT_S,
+        max_retries=cfg.INPUT.HTTP_MAX_RETRIES,
+        parallel_connections=cfg.INPUT.HTTP_PARALLEL_CONNECTIONS,
+        parallel_threshold_bytes=cfg.INPUT.HTTP_PARALLEL_THRESHOLD_BYTES,
+    )
+
+
+# where http_download() stores the file behind the url
+def get_http_download_path(url: str) -> str:
+    return os.path.join(get_download_dir(), os.path.basename(urlparse(url).path))
+
+
 def http_download(url: str) -> Optional[DownloadResult]:
     logger.info(f"Downloading {url}")
-    fn = os.path.basename(urlparse(url).path)
-    # fn = unquote(fn)
-    # fn = doc.target['url'][doc.target['url'].rfind('/') +1:]
-    output_file = os.path.join(get_download_dir(), fn)
-    logger.info(f"Saving to file {fn}")
-
-    # download if the file is not present (preventing unnecessary downloads)
-    start_time = time.time()
-    if not os.path.exists(output_file):
-        with open(output_file, "wb") as file:
-            response = requests.get(url)
-            file.write(response.content)
-            file.close()
-    download_time = (time.time() - start_time) * 1000  # time in ms
-    return DownloadResult(
-        output_file,  # NOTE or output_file? hmmm
-        download_time,  # TODO add mime_type and content_length
-    )
+    output_file = get_http_download_path(url)
+    logger.info(f"Saving to file {output_file}")
+
+    with input_cache_lock(output_file):
+        cached_input = get_cached_input(output_file)
+        if cached_input:
+            return cached_input
+
+        start_time = time.time()
+        try:
+            info = download_file(url, output_file, get_http_download_settings())
+        except (HttpDownloadException, OSError):
+            logger.exception(f"Failed to download {url}")
+            return None
+        download_time = (time.time() - start_time) * 1000  # time in ms
+        logger.info(
+            f"Downloaded {info.content_length} bytes in {download_time}ms "
+            f"({info.connections} connection(s), {info.resumes} resume(s))"
+        )
+        return add_to_input_cache(
+            DownloadResult(
+                output_file,
+                download_time,
+                info.mime_type,
+                info.content_length,
+                info.checksum,
+            )
+        )
 
 
 # e.g. s3://dane-asset-staging-gb/assets/2101608170158176431__NOS_JOURNAAL_-WON01513227.mp4
 def s3_download(s3_uri: str) -> Optional[DownloadResult]:
+    from dane.s3_util import parse_s3_uri, validate_s3_uri  # imports boto3
+
     logger.info(f"Downloading {s3_uri}")
     if not validate_s3_uri(s3_uri):
         logger.error(f"Invalid S3 URI: {s3_uri}")
@@ -246,8 +911,6 @@ def s3_download(s3_uri: str) -> Optional[DownloadResult]:
     start_time = time.time()
     output_folder = get_download_dir()
 
-    # TODO download the content into get_download_dir()
-    s3 = S3Store(cfg.OUTPUT.S3_ENDPOINT_URL)
     bucket, object_name = parse_s3_uri(s3_uri)
     logger.info(f"OBJECT NAME: {object_name}")
     input_file_path = os.path.join(
@@ -255,15 +918,49 @@ def s3_download(s3_uri: str) -> Optional[DownloadResult]:
         # source_id,
         os.path.basename(object_name),  # i.e. visxp_prep__<source_id>.tar.gz
     )
-    success = s3.download_file(bucket, object_name, output_folder)
-    if success:
-        download_time = time.time() - start_time
-        return DownloadResult(
-            input_file_path,
-            download_time,
+    with input_cache_lock(input_file_path):
+        cached_input = get_cached_input(input_file_path)
+        if cached_input:
+            return cached_input
+        os.makedirs(output_folder, exist_ok=True)
+        try:
+            # NOTE: boto3 downloads into a temporary file, renamed when complete
+            get_s3_client().download_file(
+                Bucket=bucket,
+                Key=object_name,
+                Filename=input_file_path,
+                Config=get_s3_transfer_config(),
+            )
+        except Exception:
+            logger.exception("Failed to download input data from S3")
+            return None
+        download_time = (time.time() - start_time) * 1000  # time in ms
+        logger.info(f"S3 client stats: {get_s3_client_stats()}")
+        return add_to_input_cache(
+            DownloadResult(
+                input_file_path,
+                download_time,
+            )
         )
-    logger.error("Failed to download input data from S3")
-    return None
+
+
+# lets e.g. ffprobe read (part of) an S3 object over HTTP(S)
+def get_presigned_url(s3_uri: str, expires_in_s: int = 3600) -> Optional[str]:
+    from dane.s3_util import parse_s3_uri, validate_s3_uri  # imports boto3
+
+    if not validate_s3_uri(s3_uri):
+        logger.error(f"Invalid S3 URI: {s3_uri}")
+        return None
+    bucket, object_name = parse_s3_uri(s3_uri)
+    try:
+        return get_s3_client().generate_presigned_url(
+            "get_object",
+            Params={"Bucket": bucket, "Key": object_name},
+            ExpiresIn=expires_in_s,
+        )
+    except Exception:
+        logger.exception(f"Could not sign a URL for {s3_uri}")
+        return None
 
 
 def to_download_provenance(
@@ -271,13 +968,30 @@ def to_download_provenance(
     input_file_path: str,
     start_time: float,
     software_version: str,
+    resource_snapshot: Optional[ResourceSnapshot] = None,
 ) -> Provenance:
-    return Provenance(
+    return StageProvenance(
         activity_name="Download VisXP input",
         activity_description="Download source AV media",
         start_time_unix=start_time,
         processing_time_ms=download_result.download_time,
         software_version=software_version,
         input_data={"input_file_path": input_file_path},
-        output_data={"file_path": download_result.file_path},
+        output_data={
+            "file_path": download_result.file_path,
+            "checksum": download_result.checksum,
+            **_get_input_cache_info(download_result),
+        },
+        resource_usage=(
+            get_resource_usage_since(resource_snapshot) if resource_snapshot else None
+        ),
     )
+
+
+def _get_input_cache_info(download_result: DownloadResult) -> dict:
+    input_cache = get_input_cache()
+    if not input_cache or download_result.cache_hit is None:
+        return {}
+    return {
+        "input_cache": {"hit": download_result.cache_hit, **input_cache.get_stats()}
+    }
@@ -1,11 +1,15 @@
+from dataclasses import asdict
 from functools import reduce
 import logging
+import os
 from typing import Optional, Tuple
+import uuid
 import validators
 from time import time
 
 from dane.config import cfg
 from dane.provenance import (
+    PROVENANCE_FILE,
     Provenance,
     obtain_software_versions,
     generate_initial_provenance,
@@ -15,20 +19,38 @@ from dane.s3_util import validate_s3_uri
 from models import (
     VisXPFeatureExtractionInput,
     CallbackResponse,
+    DownloadResult,
+    MediaFile,
+    OutputType,
+    StageProvenance,
 )
-from media_file_util import validate_media_file
+from manifest_util import ManifestRecorder, finalize_manifest
+from estimate_util import Calibration, Estimate, estimate_media_file
+from media_file_util import probe_media_uri, validate_media_file
 from io_util import (
+    add_to_input_cache,
     get_base_output_dir,
     generate_output_dirs,
     delete_local_output,
     delete_input_file,
+    discard_scratch_output,
     download_uri,
+    get_http_download_path,
+    get_http_download_settings,
     get_provenance_file,
+    get_source_id,
+    get_split_jobs_dir,
+    http_download,
+    IncrementalOutputUpload,
+    input_cache_lock,
+    is_input_available,
+    publish_output,
     to_download_provenance,
     transfer_output,
     validate_data_dirs,
 )
-import scenedetect_util
+from resource_util import get_resource_usage_since, take_resource_snapshot
+import split_util
 
 
 logger = logging.getLogger(__name__)
@@ -62,14 +84,22 @@ def run(
         software_version=obtain_software_versions(DANE_WORKER_ID),
     )
     provenance_chain = []  # will contain the steps of the top-level provenance
+    scenedetect_provenance = None  # only filled when run while downloading
+    run_id = uuid.uuid4().hex  # tags the output files recorded in this run
 
     # check if the input_file_path was already downloaded or not, if not do so
     if not download_provenance:
         logger.info(f"Analyzing input file: {input_file_path}")
         start_time = time()
+        resource_snapshot = take_resource_snapshot()
         if validate_s3_uri(input_file_path) or validators.url(input_file_path):
             logger.info("Input is a URI, contuining to download")
-            download_result = download_uri(input_file_path)
+            if cfg.INPUT.PIPELINED_DOWNLOAD and not validate_s3_uri(input_file_path):
+                download_result, scenedetect_provenance = download_and_detect_shots(
+                    input_file_path, run_id
+                )
+            else:
+                download_result = download_uri(input_file_path)
             if not download_result:
                 return {
                     "state": 500,
@@ -81,13 +111,23 @@ def run(
                     input_file_path,
                     start_time=start_time,
                     software_version=top_level_provenance.software_version,
+                    resource_snapshot=resource_snapshot,
                 )
                 input_file_path = download_result.file_path if download_result else ""
 
     if download_provenance:
         logger.info("Adding download provenance to provenance chain")
         provenance_chain.append(download_provenance)  # add the download provenance
-    proc_result = generate_input_for_feature_extraction(input_file_path)
+
+    # upload the output of each stage while the next stage is running
+    output_upload = None
+    if cfg.OUTPUT.TRANSFER_ON_COMPLETION and cfg.OUTPUT.INCREMENTAL_UPLOAD:
+        output_upload = IncrementalOutputUpload(
+            get_source_id(input_file_path), cfg.OUTPUT.MULTIPART_MAX_CONCURRENCY
+        )
+    proc_result = generate_input_for_feature_extraction(
+        input_file_path, scenedetect_provenance, output_upload, run_id
+    )
 
     if proc_result.provenance_chain:
         provenance_chain.extend(proc_result.provenance_chain)
@@ -103,40 +143,163 @@ def run(
         provenance_file_path=get_provenance_file(input_file_path),
     )
 
+    # the provenance.json is the last output file, so the manifest is complete now
+    if proc_result.state == 200:
+        finish_output_manifest(get_source_id(input_file_path), run_id)
+
     validated_output: CallbackResponse = (
         apply_desired_io_on_output(  # TODO make sure the media file is there
             proc_result,
             cfg.INPUT.DELETE_ON_COMPLETION,
             cfg.OUTPUT.DELETE_ON_COMPLETION,
             cfg.OUTPUT.TRANSFER_ON_COMPLETION,
+            full_provenance_chain,
+            output_upload,
         )
     )
     return validated_output, full_provenance_chain
 
 
+# lists every output file, with its size & checksum, in the output manifest
+def finish_output_manifest(source_id: str, run_id: str) -> None:
+    output_dir = get_base_output_dir(source_id)
+    recorder = ManifestRecorder(output_dir, "provenance", run_id)
+    recorder.add_file(
+        os.path.join(output_dir, OutputType.PROVENANCE.value, PROVENANCE_FILE)
+    )
+    recorder.save()
+    finalize_manifest(output_dir, run_id)
+
+
+# dry run: only probes the input (without downloading it) and estimates the runtime
+# & output size of each stage with the calibration (see estimate_util.py)
+def estimate(input_file_path: str, calibration: Calibration) -> Estimate:
+    media_file = probe_media_uri(input_file_path)
+    if not media_file or media_file.duration_ms <= 0:
+        logger.error(f"Could not probe {input_file_path}")
+        return Estimate(input_file_path)
+    return estimate_media_file(media_file, calibration)
+
+
+# pipelined mode: shot detection reads the media while it's still being downloaded.
+# Returns no scenedetect provenance if the media could not be processed this way
+def download_and_detect_shots(
+    url: str, run_id: str = ""
+) -> Tuple[Optional[DownloadResult], Optional[StageProvenance]]:
+    output_file = get_http_download_path(url)
+    # other workers sharing the input cache wait until the download is complete
+    with input_cache_lock(output_file):
+        if is_input_available(output_file):
+            return http_download(url), None
+        return _pipelined_download_and_detect_shots(url, output_file, run_id)
+
+
+def _pipelined_download_and_detect_shots(
+    url: str, output_file: str, run_id: str = ""
+) -> Tuple[Optional[DownloadResult], Optional[StageProvenance]]:
+    from pipeline_util import PipelinedDownload, PipelineException
+    import scenedetect_util
+
+    download = PipelinedDownload(url, output_file, get_http_download_settings())
+    download.start()
+    scenedetect_provenance = None
+    if not download.is_streamable():
+        logger.info(
+            "Media container needs seeking (e.g. moov atom at the end), "
+            "waiting for the download to finish"
+        )
+    else:
+        media_file = download.probe()
+        if media_file and split_util.should_split(
+            media_file, cfg.SPLIT.MIN_DURATION_MS
+        ):
+            # its time ranges are detected in parallel, see detect_shots()
+            logger.info("Long asset, detecting shots once downloaded (split)")
+        elif media_file and media_file.has_video:
+            generate_output_dirs(media_file.source_id, run_id=run_id)
+            try:
+                video_stream = download.open_video_stream(media_file)
+                try:
+                    scenedetect_provenance = scenedetect_util.run(
+                        media_file,
+                        get_base_output_dir(media_file.source_id),
+                        cfg.VISXP_PREP.RUN_KEYFRAME_EXTRACTION,
+                        video_stream,
+                    )
+                finally:
+                    video_stream.close()  # stops ffmpeg in case of an error
+                if video_stream.returncode != 0:
+                    logger.warning("Decoding the piped video failed")
+                    scenedetect_provenance = None
+            except (PipelineException, scenedetect_util.ScenedetectFailureException):
+                logger.exception("Failed to detect shots while downloading")
+
+    info = download.wait()
+    if not info:
+        return None, None
+    if not scenedetect_provenance:
+        logger.info("Falling back to shot detection on the downloaded file")
+    return (
+        add_to_input_cache(
+            DownloadResult(
+                output_file,
+                (time() - download.start_time) * 1000,
+                info.mime_type,
+                info.content_length,
+                info.checksum,
+            )
+        ),
+        scenedetect_provenance,
+    )
+
+
 # generates all the required output for the 2nd DANE worker
 def generate_input_for_feature_extraction(
     input_file_path: str,
+    scenedetect_provenance: Optional[StageProvenance] = None,
+    output_upload: Optional[IncrementalOutputUpload] = None,
+    run_id: str = "",  # see generate_output_dirs()
 ) -> VisXPFeatureExtractionInput:
+    # imports OpenCV & scenedetect, so only done once there is work for it
+    import scenedetect_util
+
     logger.info(f"Processing input: {input_file_path}")
 
+    start_time = time()
+    resource_snapshot = take_resource_snapshot()
     media_file = validate_media_file(input_file_path)
     if not media_file:
         return VisXPFeatureExtractionInput(500, "Invalid or missing media file")
+    probe_provenance = StageProvenance(
+        activity_name="Probe VisXP input",
+        activity_description="Read the technical metadata of the media file",
+        start_time_unix=start_time,
+        processing_time_ms=(time() - start_time) * 1000,
+        input_data={"input_file_path": input_file_path},
+        output_data={"media_file": asdict(media_file)},
+        resource_usage=get_resource_usage_since(resource_snapshot),
+    )
 
-    # Step 1: generate output dir per OutputType
-    generate_output_dirs(media_file.source_id)
+    # Step 1: generate output dir per OutputType (in scratch, unless other nodes
+    # help to process the media, see detect_shots())
+    generate_output_dirs(
+        media_file.source_id,
+        not split_util.should_split(media_file, cfg.SPLIT.MIN_DURATION_MS),
+        run_id,
+    )
 
-    scenedetect_provenance = None
     # spectrogram_provenance = None TODO: implement if needed
 
     # scenedetect generates (keyframe) metadata and keyframes
     try:
-        scenedetect_provenance = scenedetect_util.run(
-            media_file,
-            get_base_output_dir(media_file.source_id),
-            cfg.VISXP_PREP.SPECTROGRAM_WINDOW_SIZE_MS,
-        )
+        if scenedetect_provenance:
+            logger.info("Shots were already detected while downloading")
+        elif media_file.has_video:
+            scenedetect_provenance = detect_shots(media_file)
+        else:
+            logger.warning(
+                f"No video stream in {input_file_path}, skipping scenedetect"
+            )
     except scenedetect_util.ScenedetectFailureException:
         return VisXPFeatureExtractionInput(
             500,
@@ -145,11 +308,30 @@ def generate_input_for_feature_extraction(
             [
                 p
                 for p in [
+                    probe_provenance,
                     scenedetect_provenance,
                 ]
                 if p is not None
             ],
         )
+    # drop (or mark) near-duplicate & recurring keyframes, before they are uploaded
+    dedup_provenance = None
+    if (
+        (cfg.VISXP_PREP.KEYFRAME_DEDUP != "none" or cfg.VISXP_PREP.FINGERPRINT_INDEX)
+        and scenedetect_provenance
+        and "keyframe_dir" in (scenedetect_provenance.output_data or {})
+    ):
+        import dedup_util
+
+        dedup_provenance = dedup_util.run(
+            get_base_output_dir(media_file.source_id),
+            media_file.source_id,
+            cfg.VISXP_PREP.KEYFRAME_DEDUP,
+            cfg.VISXP_PREP.KEYFRAME_DEDUP_MAX_DISTANCE,
+            cfg.VISXP_PREP.FINGERPRINT_INDEX,
+        )
+    if output_upload:
+        output_upload.upload([OutputType.METADATA, OutputType.KEYFRAMES])
 
     # TODO: implement this if we want it back
     if cfg.VISXP_PREP.GENERATE_SPECTROGRAM_IMAGES:
@@ -157,7 +339,9 @@ def generate_input_for_feature_extraction(
             "Configured to generate spectrogram images, "
             "which is not implemented in the current version."
         )
-    if cfg.VISXP_PREP.RUN_AUDIO_EXTRACTION:
+    if cfg.VISXP_PREP.RUN_AUDIO_EXTRACTION and not media_file.has_audio:
+        logger.warning(f"No audio stream in {input_file_path}, skipping audio")
+    elif cfg.VISXP_PREP.RUN_AUDIO_EXTRACTION:
         logger.error(
             "Configured to run audio extraction, "
             "which is not implemented in the current version."
@@ -170,7 +354,9 @@ def generate_input_for_feature_extraction(
         [
             p
             for p in [
+                probe_provenance,
                 scenedetect_provenance,
+                dedup_provenance,
                 # spectrogram_provenance, TODO: activate when needed
             ]
             if p is not None
@@ -178,23 +364,51 @@ def generate_input_for_feature_extraction(
     )
 
 
+# long videos are split into time ranges, processed by this and any other process
+# sharing the jobs dir (e.g. other workers' SPLIT.HELPER_PROCESSES)
+def detect_shots(media_file: MediaFile) -> StageProvenance:
+    import scenedetect_util
+
+    output_dir = get_base_output_dir(media_file.source_id)
+    if split_util.should_split(media_file, cfg.SPLIT.MIN_DURATION_MS):
+        return split_util.run(
+            media_file,
+            output_dir,
+            cfg.VISXP_PREP.RUN_KEYFRAME_EXTRACTION,
+            get_split_jobs_dir(),
+            cfg.SPLIT.RANGE_DURATION_MS,
+            cfg.SPLIT.OVERLAP_MS,
+            cfg.SPLIT.CLAIM_TIMEOUT_S,
+        )
+    return scenedetect_util.run(
+        media_file, output_dir, cfg.VISXP_PREP.RUN_KEYFRAME_EXTRACTION
+    )
+
+
 # assesses the output and makes sure input & output is handled properly
 def apply_desired_io_on_output(
     proc_result: VisXPFeatureExtractionInput,
     delete_input_on_completion: bool,
     delete_output_on_completetion: bool,
     transfer_output_on_completion: bool,
+    top_level_provenance: Optional[Provenance] = None,
+    output_upload: Optional[IncrementalOutputUpload] = None,
 ) -> CallbackResponse:
     media_file = proc_result.media_file
     if not media_file:
+        if output_upload:
+            output_upload.abort()
         return {"state": 404, "message": "No media file in processing result"}
     # step 4: raise exception on failure
     if proc_result.state != 200:
         logger.error(f"Could not process the input properly: {proc_result.message}")
+        if output_upload:
+            output_upload.abort()
         input_deleted = delete_input_file(
             media_file.file_path, delete_input_on_completion
         )
         logger.info(f"Deleted input file of failed process: {input_deleted}")
+        discard_scratch_output(media_file.source_id)
         # something went wrong inside the VisXP work processor, return that response here
         return {"state": proc_result.state, "message": proc_result.message}
 
@@ -204,20 +418,39 @@ def apply_desired_io_on_output(
     # step 6: transfer the output to S3 (if configured so)
     transfer_success = True
     if transfer_output_on_completion:
-        transfer_success = transfer_output(media_file.source_id)
+        software_version = (
+            top_level_provenance.software_version if top_level_provenance else None
+        )
+        transfer_provenance = (
+            output_upload.finish(software_version)
+            if output_upload
+            else transfer_output(media_file.source_id, software_version)
+        )
+        transfer_success = transfer_provenance is not None
+        # provenance.json was already uploaded, so this step is only returned
+        if transfer_provenance and top_level_provenance:
+            top_level_provenance.steps = (top_level_provenance.steps or []) + [
+                transfer_provenance
+            ]
 
     if (
         not transfer_success
     ):  # failure of transfer, impedes the workflow, so return error
+        discard_scratch_output(media_file.source_id)  # not to fill up the scratch
         return {
             "state": 500,
             "message": "Failed to transfer output to S3",
         }
 
-    # step 7: clear the output files (if configured so)
+    # step 7: clear the output files (if configured so), or else make sure they
+    # are on the shared output dir (and not just in scratch)
+    start_time = time()
     delete_success = True
+    publish_success = True
     if delete_output_on_completetion:
         delete_success = delete_local_output(media_file.source_id)
+    else:
+        publish_success = publish_output(media_file.source_id)
 
     if (
         not delete_success
@@ -225,7 +458,29 @@ def apply_desired_io_on_output(
         logger.warning(f"Could not delete output files: {visxp_output_dir}")
 
     # step 8: clean the input file (if configured so)
-    if not delete_input_file(media_file.file_path, delete_input_on_completion):
+    input_deleted = delete_input_file(media_file.file_path, delete_input_on_completion)
+    if top_level_provenance:  # like the transfer, only part of the returned chain
+        top_level_provenance.steps = (top_level_provenance.steps or []) + [
+            StageProvenance(
+                activity_name="Clean up VisXP input & output",
+                activity_description="Delete the local input and output",
+                start_time_unix=start_time,
+                processing_time_ms=(time() - start_time) * 1000,
+                input_data={"input_file_path": media_file.file_path},
+                output_data={
+                    "output_deleted": delete_output_on_completetion and delete_success,
+                    "input_handled": input_deleted,  # deleted or left to the cache
+                    "output_published": not delete_output_on_completetion
+                    and publish_success,
+                },
+            )
+        ]
+    if not publish_success:
+        return {
+            "state": 500,
+            "message": "Generated VISXP_PREP output, but could not publish it",
+        }
+    if not input_deleted:
         return {
             "state": 500,
             "message": "Generated VISXP_PREP output, but could not delete the input file",
@@ -0,0 +1,206 @@
+from dataclasses import asdict, dataclass
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+from typing import Dict, List, Optional, Union
+
+from models import OutputType
+
+
+logger = logging.getLogger(__name__)
+# lists every output file of an asset, see finalize_manifest(). It's in the
+# provenance dir, so it's uploaded (and published) with the output
+MANIFEST_FILE = "output_manifest.json"
+# the files recorded by each stage (in any process) until the manifest is finalized
+FRAGMENTS_DIR = ".manifest"
+# in FRAGMENTS_DIR: the ID of the run writing the output, stored in each fragment
+RUN_ID_FILE = "run_id"
+Buffer = Union[bytes, bytearray, memoryview]
+
+
+@dataclass
+class ManifestEntry:
+    path: str  # relative to the asset's output dir, e.g. keyframes/1000.jpg
+    size: int
+    sha256: str
+    stage: str  # the stage that wrote it last
+
+
+class ManifestRecorder:
+    """Records the files a stage writes (or removes) in the asset's output dir, with
+    the size & checksum of the bytes as written. save() stores them as a fragment
+    of the manifest: stages in other processes (e.g. the helpers of a split asset)
+    record their files the same way. The fragments are tagged with the ID of the
+    run (see set_run_id()), so those of an earlier run are left out"""
+
+    def __init__(self, output_dir: str, stage: str, run_id: Optional[str] = None):
+        self.output_dir = output_dir
+        self.stage = stage
+        self.run_id = get_run_id(output_dir) if run_id is None else run_id
+        self._lock = threading.Lock()
+        self._entries: Dict[str, Optional[ManifestEntry]] = {}  # None: removed
+
+    # data: the bytes that were just written to path
+    def add(self, path: str, data: Buffer) -> None:
+        data = memoryview(data)
+        entry = ManifestEntry(
+            path=self._relative_path(path),
+            size=data.nbytes,
+            sha256=hashlib.sha256(data).hexdigest(),
+            stage=self.stage,
+        )
+        with self._lock:
+            self._entries[entry.path] = entry
+
+    # for a file written by a library (e.g. ffmpeg), so it has to be read back
+    def add_file(self, path: str) -> None:
+        with open(path, "rb") as f:
+            self.add(path, f.read())
+
+    def remove(self, path: str) -> None:
+        with self._lock:
+            self._entries[self._relative_path(path)] = None
+
+    # writes the files recorded since the last save() as a new fragment
+    def save(self) -> None:
+        with self._lock:
+            entries, self._entries = self._entries, {}
+        if not entries:
+            return
+        fragments_dir = os.path.join(self.output_dir, FRAGMENTS_DIR)
+        os.makedirs(fragments_dir, exist_ok=True)
+        # named by time, so later fragments (e.g. rewritten files) are applied last
+        fragment_file = os.path.join(
+            fragments_dir,
+            f"{time.time_ns()}-{os.getpid()}-{threading.get_ident()}.json",
+        )
+        _write_json_atomically(
+            fragment_file,
+            {
+                "run_id": self.run_id,
+                "files": {
+                    path: asdict(entry) if entry else None
+                    for path, entry in entries.items()
+                },
+            },
+        )
+
+    def _relative_path(self, path: str) -> str:
+        return os.path.relpath(path, self.output_dir)
+
+
+# writes a small output file (e.g. metadata) and records it, if there's a recorder
+def write_output_file(
+    path: str, data: Buffer, recorder: Optional[ManifestRecorder] = None
+) -> None:
+    with open(path, "wb") as f:
+        f.write(data)
+    if recorder:
+        recorder.add(path, data)
+
+
+# the ID of the run that (now) writes the output to output_dir, set at its start
+def set_run_id(output_dir: str, run_id: str) -> None:
+    fragments_dir = os.path.join(output_dir, FRAGMENTS_DIR)
+    os.makedirs(fragments_dir, exist_ok=True)
+    _write_json_atomically(os.path.join(fragments_dir, RUN_ID_FILE), run_id)
+
+
+def get_run_id(output_dir: str) -> str:
+    try:
+        with open(os.path.join(output_dir, FRAGMENTS_DIR, RUN_ID_FILE)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return ""  # e.g. no run ID was set (stand-alone use of a stage)
+
+
+# merges the fragments into the manifest, once all stages are done. Only those of
+# the run are used (default: the current one), not e.g. those of an earlier run
+# that failed: the hosts writing them may not agree on the time
+def finalize_manifest(output_dir: str, run_id: Optional[str] = None) -> dict:
+    run_id = get_run_id(output_dir) if run_id is None else run_id
+    fragments_dir = os.path.join(output_dir, FRAGMENTS_DIR)
+    files: Dict[str, dict] = {}
+    fragments = (
+        sorted(f for f in os.listdir(fragments_dir) if f.endswith(".json"))
+        if os.path.isdir(fragments_dir)
+        else []
+    )
+    for fragment in fragments:
+        with open(os.path.join(fragments_dir, fragment)) as f:
+            data = json.load(f)
+        if data["run_id"] != run_id:
+            logger.info(f"Skipping {fragment} of run {data['run_id']}")
+            continue
+        for path, entry in data["files"].items():
+            if entry:
+                files[path] = entry
+            else:
+                files.pop(path, None)
+    manifest = {
+        "file_count": len(files),
+        "total_bytes": sum(entry["size"] for entry in files.values()),
+        "files": [files[path] for path in sorted(files)],
+    }
+    _write_json_atomically(get_manifest_path(output_dir), manifest)
+    shutil.rmtree(fragments_dir, ignore_errors=True)
+    logger.info(
+        f"{manifest['file_count']} output files ({manifest['total_bytes']} bytes) in "
+        f"{get_manifest_path(output_dir)}"
+    )
+    return manifest
+
+
+def get_manifest_path(output_dir: str) -> str:
+    return os.path.join(output_dir, OutputType.PROVENANCE.value, MANIFEST_FILE)
+
+
+def read_manifest(output_dir: str) -> Optional[dict]:
+    try:
+        with open(get_manifest_path(output_dir)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+# the files of the manifest that are missing or differ (verify_checksums: reads
+# them all, otherwise only their sizes are checked)
+def verify_manifest(
+    output_dir: str, manifest: dict, verify_checksums: bool = False
+) -> List[str]:
+    invalid = []
+    for entry in manifest["files"]:
+        path = os.path.join(output_dir, entry["path"])
+        try:
+            if os.path.getsize(path) != entry["size"]:
+                invalid.append(entry["path"])
+            elif verify_checksums:
+                with open(path, "rb") as f:
+                    if hashlib.file_digest(f, "sha256").hexdigest() != entry["sha256"]:
+                        invalid.append(entry["path"])
+        except OSError:
+            invalid.append(entry["path"])
+    return invalid
+
+
+# the files of an OutputType (absolute paths), e.g. to archive
+def get_manifest_files(
+    output_dir: str, manifest: dict, output_type: OutputType
+) -> List[str]:
+    prefix = output_type.value + os.sep
+    return [
+        os.path.join(output_dir, entry["path"])
+        for entry in manifest["files"]
+        if entry["path"].startswith(prefix)
+    ]
+
+
+def _write_json_atomically(path: str, data) -> None:
+    tmp_file = f"{path}.tmp-{os.getpid()}-{threading.get_ident()}"
+    with open(tmp_file, "w") as f:
+        json.dump(data, f, indent=4)
+    os.replace(tmp_file, path)
@@ -1,13 +1,18 @@
+from dataclasses import replace
+from fractions import Fraction
+from functools import lru_cache
+import json
 import logging
 import os
+import subprocess
 from typing import Optional
 
-from base_util import run_shell_command
-from io_util import get_source_id
+from io_util import get_presigned_url, get_source_id
 from models import MediaFile
 
 
 logger = logging.getLogger(__name__)
+PROBE_CACHE_SIZE = 32
 
 
 def validate_media_file(media_file_path: str) -> Optional[MediaFile]:
@@ -15,30 +20,139 @@ def validate_media_file(media_file_path: str) -> Optional[MediaFile]:
         logger.error(f"Could not find media file at: {media_file_path}")
         return None
 
-    duration_ms = get_media_file_length(media_file_path)
-    if duration_ms <= 0:
+    media_file = probe_media_file(media_file_path)
+    if not media_file or media_file.duration_ms <= 0:
         logger.error("Not a valid media file")
         return None
-    return MediaFile(media_file_path, get_source_id(media_file_path))
+    if not media_file.has_video and not media_file.has_audio:
+        logger.error("Media file contains neither video nor audio")
+        return None
+    return media_file
 
 
 # returns duration in ms
-def get_media_file_length(media_file: str):
-    result = run_shell_command(
-        " ".join(
-            [
-                "ffprobe",
-                "-v",
-                "error",
-                "-show_entries",
-                "format=duration",
-                "-of",
-                "default=noprint_wrappers=1:nokey=1",
-                media_file,
-            ]
+def get_media_file_length(media_file: str) -> int:
+    probed = probe_media_file(media_file)
+    return probed.duration_ms if probed else -1
+
+
+# single ffprobe pass, cached per file (as long as its size & mtime do not change)
+def probe_media_file(media_file_path: str) -> Optional[MediaFile]:
+    try:
+        stat = os.stat(media_file_path)
+    except OSError:
+        logger.error(f"Could not stat media file: {media_file_path}")
+        return None
+    media_file = _probe_media_file(media_file_path, stat.st_size, stat.st_mtime_ns)
+    return replace(media_file) if media_file else None  # callers get their own copy
+
+
+# like probe_media_file, but also for remote media (HTTP(S) URLs & S3 URIs), of
+# which ffprobe only reads what it needs (e.g. the header), instead of downloading it
+def probe_media_uri(uri: str) -> Optional[MediaFile]:
+    if os.path.exists(uri):
+        return probe_media_file(uri)
+    url = get_presigned_url(uri) if uri.startswith("s3://") else uri
+    probe_data = run_ffprobe(url) if url else None
+    return to_media_file(uri, probe_data) if probe_data else None
+
+
+@lru_cache(maxsize=PROBE_CACHE_SIZE)
+def _probe_media_file(
+    media_file_path: str, file_size: int, mtime_ns: int
+) -> Optional[MediaFile]:
+    probe_data = run_ffprobe(media_file_path)
+    return to_media_file(media_file_path, probe_data) if probe_data else None
+
+
+# media can be a file path or "pipe:0", in which case input_data is fed to ffprobe
+def run_ffprobe(media: str, input_data: Optional[bytes] = None) -> Optional[dict]:
+    cmd = [
+        "ffprobe",
+        "-v",
+        "error",
+        "-print_format",
+        "json",
+        "-show_format",
+        "-show_streams",
+        media,
+    ]
+    logger.info(" ".join(cmd))
+    try:
+        process = subprocess.run(cmd, input=input_data, capture_output=True)
+    except OSError:
+        logger.exception("Could not run ffprobe")
+        return None
+    if process.returncode != 0:
+        logger.error(f"ffprobe failed on {media}: {process.stderr!r}")
+        return None
+    try:
+        return json.loads(process.stdout)
+    except ValueError:
+        logger.exception(f"Could not parse ffprobe output for {media}")
+        return None
+
+
+# converts the output of ffprobe -print_format json -show_format -show_streams
+def to_media_file(media_file_path: str, probe_data: dict) -> MediaFile:
+    streams = probe_data.get("streams", [])
+    video = next(
+        (
+            s
+            for s in streams
+            if s.get("codec_type") == "video"
+            and not s.get("disposition", {}).get("attached_pic")  # e.g. cover art
         ),
+        None,
     )
-    return int(float(result) * 1000)  # NOTE unsafe! (convert secs to ms)
+    audio = next((s for s in streams if s.get("codec_type") == "audio"), None)
+
+    file_format = probe_data.get("format", {})
+    duration_secs = _to_float(file_format.get("duration"))
+    if duration_secs <= 0 and video:
+        duration_secs = _to_float(video.get("duration"))
+    if duration_secs <= 0 and audio:
+        duration_secs = _to_float(audio.get("duration"))
+
+    media_file = MediaFile(
+        media_file_path,
+        get_source_id(media_file_path),
+        duration_ms=int(duration_secs * 1000) if duration_secs > 0 else -1,
+        has_video=video is not None,
+        has_audio=audio is not None,
+        file_size=int(_to_float(file_format.get("size"))),
+    )
+    if video:
+        media_file.video_codec = video.get("codec_name")
+        media_file.width = int(video.get("width", -1))
+        media_file.height = int(video.get("height", -1))
+        media_file.fps = _to_fps(video.get("avg_frame_rate"))
+        if media_file.fps <= 0:
+            media_file.fps = _to_fps(video.get("r_frame_rate"))
+        if "nb_frames" in video:
+            media_file.frame_count = int(video["nb_frames"])
+        elif media_file.fps > 0 and duration_secs > 0:
+            media_file.frame_count = round(duration_secs * media_file.fps)
+    if audio:
+        media_file.audio_codec = audio.get("codec_name")
+        media_file.audio_sample_rate = int(audio.get("sample_rate", -1))
+        media_file.audio_channels = int(audio.get("channels", -1))
+    return media_file
+
+
+def _to_float(value) -> float:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return -1
+
+
+# ffprobe reports frame rates as a fraction, e.g. "30000/1001"
+def _to_fps(frame_rate: Optional[str]) -> float:
+    try:
+        return float(Fraction(frame_rate)) if frame_rate else -1
+    except (ValueError, ZeroDivisionError):
+        return -1
 
 
 def too_close_to_edge(keyframe_ms: int, duration_ms: int, window_size_ms: int):
@@ -0,0 +1,127 @@
+from dataclasses import dataclass, fields
+import io
+import json
+import os
+from typing import List, Optional, Tuple, Union
+
+import numpy as np
+
+from manifest_util import ManifestRecorder, write_output_file
+from models import OutputType, ScenedetectOutput
+
+
+# in the metadata dir, next to (or instead of) the text files of ScenedetectOutput
+SHOTS_FILE = "shots.npz"
+METADATA_FORMATS = ["text", "npz"]  # see cfg.VISXP_PREP.METADATA_FORMATS
+NO_KEYFRAME = -1
+
+
+@dataclass
+class ShotTable:
+    """The shots of an asset as int64 columns, one row per shot (in order). The
+    keyframe columns hold NO_KEYFRAME for shots without a keyframe. A keyframe
+    lies within its shot, so shot_at() maps a keyframe back to its shot"""
+
+    start_ms: np.ndarray
+    end_ms: np.ndarray
+    start_frame: np.ndarray
+    end_frame: np.ndarray
+    keyframe_ms: np.ndarray
+    keyframe_frame: np.ndarray
+    frame_rate: float
+
+    def __len__(self) -> int:
+        return len(self.start_ms)
+
+    # index of the shot [start_ms, end_ms) containing the timestamp (-1: none)
+    def shot_at(self, timestamp_ms: int) -> int:
+        return int(self.shots_at([timestamp_ms])[0])
+
+    # binary search of many timestamps at once
+    def shots_at(self, timestamps_ms: Union[List[int], np.ndarray]) -> np.ndarray:
+        timestamps_ms = np.asarray(timestamps_ms, dtype=np.int64)
+        if not len(self):
+            return np.full(len(timestamps_ms), -1)
+        shots = np.searchsorted(self.start_ms, timestamps_ms, side="right") - 1
+        found = (shots >= 0) & (timestamps_ms < self.end_ms[np.maximum(shots, 0)])
+        return np.where(found, shots, -1)
+
+    # the keyframes (shots can share one, see dedup_util.py), in order
+    def keyframe_timestamps(self) -> List[int]:
+        return np.unique(self.keyframe_ms[self.keyframe_ms != NO_KEYFRAME]).tolist()
+
+    def save(
+        self, shots_file: str, recorder: Optional[ManifestRecorder] = None
+    ) -> None:
+        buffer = io.BytesIO()
+        np.savez(
+            buffer,
+            frame_rate=np.float64(self.frame_rate),
+            **{
+                field.name: getattr(self, field.name)
+                for field in fields(self)
+                if field.name != "frame_rate"
+            },
+        )
+        write_output_file(shots_file, buffer.getbuffer(), recorder)
+
+    @classmethod
+    def load(cls, shots_file: str) -> "ShotTable":
+        with np.load(shots_file) as data:
+            columns = {name: data[name] for name in data.files if name != "frame_rate"}
+            return cls(**columns, frame_rate=float(data["frame_rate"]))
+
+
+# middle frame of the shot [start_frame, end_frame), as scenedetect picks it
+def get_keyframe_frame(start_frame: int, end_frame: int) -> int:
+    return start_frame + max(1, end_frame - start_frame) // 2
+
+
+# same rounding as the text files: int(FrameTimecode.get_seconds() * 1000)
+def frames_to_ms(frames: np.ndarray, frame_rate: float) -> np.ndarray:
+    return (frames.astype(np.float64) / frame_rate * 1000).astype(np.int64)
+
+
+# shots: [start_frame, end_frame) pairs. keyframe_timestamps: those of the keyframes
+# that were saved (None: keyframes were not extracted)
+def to_shot_table(
+    shots: List[Tuple[int, int]],
+    frame_rate: float,
+    keyframe_timestamps: Optional[List[int]],
+) -> ShotTable:
+    frames = np.array(shots, dtype=np.int64).reshape(-1, 2)
+    keyframe_frame = np.array(
+        [get_keyframe_frame(start, end) for start, end in shots], dtype=np.int64
+    )
+    keyframe_ms = frames_to_ms(keyframe_frame, frame_rate)
+    saved = np.isin(keyframe_ms, keyframe_timestamps or [])
+    return ShotTable(
+        start_ms=frames_to_ms(frames[:, 0], frame_rate),
+        end_ms=frames_to_ms(frames[:, 1], frame_rate),
+        start_frame=frames[:, 0],
+        end_frame=frames[:, 1],
+        keyframe_ms=np.where(saved, keyframe_ms, NO_KEYFRAME),
+        keyframe_frame=np.where(saved, keyframe_frame, NO_KEYFRAME),
+        frame_rate=frame_rate,
+    )
+
+
+def get_shots_file(output_dir: str) -> str:
+    return os.path.join(output_dir, OutputType.METADATA.value, SHOTS_FILE)
+
+
+def read_shot_table(output_dir: str) -> ShotTable:
+    return ShotTable.load(get_shots_file(output_dir))
+
+
+# from either format, whichever was written
+def read_keyframe_timestamps(output_dir: str) -> List[int]:
+    text_file = os.path.join(
+        output_dir,
+        OutputType.METADATA.value,
+        ScenedetectOutput.KEYFRAME_TIMESTAMPS.value,
+    )
+    if os.path.exists(text_file):
+        with open(text_file) as f:
+            return json.load(f)
+    return read_shot_table(output_dir).keyframe_timestamps()
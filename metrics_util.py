@@ -0,0 +1,203 @@
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import logging
+import threading
+from typing import Dict, List, Optional, Tuple
+
+from dane.provenance import Provenance
+
+
+logger = logging.getLogger(__name__)
+PREFIX = "visxp_prep"
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"  # Prometheus text format
+DURATION_BUCKETS_S = [0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600]
+# the provenance steps that are measured per stage
+STAGES = {
+    "Download VisXP input": "download",
+    "Probe VisXP input": "probe",
+    "Python Scenedetect": "scenedetect",
+    "Keyframe deduplication": "dedup",
+    "Spectrogram extraction": "spectrogram",
+    "Transfer VisXP output": "transfer",
+    "Clean up VisXP input & output": "cleanup",
+}
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class Metric:
+    """Minimal (thread-safe) Prometheus metric: a value per combination of labels"""
+
+    TYPE = ""
+
+    def __init__(self, name: str, description: str, labeled: bool = False):
+        self.name = f"{PREFIX}_{name}"
+        self.description = description
+        self._values: Dict[Labels, float] = {} if labeled else {(): 0}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels: str) -> float:
+        with self._lock:
+            return self._values.get(tuple(sorted(labels.items())), 0)
+
+    def render(self) -> List[str]:
+        lines = [
+            f"# HELP {self.name} {self.description}",
+            f"# TYPE {self.name} {self.TYPE}",
+        ]
+        with self._lock:
+            lines += [
+                f"{self.name}{_format_labels(key)} {value}"
+                for key, value in sorted(self._values.items())
+            ]
+        return lines
+
+
+class Counter(Metric):
+    TYPE = "counter"
+
+
+class Gauge(Metric):
+    TYPE = "gauge"
+
+    def dec(self, amount: float = 1, **labels: str) -> None:
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    TYPE = "histogram"
+
+    def __init__(self, name: str, description: str, buckets: List[float]):
+        super().__init__(name, description, labeled=True)
+        self.buckets = buckets
+        # per combination of labels: the count per bucket (the last one is +Inf)
+        self._bucket_counts: Dict[Labels, List[int]] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            counts = self._bucket_counts.setdefault(key, [0] * (len(self.buckets) + 1))
+            counts[bisect_left(self.buckets, value)] += 1
+            self._values[key] = self._values.get(key, 0) + value  # the sum
+
+    def get_count(self, **labels: str) -> int:
+        with self._lock:
+            return sum(self._bucket_counts.get(tuple(sorted(labels.items())), []))
+
+    def render(self) -> List[str]:
+        lines = [
+            f"# HELP {self.name} {self.description}",
+            f"# TYPE {self.name} {self.TYPE}",
+        ]
+        with self._lock:
+            for key, counts in sorted(self._bucket_counts.items()):
+                total = 0
+                for bound, count in zip(self.buckets + [float("inf")], counts):
+                    total += count
+                    le = "+Inf" if bound == float("inf") else str(bound)
+                    labels = _format_labels(key + (("le", le),))
+                    lines.append(f"{self.name}_bucket{labels} {total}")
+                lines.append(
+                    f"{self.name}_sum{_format_labels(key)} {self._values[key]}"
+                )
+                lines.append(f"{self.name}_count{_format_labels(key)} {total}")
+        return lines
+
+
+STAGE_DURATION = Histogram(
+    "stage_duration_seconds", "Duration of each processing stage", DURATION_BUCKETS_S
+)
+MEDIA_SECONDS = Counter("media_seconds_total", "Duration of the processed media")
+FRAMES_DECODED = Counter("frames_decoded_total", "Video frames decoded")
+KEYFRAMES = Counter("keyframes_total", "Keyframes written")
+SPECTROGRAMS = Counter("spectrograms_total", "Spectrograms written")
+UPLOADED_BYTES = Counter("uploaded_bytes_total", "Bytes uploaded to S3")
+TASKS = Counter("tasks_total", "Finished tasks, per state", labeled=True)
+TASK_ERRORS = Counter("task_errors_total", "Tasks that failed")
+TASKS_IN_FLIGHT = Gauge("tasks_in_flight", "Tasks being processed")
+METRICS: List[Metric] = [
+    STAGE_DURATION,
+    MEDIA_SECONDS,
+    FRAMES_DECODED,
+    KEYFRAMES,
+    SPECTROGRAMS,
+    UPLOADED_BYTES,
+    TASKS,
+    TASK_ERRORS,
+    TASKS_IN_FLIGHT,
+]
+
+
+def render_metrics() -> str:
+    return "\n".join(line for metric in METRICS for line in metric.render()) + "\n"
+
+
+# updates the metrics with a finished task (result None: the task raised an error).
+# Uses the provenance, since it is returned even by tasks run in other processes
+def record_task(
+    result: Optional[dict], provenance: Optional[Provenance] = None
+) -> None:
+    state = str(result.get("state", 500)) if result else "error"
+    TASKS.inc(state=state)
+    if state != "200":
+        TASK_ERRORS.inc()
+    for step in (provenance.steps or []) if provenance else []:
+        stage = STAGES.get(step.activity_name)
+        if stage and step.processing_time_ms is not None:
+            STAGE_DURATION.observe(step.processing_time_ms / 1000, stage=stage)
+        output_data = step.output_data or {}
+        if stage == "probe":
+            duration_ms = output_data.get("media_file", {}).get("duration_ms", 0)
+            MEDIA_SECONDS.inc(max(duration_ms, 0) / 1000)
+        elif stage == "scenedetect":
+            FRAMES_DECODED.inc(output_data.get("frames_decoded", 0))
+            KEYFRAMES.inc(output_data.get("keyframe_count", 0))
+        elif stage == "spectrogram":
+            SPECTROGRAMS.inc(output_data.get("spectrogram_count", 0))
+        elif stage == "transfer":
+            UPLOADED_BYTES.inc(
+                sum(
+                    archive.get("compressed_bytes", 0)
+                    for archive in output_data.get("archives", {}).values()
+                )
+            )
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = render_metrics().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):  # scraping is not worth a log line
+        pass
+
+
+# serves GET /metrics in a daemon thread
+def start_metrics_server(port: int, host: str = "") -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer((host, port), MetricsRequestHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logger.info(f"Serving metrics on port {server.server_address[1]}")
+    return server
+
+
+def _format_labels(labels: Labels) -> str:
+    if not labels:
+        return ""
+    escaped = [
+        (name, value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for name, value in labels
+    ]
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
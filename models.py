@@ -1,5 +1,5 @@
 from dane.provenance import Provenance
-from dataclasses import dataclass
+from dataclasses import asdict, dataclass
 from enum import Enum
 from typing import List, Optional, TypedDict
 
@@ -19,10 +19,71 @@ class ScenedetectOutput(Enum):
     SHOT_BOUNDARIES = "shot_boundaries_timestamps_ms.txt"
 
 
+# NOTE: the technical metadata is filled by media_file_util.probe_media_file()
 @dataclass
 class MediaFile:
     file_path: str  # file location
     source_id: str  # serves as a unique processing ID
+    duration_ms: int = -1
+    fps: float = -1
+    frame_count: int = -1
+    width: int = -1
+    height: int = -1
+    video_codec: Optional[str] = None
+    audio_codec: Optional[str] = None
+    audio_sample_rate: int = -1  # in Hz
+    audio_channels: int = -1
+    has_video: bool = True  # assumed until probed
+    has_audio: bool = True  # assumed until probed
+    file_size: int = -1  # in bytes
+
+
+# resources consumed by a single processing step (see resource_util.py)
+@dataclass
+class ResourceUsage:
+    cpu_user_time_ms: float
+    cpu_system_time_ms: float
+    children_cpu_user_time_ms: float  # e.g. ffmpeg/ffprobe subprocesses
+    children_cpu_system_time_ms: float
+    peak_rss_kb: int  # high water mark of the worker process
+    peak_rss_delta_kb: int  # how much this step raised the high water mark
+    children_peak_rss_kb: int  # largest child process so far
+    read_bytes: int = -1  # all reads (incl. sockets & pipes), -1 if not available
+    write_bytes: int = -1  # all writes (incl. sockets & pipes)
+    storage_read_bytes: int = -1  # reads that actually hit the storage layer
+    storage_write_bytes: int = -1
+    children_read_blocks: int = 0  # block I/O of child processes (512 byte blocks)
+    children_write_blocks: int = 0
+
+
+# Provenance step that also accounts for the resources used while processing
+@dataclass
+class StageProvenance(Provenance):
+    resource_usage: Optional[ResourceUsage] = None
+
+    def to_json(self):
+        return {
+            **super().to_json(),
+            "resource_usage": (
+                asdict(self.resource_usage) if self.resource_usage else None
+            ),
+        }
+
+    # e.g. for a step that ran in another process (without its own steps)
+    @classmethod
+    def from_json(cls, data: dict) -> "StageProvenance":
+        resource_usage = data.get("resource_usage")
+        return cls(
+            activity_name=data["activity_name"],
+            activity_description=data["activity_description"],
+            input_data=data["input_data"],
+            start_time_unix=data["start_time_unix"],
+            parameters=data.get("parameters", {}),
+            software_version=data.get("software_version", {}),
+            output_data=data.get("output_data"),
+            processing_time_ms=data.get("processing_time_ms", -1),
+            resource_usage=ResourceUsage(**resource_usage) if resource_usage else None,
+        )
 
 
 # returned by callback()
@@ -38,6 +99,8 @@ class DownloadResult:
     download_time: float = -1  # time (secs) taken to receive data after request
     mime_type: str = "unknown"  # download_data.get("mime_type", "unknown"),
     content_length: int = -1  # download_data.get("content_length", -1),
+    checksum: str = ""  # sha256 hex digest, computed while downloading
+    cache_hit: Optional[bool] = None  # None: input cache not used
 
 
 @dataclass
@@ -0,0 +1,324 @@
+import logging
+import os
+import struct
+import subprocess
+import threading
+from time import time
+from typing import IO, Iterator, List, Optional, Union
+
+import numpy as np
+from scenedetect.frame_timecode import FrameTimecode  # type: ignore
+from scenedetect.video_stream import SeekError, VideoStream  # type: ignore
+
+from cpu_util import get_ffmpeg_thread_args
+from http_util import (
+    HttpDownloadInfo,
+    HttpDownloadSettings,
+    PARTIAL_DOWNLOAD_SUFFIX,
+    download_file,
+)
+from media_file_util import run_ffprobe, to_media_file
+from models import MediaFile
+
+"""
+Process while downloading: a background thread streams the download into <file>.part
+(see http_util.download_file), while the analysers read the same bytes from disk as the
+file grows (GrowingFileReader) and pipe them into ffmpeg.
+
+Only containers that can be demuxed front to back are processed this way. An MP4/MOV
+with its moov atom at the end (i.e. not "faststart") needs seeking, so for those the
+caller should wait for the download to finish and use the regular flow instead.
+"""
+
+logger = logging.getLogger(__name__)
+POLL_INTERVAL_S = 0.2  # how often to check the growing file for new data
+READ_CHUNK_SIZE = 1024 * 1024
+PROBE_HEAD_BYTES = 4 * 1024 * 1024  # partial data handed to ffprobe
+ISO_BMFF_BOX_TYPES = {b"ftyp", b"styp", b"moov", b"mdat", b"free", b"skip", b"wide"}
+
+
+class PipelineException(Exception):
+    pass
+
+
+# returns True/False when it's clear if the container can be read sequentially,
+# None if more data is needed to tell
+def is_streamable_container(head: bytes) -> Optional[bool]:
+    if len(head) < 8:
+        return None
+    if head[4:8] not in ISO_BMFF_BOX_TYPES:
+        return True  # not MP4/MOV: e.g. MPEG-TS or Matroska are demuxed sequentially
+    offset = 0
+    while offset + 8 <= len(head):
+        box_size, box_type = struct.unpack(">I4s", head[offset : offset + 8])
+        if box_type == b"moov":
+            return True
+        if box_type == b"mdat":
+            return False  # media data before the moov atom: seeking required
+        if box_size == 1:  # 64-bit box size follows the type
+            if offset + 16 > len(head):
+                return None
+            box_size = struct.unpack(">Q", head[offset + 8 : offset + 16])[0]
+        elif box_size == 0:  # box runs until the end of the file
+            return False
+        if box_size < 8:
+            return False  # corrupt, let the regular flow deal with it
+        offset += box_size
+    return None
+
+
+# iterates over the bytes of a file that is still being written, until finished is set
+class GrowingFileReader:
+    def __init__(
+        self,
+        file_paths: List[str],  # the file may be renamed (e.g. .part -> final name)
+        finished: threading.Event,
+        chunk_size: int = READ_CHUNK_SIZE,
+        offset: int = 0,
+    ):
+        self.file_paths = file_paths
+        self.finished = finished
+        self.chunk_size = chunk_size
+        self.offset = offset
+
+    def __iter__(self) -> Iterator[bytes]:
+        f = self._open()
+        if f is None:
+            return
+        with f:
+            f.seek(self.offset)
+            while True:
+                chunk = f.read(self.chunk_size)
+                if chunk:
+                    self.offset += len(chunk)
+                    yield chunk
+                elif self.finished.is_set():
+                    chunk = f.read()  # written right before finishing
+                    if not chunk:
+                        return
+                    self.offset += len(chunk)
+                    yield chunk
+                else:
+                    self.finished.wait(POLL_INTERVAL_S)
+
+    def _open(self) -> Optional[IO[bytes]]:
+        while True:
+            for file_path in self.file_paths:
+                try:
+                    return open(file_path, "rb")
+                except FileNotFoundError:
+                    continue
+            if self.finished.is_set():
+                return None
+            self.finished.wait(POLL_INTERVAL_S)
+
+
+class PipelinedDownload:
+    def __init__(
+        self,
+        url: str,
+        output_file: str,
+        settings: Optional[HttpDownloadSettings] = None,
+    ):
+        self.url = url
+        self.output_file = output_file
+        self.part_file = output_file + PARTIAL_DOWNLOAD_SUFFIX
+        self.settings = settings or HttpDownloadSettings()
+        # parallel ranges are written out of order, readers would run into gaps
+        self.settings.parallel_connections = 1
+        self.finished = threading.Event()
+        self.info: Optional[HttpDownloadInfo] = None
+        self.start_time = -1.0
+        self._thread = threading.Thread(target=self._download, daemon=True)
+
+    def start(self) -> "PipelinedDownload":
+        logger.info(f"Starting pipelined download of {self.url}")
+        self.start_time = time()
+        # a leftover .part file is resumed, but first overwritten if the server
+        # ignores the Range header, which readers cannot cope with
+        if os.path.exists(self.part_file):
+            os.remove(self.part_file)
+        self._thread.start()
+        return self
+
+    def _download(self) -> None:
+        try:
+            self.info = download_file(self.url, self.output_file, self.settings)
+        except Exception:
+            logger.exception(f"Pipelined download of {self.url} failed")
+        finally:
+            self.finished.set()
+
+    # blocks until the download is done, returns None if it failed
+    def wait(self) -> Optional[HttpDownloadInfo]:
+        self._thread.join()
+        return self.info
+
+    def reader(self) -> GrowingFileReader:
+        return GrowingFileReader(
+            [self.part_file, self.output_file], self.finished, self.settings.chunk_size
+        )
+
+    # returns the first n bytes (or less if the download ended before that)
+    def read_head(self, n: int) -> bytes:
+        head = bytearray()
+        for chunk in self.reader():
+            head += chunk
+            if len(head) >= n:
+                break
+        return bytes(head[:n])
+
+    # True if the analysers can start before the download finishes
+    def is_streamable(self) -> bool:
+        head_size = 64 * 1024
+        while True:
+            head = self.read_head(head_size)
+            streamable = is_streamable_container(head)
+            if streamable is not None:
+                return streamable
+            if len(head) < head_size:  # download ended (or failed)
+                return False
+            head_size *= 4  # the moov box can be quite large, read further
+
+    # probes the part of the file that has already been downloaded
+    def probe(self) -> Optional[MediaFile]:
+        probe_data = run_ffprobe("pipe:0", self.read_head(PROBE_HEAD_BYTES))
+        return to_media_file(self.output_file, probe_data) if probe_data else None
+
+    def open_video_stream(self, media_file: MediaFile) -> "FfmpegPipeVideoStream":
+        return FfmpegPipeVideoStream(self.reader(), media_file)
+
+
+# scenedetect VideoStream decoding the frames that ffmpeg reads from a GrowingFileReader
+class FfmpegPipeVideoStream(VideoStream):
+    BACKEND_NAME = "ffmpeg_pipe"
+
+    def __init__(self, reader: GrowingFileReader, media_file: MediaFile):
+        super().__init__()
+        if media_file.fps <= 0 or media_file.width <= 0 or media_file.height <= 0:
+            raise PipelineException(f"Frame rate/size unknown for {media_file}")
+        self._media_file = media_file
+        self._frame_number = 0
+        self._frame: Optional[np.ndarray] = None
+        self._frame_bytes = media_file.width * media_file.height * 3
+        self._process = subprocess.Popen(
+            [
+                "ffmpeg",
+                "-v",
+                "error",
+                *get_ffmpeg_thread_args(),
+                "-i",
+                "pipe:0",
+                "-map",
+                "0:v:0",
+                "-fps_mode",
+                "passthrough",  # one output frame per decoded frame, like OpenCV
+                "-vf",
+                f"scale={media_file.width}:{media_file.height}",
+                "-pix_fmt",
+                "bgr24",
+                "-f",
+                "rawvideo",
+                "pipe:1",
+            ],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+        self._feeder = threading.Thread(target=self._feed, args=(reader,), daemon=True)
+        self._feeder.start()
+
+    def _feed(self, reader: GrowingFileReader) -> None:
+        assert self._process.stdin
+        try:
+            for chunk in reader:
+                self._process.stdin.write(chunk)
+        except BrokenPipeError:
+            logger.warning("ffmpeg stopped reading the input stream")
+        finally:
+            try:
+                self._process.stdin.close()
+            except BrokenPipeError:
+                pass
+
+    # exit code of ffmpeg, None while it's still running
+    @property
+    def returncode(self) -> Optional[int]:
+        return self._process.returncode
+
+    def close(self) -> None:
+        if self._process.poll() is None:
+            self._process.kill()
+        self._process.wait()
+        self._feeder.join()
+        assert self._process.stderr
+        stderr = self._process.stderr.read()
+        if stderr:
+            logger.warning(f"ffmpeg: {stderr!r}")
+
+    @property
+    def path(self) -> str:
+        return self._media_file.file_path
+
+    @property
+    def name(self) -> str:
+        return self._media_file.source_id
+
+    @property
+    def is_seekable(self) -> bool:
+        return False
+
+    @property
+    def frame_rate(self) -> float:
+        return self._media_file.fps
+
+    @property
+    def duration(self) -> Optional[FrameTimecode]:
+        if self._media_file.frame_count <= 0:
+            return None
+        return self.base_timecode + self._media_file.frame_count
+
+    @property
+    def frame_size(self):
+        return (self._media_file.width, self._media_file.height)
+
+    @property
+    def aspect_ratio(self) -> float:
+        return 1.0
+
+    @property
+    def position(self) -> FrameTimecode:
+        if self._frame_number < 1:
+            return self.base_timecode
+        return self.base_timecode + (self._frame_number - 1)
+
+    @property
+    def position_ms(self) -> float:
+        return max(0, self._frame_number - 1) * 1000 / self.frame_rate
+
+    @property
+    def frame_number(self) -> int:
+        return self._frame_number
+
+    def read(
+        self, decode: bool = True, advance: bool = True
+    ) -> Union[np.ndarray, bool]:
+        if advance:
+            assert self._process.stdout
+            data = self._process.stdout.read(self._frame_bytes)
+            if len(data) < self._frame_bytes:
+                self.close()
+                return False
+            self._frame = np.frombuffer(data, np.uint8).reshape(
+                (self._media_file.height, self._media_file.width, 3)
+            )
+            self._frame_number += 1
+        if self._frame is None:
+            return False
+        return self._frame if decode else True
+
+    def reset(self) -> None:
+        raise SeekError("Cannot reset a piped video stream")
+
+    def seek(self, target: Union[FrameTimecode, float, int]) -> None:
+        raise SeekError("Cannot seek in a piped video stream")
@@ -0,0 +1,232 @@
+from concurrent.futures import Future
+import importlib
+import logging
+import multiprocessing
+from multiprocessing.connection import Connection
+from multiprocessing.process import BaseProcess
+import pickle
+import queue
+import threading
+from time import time
+import traceback
+from typing import Callable, Dict, List, Optional, Tuple
+
+from resource_util import get_current_rss_bytes
+
+
+logger = logging.getLogger(__name__)
+
+
+class TaskProcessDied(Exception):
+    pass
+
+
+class WarmProcessPool:
+    """Runs each task in a child process that was started (and imported the heavy
+    modules) before the task arrived. A child is replaced by a fresh one after
+    max_tasks_per_process tasks, when its RSS exceeds max_rss_bytes after a task,
+    or when it dies; a crashing task only fails its own Future.
+    Children are spawned, since forking a process with running threads is unsafe"""
+
+    def __init__(
+        self,
+        size: int,
+        preload_modules: List[str],
+        max_tasks_per_process: int = 0,  # 0: unlimited
+        max_rss_bytes: int = 0,  # 0: unlimited
+        initializer: Optional[Callable] = None,
+        initargs: Tuple = (),
+    ):
+        self.preload_modules = preload_modules
+        self.max_tasks_per_process = max_tasks_per_process
+        self.max_rss_bytes = max_rss_bytes
+        self.initializer = initializer
+        self.initargs = initargs
+        self.created_at = time()
+        self._context = multiprocessing.get_context("spawn")
+        self._tasks: queue.Queue = queue.Queue()
+        self._shutdown = False
+        self._stats_lock = threading.Lock()
+        self._stats: Dict = {
+            "processes_started": 0,
+            "processes_recycled": 0,
+            "processes_died": 0,
+            "tasks_completed": 0,
+            "warmup_s": [],  # time from spawning a child until it is ready
+            "first_task_latency_s": -1,  # from creating the pool to the 1st task start
+            "rss_bytes": {},  # RSS of each live child after its last task
+        }
+        # one thread per slot feeds tasks to (and restarts) its child process
+        self._slots = [
+            threading.Thread(target=self._run_slot, name=f"warm-process-{i}")
+            for i in range(size)
+        ]
+        for slot in self._slots:
+            slot.daemon = True
+            slot.start()
+
+    def submit(self, fn: Callable, *args) -> Future:
+        if self._shutdown:
+            raise RuntimeError("Cannot submit tasks after shutdown")
+        future: Future = Future()
+        self._tasks.put((future, fn, args))
+        return future
+
+    def shutdown(self, wait: bool = True, cancel_futures: bool = False) -> None:
+        self._shutdown = True
+        if cancel_futures:
+            while True:
+                try:
+                    item = self._tasks.get_nowait()
+                except queue.Empty:
+                    break
+                if item:
+                    item[0].cancel()
+        for _ in self._slots:
+            self._tasks.put(None)  # stops a slot after its current task
+        if wait:
+            for slot in self._slots:
+                slot.join()
+
+    def get_stats(self) -> Dict:
+        with self._stats_lock:
+            return {
+                **self._stats,
+                "warmup_s": list(self._stats["warmup_s"]),
+                "rss_bytes": dict(self._stats["rss_bytes"]),
+            }
+
+    def _run_slot(self) -> None:
+        process, conn = self._start_process()
+        tasks_done = 0
+        while True:
+            item = self._tasks.get()
+            if item is None:
+                break
+            future, fn, args = item
+            if not future.set_running_or_notify_cancel():
+                continue
+            if process is None:  # the last start failed, try again
+                process, conn = self._start_process()
+                if process is None:
+                    future.set_exception(TaskProcessDied("Could not start a process"))
+                    continue
+            with self._stats_lock:
+                if self._stats["first_task_latency_s"] < 0:
+                    self._stats["first_task_latency_s"] = time() - self.created_at
+            try:
+                assert conn
+                conn.send((fn, args))
+                ok, value, rss_bytes = conn.recv()
+            except (EOFError, OSError):
+                process.join()
+                logger.error(f"Task process {process.pid} died ({process.exitcode})")
+                future.set_exception(
+                    TaskProcessDied(f"Process died with exit code {process.exitcode}")
+                )
+                self._update_stats(process, processes_died=1)
+                process, conn = self._start_process()
+                tasks_done = 0
+                continue
+            tasks_done += 1
+            self._update_stats(process, tasks_completed=1, rss_bytes=rss_bytes)
+            if ok:
+                future.set_result(value)
+            else:
+                future.set_exception(value)
+
+            if self._must_recycle(tasks_done, rss_bytes):
+                logger.info(
+                    f"Recycling task process {process.pid} after {tasks_done} "
+                    f"tasks (RSS: {rss_bytes} bytes)"
+                )
+                self._stop_process(process, conn)
+                self._update_stats(process, processes_recycled=1)
+                process, conn = self._start_process()
+                tasks_done = 0
+        if process:
+            self._stop_process(process, conn)
+            self._update_stats(process)
+
+    def _must_recycle(self, tasks_done: int, rss_bytes: int) -> bool:
+        return (
+            0 < self.max_tasks_per_process <= tasks_done
+            or 0 < self.max_rss_bytes < rss_bytes
+        )
+
+    def _start_process(
+        self,
+    ) -> Tuple[Optional[BaseProcess], Optional[Connection]]:
+        start_time = time()
+        conn, child_conn = self._context.Pipe()
+        process = self._context.Process(
+            target=_run_task_process,
+            args=(child_conn, self.preload_modules, self.initializer, self.initargs),
+            daemon=True,
+        )
+        process.start()
+        child_conn.close()
+        try:
+            conn.recv()  # sent once the modules are imported
+        except (EOFError, OSError):
+            process.join()
+            logger.error(f"Task process failed to start ({process.exitcode})")
+            return None, None
+        warmup_s = time() - start_time
+        logger.info(f"Task process {process.pid} ready in {warmup_s:.2f}s")
+        with self._stats_lock:
+            self._stats["processes_started"] += 1
+            self._stats["warmup_s"].append(warmup_s)
+        return process, conn
+
+    def _stop_process(self, process: BaseProcess, conn: Optional[Connection]):
+        try:
+            assert conn
+            conn.send(None)
+        except (AssertionError, OSError):
+            pass
+        process.join(timeout=10)
+        if process.is_alive():
+            process.kill()
+            process.join()
+
+    def _update_stats(self, process: BaseProcess, rss_bytes: int = -1, **counts):
+        with self._stats_lock:
+            for name, count in counts.items():
+                self._stats[name] += count
+            if rss_bytes >= 0 and process.is_alive():
+                self._stats["rss_bytes"][process.pid] = rss_bytes
+            else:
+                self._stats["rss_bytes"].pop(process.pid, None)
+
+
+# main loop of a child process: imports the heavy modules, then runs tasks until
+# receiving None (or the parent closing the pipe)
+def _run_task_process(
+    conn: Connection,
+    preload_modules: List[str],
+    initializer: Optional[Callable],
+    initargs: Tuple,
+) -> None:
+    if initializer:
+        initializer(*initargs)
+    for module in preload_modules:
+        importlib.import_module(module)
+    conn.send("ready")
+    while True:
+        try:
+            task = conn.recv()
+        except EOFError:
+            break
+        if task is None:
+            break
+        fn, args = task
+        try:
+            result = (True, fn(*args))
+        except Exception as e:
+            result = (False, e)
+        try:
+            conn.send((*result, get_current_rss_bytes()))
+        except (pickle.PicklingError, TypeError, AttributeError):
+            error = RuntimeError(f"Unpicklable task result: {traceback.format_exc()}")
+            conn.send((False, error, get_current_rss_bytes()))
@@ -0,0 +1,95 @@
+import logging
+import resource
+from dataclasses import dataclass
+from time import time
+from typing import Dict
+
+from models import ResourceUsage
+
+
+logger = logging.getLogger(__name__)
+PROC_SELF_IO = "/proc/self/io"  # only available on Linux
+PROC_SELF_STATM = "/proc/self/statm"
+
+
+# point-in-time view of the resources consumed by this process (and its finished children)
+@dataclass
+class ResourceSnapshot:
+    wall_time: float  # unix time in secs
+    self_usage: resource.struct_rusage
+    children_usage: resource.struct_rusage
+    io_counters: Dict[str, int]
+
+
+def take_resource_snapshot() -> ResourceSnapshot:
+    return ResourceSnapshot(
+        wall_time=time(),
+        self_usage=resource.getrusage(resource.RUSAGE_SELF),
+        children_usage=resource.getrusage(resource.RUSAGE_CHILDREN),
+        io_counters=_read_io_counters(),
+    )
+
+
+# NOTE: getrusage() is process wide, so concurrent stages in other threads are included.
+# Child process (ffmpeg/ffprobe) usage is only counted after the child has been waited for
+def get_resource_usage_since(snapshot: ResourceSnapshot) -> ResourceUsage:
+    now = take_resource_snapshot()
+    return ResourceUsage(
+        cpu_user_time_ms=_ms(now.self_usage.ru_utime - snapshot.self_usage.ru_utime),
+        cpu_system_time_ms=_ms(now.self_usage.ru_stime - snapshot.self_usage.ru_stime),
+        children_cpu_user_time_ms=_ms(
+            now.children_usage.ru_utime - snapshot.children_usage.ru_utime
+        ),
+        children_cpu_system_time_ms=_ms(
+            now.children_usage.ru_stime - snapshot.children_usage.ru_stime
+        ),
+        peak_rss_kb=now.self_usage.ru_maxrss,  # NOTE: in kilobytes on Linux
+        peak_rss_delta_kb=now.self_usage.ru_maxrss - snapshot.self_usage.ru_maxrss,
+        children_peak_rss_kb=now.children_usage.ru_maxrss,
+        read_bytes=_io_delta(snapshot.io_counters, now.io_counters, "rchar"),
+        write_bytes=_io_delta(snapshot.io_counters, now.io_counters, "wchar"),
+        storage_read_bytes=_io_delta(
+            snapshot.io_counters, now.io_counters, "read_bytes"
+        ),
+        storage_write_bytes=_io_delta(
+            snapshot.io_counters, now.io_counters, "write_bytes"
+        ),
+        children_read_blocks=(
+            now.children_usage.ru_inblock - snapshot.children_usage.ru_inblock
+        ),
+        children_write_blocks=(
+            now.children_usage.ru_oublock - snapshot.children_usage.ru_oublock
+        ),
+    )
+
+
+# current (not peak) resident set size, falls back to the peak if /proc is unavailable
+def get_current_rss_bytes() -> int:
+    try:
+        with open(PROC_SELF_STATM, "r") as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except (OSError, ValueError, IndexError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+# see https://www.kernel.org/doc/html/latest/filesystems/proc.html#proc-pid-io-display-the-io-accounting-fields
+def _read_io_counters() -> Dict[str, int]:
+    try:
+        with open(PROC_SELF_IO, "r") as f:
+            return {
+                k.strip(): int(v)
+                for k, v in (line.split(":", 1) for line in f if ":" in line)
+            }
+    except (OSError, ValueError):
+        logger.debug(f"Could not read I/O counters from {PROC_SELF_IO}")
+        return {}
+
+
+def _io_delta(before: Dict[str, int], after: Dict[str, int], key: str) -> int:
+    if key not in before or key not in after:
+        return -1  # not available on this platform
+    return after[key] - before[key]
+
+
+def _ms(secs: float) -> float:
+    return round(secs * 1000, 3)
@@ -0,0 +1,213 @@
+from concurrent.futures import Future, ThreadPoolExecutor
+import io
+import logging
+import tarfile
+import threading
+from typing import TYPE_CHECKING, Dict, List, Optional
+
+from botocore.exceptions import BotoCoreError, ClientError
+
+from archive_util import ArchiveStats, Compression, write_archive
+
+if TYPE_CHECKING:  # boto3 takes long to import, so only do so on first use
+    from boto3.s3.transfer import TransferConfig
+
+
+logger = logging.getLogger(__name__)
+MIN_PART_SIZE = 5 * 1024 * 1024  # S3 minimum for all parts but the last one
+
+_s3_clients: Dict[Optional[str], "PooledS3Client"] = {}  # per endpoint URL
+_s3_clients_lock = threading.Lock()
+
+
+class PooledS3Client:
+    """One boto3 S3 client (thread-safe, with its own connection pool) per worker
+    process, shared by all downloads and uploads; see get_pooled_s3_client()"""
+
+    def __init__(self, endpoint_url: Optional[str], max_pool_connections: int):
+        import boto3
+        from botocore.config import Config
+
+        # boto3's default session is not thread-safe, so use a dedicated one
+        self.client = boto3.session.Session().client(
+            "s3",
+            endpoint_url=endpoint_url,
+            config=Config(max_pool_connections=max_pool_connections),
+        )
+        self._requests = 0
+        self._requests_lock = threading.Lock()
+        self.client.meta.events.register("before-send.s3", self._count_request)
+
+    def _count_request(self, **kwargs) -> None:
+        with self._requests_lock:
+            self._requests += 1
+
+    # requests sent vs. connections opened (the rest reused a pooled connection)
+    def get_stats(self) -> Dict[str, int]:
+        connections = 0
+        try:  # NOTE: relies on botocore's urllib3 based http session
+            pools = self.client._endpoint.http_session._manager.pools
+            connections = sum(pools[key].num_connections for key in pools.keys())
+        except (AttributeError, KeyError):
+            logger.debug("Could not read the S3 connection pool stats")
+        return {
+            "requests": self._requests,
+            "connections_opened": connections,
+            "connections_reused": max(self._requests - connections, 0),
+        }
+
+
+# lazily creates the S3 client of this process (the first caller sets the pool size)
+def get_pooled_s3_client(
+    endpoint_url: Optional[str], max_pool_connections: int = 10
+) -> PooledS3Client:
+    with _s3_clients_lock:
+        if endpoint_url not in _s3_clients:
+            logger.info(
+                f"Creating pooled S3 client for {endpoint_url} "
+                f"(max {max_pool_connections} connections)"
+            )
+            _s3_clients[endpoint_url] = PooledS3Client(
+                endpoint_url, max_pool_connections
+            )
+        return _s3_clients[endpoint_url]
+
+
+# settings for boto3's managed transfers (upload_file, download_file)
+def get_transfer_config(
+    multipart_threshold: int, part_size: int, max_concurrency: int
+) -> "TransferConfig":
+    from boto3.s3.transfer import TransferConfig
+
+    return TransferConfig(
+        multipart_threshold=multipart_threshold,
+        multipart_chunksize=max(part_size, MIN_PART_SIZE),
+        max_concurrency=max_concurrency,
+    )
+
+
+class MultipartUploadWriter(io.RawIOBase):
+    """Write-only file object that uploads its data as an S3 multipart upload.
+    Parts are uploaded in parallel while writing continues; memory use is bounded
+    to (max_concurrency + 1) * part_size, since write() blocks while all upload
+    slots are taken. Use as a context manager: on an exception the upload is
+    aborted, otherwise it is completed when closing."""
+
+    def __init__(
+        self,
+        client,
+        bucket: str,
+        key: str,
+        part_size: int = 16 * 1024 * 1024,
+        max_concurrency: int = 4,
+    ):
+        super().__init__()
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.part_size = max(part_size, MIN_PART_SIZE)
+        self.bytes_written = 0
+        self._upload_id = client.create_multipart_upload(Bucket=bucket, Key=key)[
+            "UploadId"
+        ]
+        self._pool = ThreadPoolExecutor(max_workers=max_concurrency)
+        self._upload_slots = threading.BoundedSemaphore(max_concurrency)
+        self._buffer = bytearray()
+        self._futures: List[Future] = []
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self._raise_on_failed_part()
+        self._buffer += data
+        while len(self._buffer) >= self.part_size:
+            self._upload_part(bytes(self._buffer[: self.part_size]))
+            del self._buffer[: self.part_size]
+        self.bytes_written += len(data)
+        return len(data)
+
+    def _upload_part(self, data: bytes) -> None:
+        self._upload_slots.acquire()  # backpressure: wait for a free upload slot
+        part_number = len(self._futures) + 1
+        logger.debug(f"Uploading part {part_number} ({len(data)} bytes)")
+        future = self._pool.submit(self._send_part, part_number, data)
+        future.add_done_callback(lambda _: self._upload_slots.release())
+        self._futures.append(future)
+
+    def _send_part(self, part_number: int, data: bytes) -> dict:
+        response = self.client.upload_part(
+            Bucket=self.bucket,
+            Key=self.key,
+            PartNumber=part_number,
+            UploadId=self._upload_id,
+            Body=data,
+        )
+        return {"PartNumber": part_number, "ETag": response["ETag"]}
+
+    def _raise_on_failed_part(self) -> None:
+        for future in self._futures:
+            if future.done() and future.exception():
+                raise future.exception()  # type: ignore
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        try:
+            if self._buffer or not self._futures:  # last (or only) part
+                self._upload_part(bytes(self._buffer))
+                self._buffer.clear()
+            parts = [future.result() for future in self._futures]
+            self.client.complete_multipart_upload(
+                Bucket=self.bucket,
+                Key=self.key,
+                UploadId=self._upload_id,
+                MultipartUpload={"Parts": parts},
+            )
+            logger.info(f"Uploaded {self.bytes_written} bytes in {len(parts)} parts")
+        except Exception:
+            self.abort()
+            raise
+        finally:
+            self._pool.shutdown()
+            super().close()
+
+    def abort(self) -> None:
+        logger.warning(f"Aborting multipart upload of s3://{self.bucket}/{self.key}")
+        self._pool.shutdown(cancel_futures=True)
+        try:
+            self.client.abort_multipart_upload(
+                Bucket=self.bucket, Key=self.key, UploadId=self._upload_id
+            )
+        except (BotoCoreError, ClientError):
+            logger.exception("Failed to abort the multipart upload")
+        super().close()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None and not self.closed:
+            self.abort()
+        else:
+            self.close()
+
+
+# streams a tar of file_list (files/dirs) to S3, without writing it to disk first
+def stream_tar_to_s3(
+    client,
+    bucket: str,
+    key: str,
+    file_list: List[str],
+    part_size: int,
+    max_concurrency: int,
+    compression: Compression = Compression.GZIP,
+    zstd_threads: int = 0,
+    base_dir: str = "",  # see write_archive()
+) -> Optional[ArchiveStats]:
+    logger.info(f"Streaming {len(file_list)} items to s3://{bucket}/{key}")
+    try:
+        with MultipartUploadWriter(
+            client, bucket, key, part_size, max_concurrency
+        ) as writer:
+            return write_archive(writer, file_list, compression, zstd_threads, base_dir)
+    except (OSError, tarfile.TarError, BotoCoreError, ClientError):
+        logger.exception(f"Failed to stream tar to s3://{bucket}/{key}")
+        return None
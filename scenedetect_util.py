@@ -1,17 +1,29 @@
+from dataclasses import asdict
+from functools import partial
 import logging
 import os
 from time import time
-from dane.provenance import Provenance, obtain_software_versions
-from models import OutputType, ScenedetectOutput, MediaFile
+from typing import List, Optional, Tuple
+from cpu_util import limit_opencv_threads
+from dane.config import cfg
+from dane.provenance import obtain_software_versions
+from manifest_util import ManifestRecorder, write_output_file
+from metadata_util import get_keyframe_frame, get_shots_file, to_shot_table
+from models import OutputType, ScenedetectOutput, MediaFile, StageProvenance
+from resource_util import get_resource_usage_since, take_resource_snapshot
+import cv2  # type: ignore
 from scenedetect import (  # type: ignore
+    FrameTimecode,
     SceneManager,
     open_video,
     ContentDetector,
-    scene_manager,
+    VideoStream,
 )
+from writer_util import AsyncFileWriter, get_file_writer
 
 
 logger = logging.getLogger(__name__)
+limit_opencv_threads()  # OpenCV is imported by scenedetect
 
 
 class ScenedetectFailureException(Exception):
@@ -39,56 +51,52 @@ def _get_metadata_path(output_dir: str, kind: str) -> str:
         raise Exception()
 
 
+# NOTE: if a (non seekable) video_stream is passed, shots are detected on that stream,
+# while keyframes are extracted from media_file.file_path afterwards
 def run(
     media_file: MediaFile,
     output_dir: str,
     extract_keyframes=False,
-) -> Provenance:
+    video_stream: Optional[VideoStream] = None,
+) -> StageProvenance:
     logger.info(f"Running scenedetect on {media_file}")
     start_time = time()
+    resource_snapshot = take_resource_snapshot()
     keyframe_dir = _get_keyframe_dir(output_dir)
 
-    try:
-        video = open_video(media_file.file_path)
-    except Exception:
-        logger.error(
-            f"Failed to run scenedetect on {media_file.file_path}: "
-            "Could not open video."
-        )
-        raise ScenedetectFailureException()
+    video = video_stream if video_stream else _open_video(media_file.file_path)
     video_scene_manager = SceneManager()
     video_scene_manager.add_detector(ContentDetector())
     # Detect all scenes in video from current position to end.
-    video_scene_manager.detect_scenes(video)
+    frames_decoded = video_scene_manager.detect_scenes(video)
     # `get_scene_list` returns a list of start/end timecode pairs
     # for each scene that was found.
     scene_list = video_scene_manager.get_scene_list()
-    shot_boundaries_path = _get_metadata_path(
-        output_dir=output_dir, kind="shot_boundaries"
-    )
-    with open(shot_boundaries_path, "w") as f:
-        f.write(str(get_shot_boundaries(scene_list=scene_list)))
-    output_data = {"shot_boundaries": shot_boundaries_path}
+    output_data: dict = {"frames_decoded": frames_decoded}
+    recorder = ManifestRecorder(output_dir, "scenedetect")
 
+    keyframe_timestamps = None
     if extract_keyframes:
         logger.info("Also telling scenedetect to extract keyframes")
         keyframe_dir = _get_keyframe_dir(output_dir)
-        image_paths = scene_manager.save_images(
-            scene_list=scene_list,
-            video=video,
-            num_images=1,
-            image_extension="jpg",
-            encoder_param=100,
-            output_dir=keyframe_dir,
-            image_name_template="$TIMESTAMP_MS",
+        if not video.is_seekable:
+            video = _open_video(media_file.file_path, video.frame_rate)
+        with get_file_writer(recorder) as writer:
+            image_paths = _save_keyframes(scene_list, video, keyframe_dir, writer)
+        output_data["file_writer"] = asdict(writer.stats)
+        keyframe_timestamps = get_keyframes_timestamps(image_paths)
+    output_data.update(
+        write_metadata(
+            output_dir,
+            [(start.get_frames(), end.get_frames()) for start, end in scene_list],
+            video.frame_rate,
+            keyframe_timestamps,
+            recorder,
         )
-        output_data["keyframe_dir"] = keyframe_dir
-        keyframes_path = _get_metadata_path(output_dir=output_dir, kind="keyframes")
-        with open(keyframes_path, "w") as f:
-            f.write(str(get_keyframes_timestamps(image_paths)))
-        output_data["keyframe_timestamps"] = keyframes_path
+    )
+    recorder.save()
 
-    return Provenance(
+    return StageProvenance(
         activity_name="Python Scenedetect",
         activity_description="Shot detection & keyframe extraction",
         start_time_unix=start_time,
@@ -96,9 +104,143 @@ def run(
         software_version=obtain_software_versions(["scenedetect"]),
         input_data={"input_file": media_file.file_path},
         output_data=output_data,
+        resource_usage=get_resource_usage_since(resource_snapshot),
     )
 
 
+# shot detection on a time range [start_frame, end_frame) of the video (end_frame -1:
+# until the end). Decoding starts overlap_frames earlier, so the detector has seen the
+# preceding frames, as it would when processing the whole video: cuts at (or just
+# after) start_frame are found and cuts too close to a previous one are suppressed.
+# Returns the frames at which a shot starts within the range, the frame decoding
+# stopped at and the frame rate
+def detect_cuts(
+    file_path: str, start_frame: int, end_frame: int, overlap_frames: int
+) -> Tuple[List[int], int, float]:
+    video = _open_video(file_path)
+    video.seek(max(start_frame - overlap_frames, 0))
+    video_scene_manager = SceneManager()
+    video_scene_manager.add_detector(ContentDetector())
+    video_scene_manager.detect_scenes(
+        video, end_time=end_frame if end_frame >= 0 else None
+    )
+    cuts = [scene[0].get_frames() for scene in video_scene_manager.get_scene_list()[1:]]
+    return (
+        [cut for cut in cuts if cut >= start_frame],
+        video.frame_number,
+        video.frame_rate,
+    )
+
+
+# saves the keyframes of the given shots ([start_frame, end_frame) pairs),
+# returns their timestamps
+def extract_keyframes(
+    file_path: str,
+    shots: List[Tuple[int, int]],
+    output_dir: str,
+    writer: AsyncFileWriter,
+) -> List[int]:
+    video = _open_video(file_path)
+    image_paths = _save_keyframes(
+        to_scene_list(shots, video.frame_rate),
+        video,
+        _get_keyframe_dir(output_dir),
+        writer,
+    )
+    return get_keyframes_timestamps(image_paths)
+
+
+# writes the metadata of the shots ([start_frame, end_frame) pairs) and their
+# keyframes (None: not extracted) in cfg.VISXP_PREP.METADATA_FORMATS
+def write_metadata(
+    output_dir: str,
+    shots: List[Tuple[int, int]],
+    frame_rate: float,
+    keyframe_timestamps: Optional[List[int]],
+    recorder: Optional[ManifestRecorder] = None,
+) -> dict:
+    output_data: dict = {}
+    if "text" in cfg.VISXP_PREP.METADATA_FORMATS:
+        output_data["shot_boundaries"] = _get_metadata_path(
+            output_dir, "shot_boundaries"
+        )
+        write_output_file(
+            output_data["shot_boundaries"],
+            str(get_shot_boundaries(to_scene_list(shots, frame_rate))).encode(),
+            recorder,
+        )
+        if keyframe_timestamps is not None:
+            output_data["keyframe_timestamps"] = _get_metadata_path(
+                output_dir, "keyframes"
+            )
+            write_output_file(
+                output_data["keyframe_timestamps"],
+                str(keyframe_timestamps).encode(),
+                recorder,
+            )
+    if "npz" in cfg.VISXP_PREP.METADATA_FORMATS:
+        output_data["shots"] = get_shots_file(output_dir)
+        to_shot_table(shots, frame_rate, keyframe_timestamps).save(
+            output_data["shots"], recorder
+        )
+    if keyframe_timestamps is not None:
+        output_data["keyframe_dir"] = _get_keyframe_dir(output_dir)
+        output_data["keyframe_count"] = len(keyframe_timestamps)
+    return output_data
+
+
+def to_scene_list(shots: List[Tuple[int, int]], frame_rate: float) -> list:
+    return [
+        (FrameTimecode(start, frame_rate), FrameTimecode(end, frame_rate))
+        for start, end in shots
+    ]
+
+
+# saves the middle frame of each shot, as scenedetect's save_images(num_images=1)
+# does, but hands the images to the writer: they are encoded & written in the
+# background, while the next keyframe is decoded
+def _save_keyframes(
+    scene_list, video: VideoStream, keyframe_dir: str, writer: AsyncFileWriter
+) -> dict:
+    image_paths = {}
+    aspect_ratio = video.aspect_ratio if abs(video.aspect_ratio - 1.0) >= 0.01 else None
+    video.reset()
+    for i, (start, end) in enumerate(scene_list):
+        frame = get_keyframe_frame(start.get_frames(), end.get_frames())
+        timecode = FrameTimecode(frame, start.framerate)
+        video.seek(timecode)
+        image = video.read()
+        if image is None or image is False:
+            logger.error("Could not generate all keyframes.")
+            break
+        file_name = f"{int(timecode.get_seconds() * 1000)}.jpg"
+        writer.write(
+            os.path.join(keyframe_dir, file_name),
+            partial(_encode_keyframe, image, aspect_ratio),
+        )
+        image_paths[i] = [file_name]
+    return image_paths
+
+
+def _encode_keyframe(image, aspect_ratio: Optional[float]) -> bytes:
+    if aspect_ratio is not None:  # non-square pixels
+        image = cv2.resize(
+            image, (0, 0), fx=aspect_ratio, fy=1.0, interpolation=cv2.INTER_CUBIC
+        )
+    is_ok, encoded = cv2.imencode(".jpg", image, [cv2.IMWRITE_JPEG_QUALITY, 100])
+    if not is_ok:
+        raise ScenedetectFailureException("Failed to encode a keyframe")
+    return encoded.tobytes()
+
+
+def _open_video(file_path: str, framerate: Optional[float] = None) -> VideoStream:
+    try:
+        return open_video(file_path, framerate=framerate)
+    except Exception:
+        logger.error(f"Failed to run scenedetect on {file_path}: Could not open video.")
+        raise ScenedetectFailureException()
+
+
 def get_shot_boundaries(scene_list):
     return [
         tuple(int(scene[i].get_seconds() * 1000) for i in (0, 1))
@@ -0,0 +1,96 @@
+"""Measures the throughput of shot detection & keyframe extraction for different
+combinations of per-job CPU budgets (WORKER.CPU_THREADS_PER_JOB) and the number of
+jobs running in parallel on this machine (e.g. WORKER.PROCESS_POOL_SIZE).
+
+Run from the root of this repo, e.g.:
+
+    python scripts/benchmark_cpu_budget.py --budgets 0 1 2 4 --jobs 1 2 4
+
+Uses a generated test video, unless --video is given."""
+
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import os
+import subprocess
+import sys
+import tempfile
+from time import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cpu_util import apply_cpu_budget  # noqa: E402
+
+
+def generate_video(video_file: str, duration_s: int) -> None:
+    subprocess.run(
+        ["ffmpeg", "-v", "error", "-y", "-f", "lavfi"]
+        + ["-i", f"testsrc2=s=1280x720:r=25:d={duration_s}"]
+        + ["-c:v", "libx264", "-g", "50", "-pix_fmt", "yuv420p", video_file],
+        check=True,
+    )
+
+
+def warm_up() -> int:
+    import scenedetect_util  # noqa: F401
+
+    return os.getpid()
+
+
+def run_job(video_file: str, output_dir: str) -> None:
+    from models import MediaFile, OutputType
+    import scenedetect_util
+
+    for output_type in [OutputType.METADATA, OutputType.KEYFRAMES]:
+        os.makedirs(os.path.join(output_dir, output_type.value), exist_ok=True)
+    scenedetect_util.run(MediaFile(video_file, "benchmark"), output_dir, True)
+
+
+# returns the jobs finished per minute
+def measure(video_file: str, budget: int, jobs: int, rounds: int, work_dir: str):
+    with ProcessPoolExecutor(
+        max_workers=jobs,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=apply_cpu_budget,
+        initargs=(budget,),
+    ) as pool:
+        for warm_up_future in [pool.submit(warm_up) for _ in range(jobs)]:
+            warm_up_future.result()
+        start_time = time()
+        futures = [
+            pool.submit(run_job, video_file, os.path.join(work_dir, f"{budget}_{i}"))
+            for i in range(jobs * rounds)
+        ]
+        for future in futures:
+            future.result()
+        return jobs * rounds * 60 / (time() - start_time)
+
+
+def main() -> int:
+    parser = ArgumentParser(description="CPU budget benchmark")
+    parser.add_argument("--budgets", type=int, nargs="+", default=[0, 1, 2, 4])
+    parser.add_argument("--jobs", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--rounds", type=int, default=2)  # jobs per pool process
+    parser.add_argument("--video", default="")
+    parser.add_argument("--duration-s", type=int, default=30)  # generated video
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        video_file = args.video
+        if not video_file:
+            video_file = os.path.join(work_dir, "benchmark.mp4")
+            generate_video(video_file, args.duration_s)
+        print(f"{os.cpu_count()} CPUs, video: {video_file}")
+        print("jobs per minute (budget 0: library defaults, i.e. a thread per core)")
+        print("budget " + "".join(f"{jobs:>10} jobs" for jobs in args.jobs))
+        for budget in args.budgets:
+            results = [
+                measure(video_file, budget, jobs, args.rounds, work_dir)
+                for jobs in args.jobs
+            ]
+            print(f"{budget:>6} " + "".join(f"{r:>15.1f}" for r in results))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
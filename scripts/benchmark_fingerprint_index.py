@@ -0,0 +1,101 @@
+"""Measures the bulk insert and lookup throughput of the keyframe fingerprint index
+(VISXP_PREP.FINGERPRINT_INDEX) at the given number of entries, with readers in
+parallel processes (e.g. the workers of a node sharing the index).
+
+Run from the root of this repo, e.g.:
+
+    python scripts/benchmark_fingerprint_index.py --entries 5000000 --readers 1 4
+
+Uses a temporary index, unless --index is given (which is then kept, so larger
+indexes only need to be filled once)."""
+
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import closing
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+from time import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fingerprint_util import FingerprintIndex  # noqa: E402
+
+KEYFRAMES_PER_ASSET = 500
+
+
+# adds random fingerprints, per asset as the worker does. Returns entries per second
+def fill(index_path: str, entries: int) -> float:
+    start_time = time()
+    with FingerprintIndex(index_path) as index:
+        for asset in range(0, entries, KEYFRAMES_PER_ASSET):
+            index.add(
+                f"asset{asset}",
+                [
+                    (random.getrandbits(64), timestamp_ms)
+                    for timestamp_ms in range(min(KEYFRAMES_PER_ASSET, entries - asset))
+                ],
+            )
+    return entries / (time() - start_time)
+
+
+# looks up batches of an asset's keyframes, of which hit_rate was seen before.
+# Returns the lookups per second
+def lookup(index_path: str, lookups: int, hit_rate: float, seed: int) -> float:
+    rng = random.Random(seed)
+    with closing(sqlite3.connect(index_path)) as connection:
+        known = [
+            h
+            for h, in connection.execute(
+                "SELECT hash FROM fingerprints ORDER BY RANDOM() LIMIT 10000"
+            )
+        ]
+    with FingerprintIndex(index_path) as index:
+        hashes = [
+            (
+                rng.choice(known) % (1 << 64)
+                if rng.random() < hit_rate
+                else rng.getrandbits(64)
+            )
+            for _ in range(lookups)
+        ]
+        start_time = time()
+        for i in range(0, lookups, KEYFRAMES_PER_ASSET):
+            index.lookup(hashes[i : i + KEYFRAMES_PER_ASSET], "benchmark")
+    return lookups / (time() - start_time)
+
+
+def main() -> int:
+    parser = ArgumentParser(description="fingerprint index benchmark")
+    parser.add_argument("--entries", type=int, default=1000000)
+    parser.add_argument("--lookups", type=int, default=100000)  # per reader
+    parser.add_argument("--hit-rate", type=float, default=0.1)
+    parser.add_argument("--readers", type=int, nargs="+", default=[1, 4])
+    parser.add_argument("--index", default="")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        index_path = args.index or os.path.join(work_dir, "fingerprints.db")
+        with FingerprintIndex(index_path) as index:
+            missing = args.entries - index.count()
+        if missing > 0:
+            print(f"inserted {missing} entries: {fill(index_path, missing):.0f}/s")
+        print(f"index size: {os.path.getsize(index_path) / 1e6:.1f} MB")
+        print("readers\tlookups/s (total)")
+        for readers in args.readers:
+            with ProcessPoolExecutor(max_workers=readers) as pool:
+                rates = pool.map(
+                    lookup,
+                    [index_path] * readers,
+                    [args.lookups] * readers,
+                    [args.hit_rate] * readers,
+                    range(readers),
+                )
+                print(f"{readers}\t{sum(rates):.0f}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,83 @@
+"""Measures the cold start of the worker: the time it takes a fresh interpreter to
+import a module (default: worker), with a breakdown per imported package.
+
+Run from the root of this repo (so config.yml is found), e.g.:
+
+    python scripts/benchmark_startup.py --runs 5 --top 15 --max-ms 500
+
+Exits with 1 if the median import time exceeds --max-ms, or if one of the
+--forbid modules (default: the heavy media libraries) was imported."""
+
+from argparse import ArgumentParser
+from collections import defaultdict
+import statistics
+import subprocess
+import sys
+from typing import Dict, List, Tuple
+
+# only needed once there is media to process (see WORKER.PRELOAD_MODULES)
+HEAVY_MODULES = ["cv2", "scenedetect", "numpy", "matplotlib", "boto3"]
+
+
+# returns the total import time (ms) & the self time (ms) per top-level package
+def measure_import(module: str) -> Tuple[float, Dict[str, float]]:
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    # lines look like: "import time:  self [us] | cumulative | imported package"
+    self_ms: Dict[str, float] = defaultdict(float)
+    total_ms = 0.0
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:") :].split("|")
+        self_ms[name.strip().split(".")[0]] += int(self_us) / 1000
+        if name.strip() == module:
+            total_ms = int(cumulative_us) / 1000
+    return total_ms, self_ms
+
+
+def main() -> int:
+    parser = ArgumentParser(description="cold start benchmark")
+    parser.add_argument("--module", default="worker")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=15)
+    parser.add_argument("--max-ms", type=float, default=0)  # 0: no budget
+    parser.add_argument("--forbid", nargs="*", default=HEAVY_MODULES)
+    args = parser.parse_args()
+
+    totals: List[float] = []
+    breakdowns: Dict[str, List[float]] = defaultdict(list)
+    for _ in range(args.runs):
+        total_ms, self_ms = measure_import(args.module)
+        totals.append(total_ms)
+        for package, ms in self_ms.items():
+            breakdowns[package].append(ms)
+
+    median_ms = statistics.median(totals)
+    print(f"import {args.module}: median {median_ms:.1f} ms over {args.runs} runs")
+    print(f"  (min {min(totals):.1f} ms, max {max(totals):.1f} ms)")
+    print(f"top {args.top} packages by self time (median ms):")
+    medians = sorted(
+        ((statistics.median(ms), package) for package, ms in breakdowns.items()),
+        reverse=True,
+    )
+    for ms, package in medians[: args.top]:
+        print(f"  {ms:8.1f}  {package}")
+
+    ok = True
+    imported = [m for m in args.forbid if m in breakdowns]
+    if imported:
+        print(f"FAIL: {args.module} imports {', '.join(imported)}")
+        ok = False
+    if args.max_ms and median_ms > args.max_ms:
+        print(f"FAIL: median import time exceeds {args.max_ms} ms")
+        ok = False
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
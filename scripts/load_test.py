@@ -0,0 +1,271 @@
+"""Load test of a VideoSegmentationWorker without a DANE stack: the worker consumes
+from an in-process stand-in for RabbitMQ (tests/unit/fake_amqp.py), which queues
+synthetic tasks at the given arrival rate, saves its results to a fake DANE result
+API (with --dane-latency-s) and, in --mode process, uploads to an in-memory S3
+(tests/unit/fake_s3.py). Reports the queue wait, task latency percentiles,
+throughput and failure modes, e.g. deliveries that RabbitMQ would have closed the
+channel for (not acked within its consumer_timeout, --ack-timeout-s).
+
+Run from the root of this repo, e.g.:
+
+    python scripts/load_test.py --tasks 50 --rate 30 --pool-size 2 --prefetch 2
+
+--mode sleep (default) runs tasks that just take --task-s (±--jitter) seconds, of
+which --failure-rate fail, to test the worker's concurrency & queue handling.
+--mode process runs the actual processing on copies of --video (or a generated
+video), to measure the tasks per hour a pod sustains."""
+
+from argparse import ArgumentParser
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+from time import sleep, time
+from typing import Dict, List, Tuple
+from urllib.parse import parse_qs, urlparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import dane.base_classes  # noqa: E402
+from dane.base_classes import base_worker  # noqa: E402
+from dane.config import cfg  # noqa: E402
+
+from tests.unit.fake_amqp import FakeChannel, FakeConnection  # noqa: E402
+
+# read by the (spawned) task processes in --mode process
+BASE_MOUNT_ENV_VAR = "VISXP_PREP_LOAD_TEST_BASE_MOUNT"
+
+
+# --mode sleep, e.g. synthetic://task/3?duration_s=1.5&fail=0
+def synthetic_task(input_file_path: str):
+    params = parse_qs(urlparse(input_file_path).query)
+    sleep(float(params["duration_s"][0]))
+    if params["fail"][0] == "1":
+        return {"state": 500, "message": "Synthetic failure"}, None
+    return {"state": 200, "message": "Synthetic success"}, None
+
+
+# --mode process: the actual processing, with the output uploaded to a fake S3
+def process_media_task(input_file_path: str):
+    import io_util
+    import main_data_processor
+    from tests.unit.fake_s3 import FakeS3Client
+
+    if not cfg.is_frozen() or cfg.FILE_SYSTEM.BASE_MOUNT != os.environ.get(
+        BASE_MOUNT_ENV_VAR
+    ):
+        _configure_processing(os.environ[BASE_MOUNT_ENV_VAR])
+        fake_s3 = FakeS3Client()
+        io_util.get_s3_client = lambda: fake_s3  # type: ignore
+        io_util.get_s3_client_stats = lambda: {}  # type: ignore
+    return main_data_processor.run(input_file_path)
+
+
+def _configure_processing(base_mount: str) -> None:
+    cfg.defrost()
+    cfg.FILE_SYSTEM.BASE_MOUNT = base_mount
+    cfg.INPUT.DELETE_ON_COMPLETION = False
+    cfg.INPUT.PIPELINED_DOWNLOAD = False
+    cfg.OUTPUT.DELETE_ON_COMPLETION = True
+    cfg.OUTPUT.TRANSFER_ON_COMPLETION = True
+    cfg.OUTPUT.S3_BUCKET = "load-test"
+    cfg.freeze()
+
+
+def to_queue_message(i: int, url: str) -> str:
+    return json.dumps(
+        {
+            "task": {"key": "VISXP_PREP", "_id": f"task{i}"},
+            "document": {
+                "target": {"id": f"doc{i}", "url": url, "type": "Video"},
+                "creator": {"id": "load-test", "type": "Organization"},
+                "_id": f"doc{i}",
+            },
+        }
+    )
+
+
+# start times relative to the first task: a fixed interval or a Poisson process
+def get_arrival_offsets(tasks: int, rate: float, poisson: bool) -> List[float]:
+    offsets, offset = [], 0.0
+    for _ in range(tasks):
+        offsets.append(offset)
+        offset += random.expovariate(rate / 60) if poisson else 60 / rate
+    return offsets
+
+
+def get_task_urls(args, work_dir: str) -> List[str]:
+    if args.mode == "sleep":
+        return [
+            f"synthetic://task/{i}?duration_s="
+            f"{max(args.task_s + random.uniform(-args.jitter, args.jitter), 0):.3f}"
+            f"&fail={int(random.random() < args.failure_rate)}"
+            for i in range(args.tasks)
+        ]
+    video_file = args.video
+    if not video_file:
+        video_file = os.path.join(work_dir, "load_test.mp4")
+        subprocess.run(
+            ["ffmpeg", "-v", "error", "-y", "-f", "lavfi"]
+            + ["-i", f"testsrc2=s=1280x720:r=25:d={args.duration_s}"]
+            + ["-c:v", "libx264", "-pix_fmt", "yuv420p", video_file],
+            check=True,
+        )
+    input_dir = os.path.join(work_dir, "assets")
+    os.makedirs(input_dir)
+    urls = []
+    for i in range(args.tasks):  # each asset needs its own source ID (file name)
+        url = os.path.join(input_dir, f"asset_{i}.mp4")
+        os.symlink(os.path.abspath(video_file), url)
+        urls.append(url)
+    return urls
+
+
+def percentiles(values: List[float]) -> Dict[str, float]:
+    if not values:
+        return {}
+    values = sorted(values)
+    return {
+        f"p{p}": round(values[min(int(len(values) * p / 100), len(values) - 1)], 3)
+        for p in [50, 90, 99]
+    } | {"max": round(values[-1], 3)}
+
+
+def run_load_test(args) -> dict:
+    cfg.defrost()
+    cfg.WORKER.PROCESS_POOL_SIZE = args.pool_size
+    cfg.WORKER.PREFETCH_COUNT = args.prefetch
+    if args.mode == "sleep":  # nothing to import up front
+        cfg.WORKER.PRELOAD_MODULES = []
+    cfg.freeze()
+    os.environ["DW_VISXP_PREP_UNIT_TESTING"] = "1"  # no DANE server, nor RabbitMQ
+    dane.base_classes.cwd_is_git = lambda: False  # type: ignore
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        if args.mode == "process":
+            os.environ[BASE_MOUNT_ENV_VAR] = work_dir
+            _configure_processing(work_dir)
+        urls = get_task_urls(args, work_dir)
+        start_time = time() + args.warm_up_s  # time for the pool to start
+        arrival_times = [
+            start_time + offset
+            for offset in get_arrival_offsets(args.tasks, args.rate, args.poisson)
+        ]
+        channel = FakeChannel(
+            [to_queue_message(i, url) for i, url in enumerate(urls)], arrival_times
+        )
+        dane_results: List[float] = []
+
+        def fake_connect(self):
+            self.channel, self.connection = channel, FakeConnection(channel)
+            self._connected, self._is_interrupted = True, False
+
+        def fake_save_to_dane_index(*args_, **kwargs):
+            sleep(args.dane_latency_s)  # the DANE result API
+            dane_results.append(time())
+
+        from worker import VideoSegmentationWorker
+
+        base_worker.connect = fake_connect  # type: ignore
+        worker = VideoSegmentationWorker(
+            cfg, synthetic_task if args.mode == "sleep" else process_media_task
+        )
+        worker.handler = object()  # base_worker refuses tasks without one
+        worker.save_to_dane_index = fake_save_to_dane_index  # type: ignore
+        worker.connect()
+        consumer = threading.Thread(target=worker.run, daemon=True)
+        consumer.start()
+        deadline = arrival_times[-1] + args.drain_s
+        while len(channel.acked) + len(channel.nacked) < args.tasks:
+            if time() > deadline:
+                break
+            sleep(0.1)
+        worker.stop()
+        consumer.join()
+    return to_report(args, channel, dane_results, start_time)
+
+
+def to_report(args, channel: FakeChannel, dane_results: list, start: float) -> dict:
+    acked = sorted(channel.acked)
+    queue_wait = [channel.delivered_at[t] - channel.arrived_at[t] for t in acked]
+    latency = [channel.acked_at[t] - channel.arrived_at[t] for t in acked]
+    processing = [channel.acked_at[t] - channel.delivered_at[t] for t in acked]
+    states: Dict[str, int] = {}
+    messages: Dict[Tuple[int, str], int] = {}
+    for response in channel.responses.values():
+        state = response.get("state", -1)
+        states[str(state)] = states.get(str(state), 0) + 1
+        if state != 200:
+            key = (state, response.get("message", ""))
+            messages[key] = messages.get(key, 0) + 1
+    duration_s = max(list(channel.acked_at.values()) + [start]) - start
+    succeeded = states.get("200", 0)
+    event_loop_gaps = [
+        b - a for a, b in zip(channel.poll_times, channel.poll_times[1:])
+    ]
+    return {
+        "settings": {
+            "mode": args.mode,
+            "tasks": args.tasks,
+            "arrival_rate_per_min": args.rate,
+            "pool_size": args.pool_size,
+            "prefetch": args.prefetch,
+        },
+        "tasks": {
+            "acked": len(acked),
+            "succeeded": succeeded,
+            "nacked": len(channel.nacked),
+            "unfinished": args.tasks - len(acked) - len(channel.nacked),
+            "states": states,
+            "saved_to_dane": len(dane_results),
+        },
+        "throughput_per_hour": (
+            round(succeeded * 3600 / duration_s, 1) if duration_s > 0 else 0
+        ),
+        "queue_wait_s": percentiles(queue_wait),
+        "latency_s": percentiles(latency),
+        "processing_s": percentiles(processing),
+        "failure_modes": {
+            # RabbitMQ closes the channel when a delivery is not acked in time
+            "ack_timeouts": len([p for p in processing if p > args.ack_timeout_s]),
+            "errors": [
+                {"state": state, "message": message, "count": count}
+                for (state, message), count in sorted(messages.items())
+            ],
+            # the consumer thread must keep handling events (e.g. heartbeats)
+            "max_event_loop_gap_s": round(max(event_loop_gaps, default=0), 3),
+        },
+    }
+
+
+def main() -> int:
+    parser = ArgumentParser(description="VideoSegmentationWorker load test")
+    parser.add_argument("--mode", choices=["sleep", "process"], default="sleep")
+    parser.add_argument("--tasks", type=int, default=20)
+    parser.add_argument("--rate", type=float, default=60)  # arrivals per minute
+    parser.add_argument("--poisson", action="store_true")  # else a fixed interval
+    parser.add_argument("--pool-size", type=int, default=2)  # PROCESS_POOL_SIZE
+    parser.add_argument("--prefetch", type=int, default=2)  # PREFETCH_COUNT
+    parser.add_argument("--task-s", type=float, default=2)  # --mode sleep
+    parser.add_argument("--jitter", type=float, default=0.5)
+    parser.add_argument("--failure-rate", type=float, default=0)
+    parser.add_argument("--video", default="")  # --mode process
+    parser.add_argument("--duration-s", type=int, default=30)  # generated video
+    parser.add_argument("--dane-latency-s", type=float, default=0.05)
+    parser.add_argument("--ack-timeout-s", type=float, default=1800)
+    parser.add_argument("--warm-up-s", type=float, default=5)
+    parser.add_argument("--drain-s", type=float, default=600)  # after the last task
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    report = run_load_test(args)
+    print(json.dumps(report, indent=4))
+    return 0 if report["tasks"]["unfinished"] == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,259 @@
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+import fcntl
+import json
+import logging
+import os
+import shutil
+import socket
+import time
+from typing import IO, Callable, Dict, Iterator, List, Optional
+
+
+logger = logging.getLogger(__name__)
+SHARD_FILE_BASE_NAME = "visxp_prep__shard"
+LOCK_FILE = ".lock"
+OPEN_SUFFIX = ".open"  # the shard new archives are appended to
+SEALED_SUFFIX = ".sealed"  # full (or old enough), waiting to be uploaded
+LEASE_SUFFIX = ".lease"  # flock-ed by the process uploading the sealed shard
+INDEX_SUFFIX = ".index.json"
+
+
+@dataclass
+class ShardLocation:
+    """Where the archives of an asset are in a shard object: the byte range of each
+    archive (by file name), so a reader can fetch it with a range request"""
+
+    uri: str
+    index_uri: str
+    archives: Dict[str, dict] = field(default_factory=dict)  # offset & length
+
+    def to_json(self) -> dict:
+        return {"uri": self.uri, "index_uri": self.index_uri, "archives": self.archives}
+
+
+class ShardSpool:
+    """Appends the archives of small assets to a shared shard file in a spool dir,
+    instead of uploading each as a tiny object. A shard is sealed once it holds
+    max_bytes or its first archive is max_age_s old, after which flush() uploads it
+    and its index (the offset & length of each archive). Each host appends to its
+    own dir below spool_root, guarded by a file lock, so the worker's processes
+    (and other workers on the host) share its open shard. flush() sweeps the dirs
+    of all hosts, so the shards of a host that's gone (e.g. a pod) are uploaded by
+    the others. The process uploading a shard holds a lock on its lease file,
+    which is released (and the shard taken over) when that process dies"""
+
+    def __init__(
+        self,
+        spool_root: str,
+        base_uri: str,  # of the shard objects, e.g. s3://<bucket>/assets/shards
+        max_bytes: int,
+        max_age_s: float,
+        upload: Callable[[str, str], bool],  # (local file, object name) -> success
+        host: str = "",  # default: this host's name
+    ):
+        self.spool_root = spool_root
+        self.spool_dir = os.path.join(spool_root, host or socket.gethostname())
+        self.base_uri = base_uri
+        self.max_bytes = max_bytes
+        self.max_age_s = max_age_s
+        self.upload = upload
+        os.makedirs(self.spool_dir, exist_ok=True)
+
+    # archives: file name -> local archive. Copies them into the open shard (as one
+    # asset), uploading the shard if that fills it up
+    def append(self, source_id: str, archives: Dict[str, str]) -> ShardLocation:
+        spool_dir = self.spool_dir
+        with _lock(spool_dir):
+            shard_id = _get_open_shard(spool_dir) or self._new_shard()
+            index = _read_index(spool_dir, shard_id)
+            location = ShardLocation(
+                f"{self.base_uri}/{get_shard_file_name(shard_id)}",
+                f"{self.base_uri}/{get_shard_file_name(shard_id)}{INDEX_SUFFIX}",
+            )
+            with open(_get_file(spool_dir, shard_id, OPEN_SUFFIX), "ab") as f:
+                for file_name, archive in archives.items():
+                    offset = f.tell()  # after any bytes of an interrupted append
+                    with open(archive, "rb") as src:
+                        shutil.copyfileobj(src, f)
+                    location.archives[file_name] = {
+                        "offset": offset,
+                        "length": f.tell() - offset,
+                    }
+                f.flush()
+                os.fsync(f.fileno())
+                size = f.tell()
+            # the index is only updated once the archives are durable
+            index["assets"][source_id] = location.archives
+            _write_index(spool_dir, shard_id, index)
+            logger.info(f"Appended the archives of {source_id} to {location.uri}")
+            if size >= self.max_bytes:
+                _seal(spool_dir, shard_id)
+        if size >= self.max_bytes:
+            self.flush()
+        return location
+
+    # uploads the sealed shards of all hosts, after sealing their open shards that
+    # are old enough (force: this host's open shard as well, e.g. when the worker
+    # stops). Returns the names of the uploaded shards
+    def flush(self, force: bool = False) -> List[str]:
+        uploaded = []
+        for spool_dir in self._get_spool_dirs():
+            with _lock(spool_dir):
+                shard_id = _get_open_shard(spool_dir)
+                if shard_id and (
+                    (force and spool_dir == self.spool_dir)
+                    or _get_age_s(spool_dir, shard_id) >= self.max_age_s
+                ):
+                    _seal(spool_dir, shard_id)
+            for shard_id in _get_sealed_shards(spool_dir):
+                if self._upload_shard(spool_dir, shard_id):
+                    uploaded.append(get_shard_file_name(shard_id))
+        return uploaded
+
+    # True once the shard of the location was uploaded (it's no longer spooled)
+    def is_uploaded(self, location: ShardLocation) -> bool:
+        shard_id = get_shard_id(os.path.basename(location.uri))
+        return not any(
+            os.path.exists(_get_file(spool_dir, shard_id, suffix))
+            for spool_dir in self._get_spool_dirs()
+            for suffix in (OPEN_SUFFIX, SEALED_SUFFIX)
+        )
+
+    # the shards in the spool of this host (open or sealed), e.g. to monitor it
+    def list_shards(self) -> Dict[str, str]:
+        shards = {}
+        for file_name in os.listdir(self.spool_dir):
+            shard_id, suffix = os.path.splitext(file_name)
+            if suffix in (OPEN_SUFFIX, SEALED_SUFFIX):
+                shards[shard_id] = suffix
+        return shards
+
+    # the shard first, so the index never points to a missing object. Skipped if
+    # another process holds the lease (i.e. is uploading it)
+    def _upload_shard(self, spool_dir: str, shard_id: str) -> bool:
+        sealed_file = _get_file(spool_dir, shard_id, SEALED_SUFFIX)
+        index_file = _get_file(spool_dir, shard_id, INDEX_SUFFIX)
+        file_name = get_shard_file_name(shard_id)
+        with _lease(spool_dir, shard_id) as lease:
+            if lease is None:
+                return False
+            if not os.path.exists(sealed_file):  # another process just uploaded it
+                os.remove(lease.name)
+                return False
+            if not (
+                self.upload(sealed_file, file_name)
+                and self.upload(index_file, f"{file_name}{INDEX_SUFFIX}")
+            ):
+                logger.error(f"Failed to upload shard {file_name}, will retry")
+                return False
+            asset_count = len(_read_index(spool_dir, shard_id)["assets"])
+            logger.info(f"Uploaded shard {file_name} ({asset_count} assets)")
+            os.remove(sealed_file)
+            os.remove(index_file)
+            os.remove(lease.name)
+        return True
+
+    # unique across the hosts writing shards to the same bucket
+    def _new_shard(self) -> str:
+        host = os.path.basename(self.spool_dir)
+        shard_id = f"{time.time_ns()}-{host}-{os.getpid()}"
+        _write_index(
+            self.spool_dir, shard_id, {"created_at": time.time(), "assets": {}}
+        )
+        open(_get_file(self.spool_dir, shard_id, OPEN_SUFFIX), "wb").close()
+        return shard_id
+
+    # this host's dir first
+    def _get_spool_dirs(self) -> List[str]:
+        return [self.spool_dir] + [
+            entry.path
+            for entry in sorted(os.scandir(self.spool_root), key=lambda e: e.name)
+            if entry.is_dir() and entry.path != self.spool_dir
+        ]
+
+
+# e.g. visxp_prep__shard__<shard_id>.shard, the concatenated archives of its assets
+def get_shard_file_name(shard_id: str) -> str:
+    return f"{SHARD_FILE_BASE_NAME}__{shard_id}.shard"
+
+
+def get_shard_id(shard_file_name: str) -> str:
+    return shard_file_name[len(f"{SHARD_FILE_BASE_NAME}__") : -len(".shard")]
+
+
+# HTTP range header for the archive at offset (e.g. for S3's get_object)
+def get_byte_range(offset: int, length: int) -> str:
+    return f"bytes={offset}-{offset + length - 1}"
+
+
+def _get_open_shard(spool_dir: str) -> Optional[str]:
+    for file_name in os.listdir(spool_dir):
+        shard_id, suffix = os.path.splitext(file_name)
+        if suffix == OPEN_SUFFIX:
+            return shard_id
+    return None
+
+
+def _get_sealed_shards(spool_dir: str) -> List[str]:
+    return sorted(
+        shard_id
+        for shard_id, suffix in map(os.path.splitext, os.listdir(spool_dir))
+        if suffix == SEALED_SUFFIX
+    )
+
+
+def _seal(spool_dir: str, shard_id: str) -> None:
+    os.replace(
+        _get_file(spool_dir, shard_id, OPEN_SUFFIX),
+        _get_file(spool_dir, shard_id, SEALED_SUFFIX),
+    )
+
+
+def _get_age_s(spool_dir: str, shard_id: str) -> float:
+    return time.time() - _read_index(spool_dir, shard_id)["created_at"]
+
+
+def _read_index(spool_dir: str, shard_id: str) -> dict:
+    with open(_get_file(spool_dir, shard_id, INDEX_SUFFIX)) as f:
+        return json.load(f)
+
+
+def _write_index(spool_dir: str, shard_id: str, index: dict) -> None:
+    index_file = _get_file(spool_dir, shard_id, INDEX_SUFFIX)
+    with open(f"{index_file}.tmp", "w") as f:
+        json.dump(index, f, indent=4)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(f"{index_file}.tmp", index_file)
+
+
+def _get_file(spool_dir: str, shard_id: str, suffix: str) -> str:
+    return os.path.join(spool_dir, f"{shard_id}{suffix}")
+
+
+# exclusive across processes (and threads, as each opens the lock file itself)
+@contextmanager
+def _lock(spool_dir: str) -> Iterator[None]:
+    with open(os.path.join(spool_dir, LOCK_FILE), "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+# yields the locked lease file, or None if another process holds it. The kernel
+# releases the lock when the process dies, so its shard is taken over
+@contextmanager
+def _lease(spool_dir: str, shard_id: str) -> Iterator[Optional[IO]]:
+    with open(_get_file(spool_dir, shard_id, LEASE_SUFFIX), "a") as lease_file:
+        try:
+            fcntl.flock(lease_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield None
+            return
+        try:
+            yield lease_file
+        finally:
+            fcntl.flock(lease_file, fcntl.LOCK_UN)
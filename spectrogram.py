@@ -1,47 +1,77 @@
+from dataclasses import asdict
+import io
 import numpy as np
-from python_speech_features import logfbank  # type: ignore
-import ffmpeg  # type: ignore
 import logging
 import os
+from functools import lru_cache
 from time import time
-from typing import List
+from typing import Callable, Dict, List, Optional
 from dane.config import cfg
-from dane.provenance import Provenance
-from matplotlib import pyplot as plt  # type: ignore
+from manifest_util import ManifestRecorder
+from models import MediaFile, OutputType, StageProvenance
 from collections import defaultdict
+from cpu_util import get_ffmpeg_input_options
 from media_file_util import (
     get_start_frame,
     get_end_frame,
 )
+from resource_util import get_resource_usage_since, take_resource_snapshot
+from writer_util import AsyncFileWriter, get_file_writer
 
 
 logger = logging.getLogger(__name__)
+# log mel filterbank settings, shared by all spectrogram engines
+SPEC_WINLEN_S = 0.02
+SPEC_WINSTEP_S = 0.01
+SPEC_NFILT = 257
+SPEC_NFFT = 1024
+SPEC_PREEMPH = 0.97
+# the original implementation (python_speech_features), that produced the golden
+# output in tests/data/spectrograms. Other engines must match it, see
+# tests/unit/test_spectrogram.py
+REFERENCE_ENGINE = "python_speech_features"
 
 
 # TODO this main function should be configurable via config.yml
 def run(
-    input_file_path: str,
+    media_file: MediaFile,
     keyframe_timestamps: List[int],
     output_dirs: dict,
-) -> Provenance:
+) -> StageProvenance:
     start_time = time()
+    resource_snapshot = take_resource_snapshot()
+    input_file_path = media_file.file_path
     logger.info("Extracting audio spectrograms")
 
     spectrogram_files = defaultdict(list)
-    for sample_rate in cfg.VISXP_PREP.SPECTROGRAM_SAMPLERATE_HZ:
-        logger.info(f"Extracting {sample_rate}Hz spectrograms")
-        sf = extract_audio_spectrograms(
-            media_file=input_file_path,
-            keyframe_timestamps=keyframe_timestamps,
-            locations=output_dirs,
-            sample_rate=sample_rate,
-            window_size_ms=cfg.VISXP_PREP.SPECTROGRAM_WINDOW_SIZE_MS,
-            generate_images=cfg.VISXP_PREP.GENERATE_SPECTROGRAM_IMAGES,
-            extract_audio=cfg.VISXP_PREP.EXTRACT_AUDIO_SAMPLES,
-        )
-        for k, v in sf.items():
-            spectrogram_files[k].extend(v)
-    return Provenance(
+    if not media_file.has_audio:
+        logger.warning(f"No audio stream in {input_file_path}, skipping spectrograms")
+    # the output dir of the asset, for the manifest
+    recorder = ManifestRecorder(
+        os.path.dirname(output_dirs[OutputType.SPECTROGRAMS.value]), "spectrogram"
+    )
+    with get_file_writer(recorder) as writer:
+        for sample_rate in (
+            cfg.VISXP_PREP.SPECTROGRAM_SAMPLERATE_HZ if media_file.has_audio else []
+        ):
+            logger.info(f"Extracting {sample_rate}Hz spectrograms")
+            sf = extract_audio_spectrograms(
+                media_file=input_file_path,
+                keyframe_timestamps=keyframe_timestamps,
+                locations=output_dirs,
+                sample_rate=sample_rate,
+                window_size_ms=cfg.VISXP_PREP.SPECTROGRAM_WINDOW_SIZE_MS,
+                generate_images=cfg.VISXP_PREP.GENERATE_SPECTROGRAM_IMAGES,
+                extract_audio=cfg.VISXP_PREP.EXTRACT_AUDIO_SAMPLES,
+                engine=cfg.VISXP_PREP.SPECTROGRAM_ENGINE,
+                writer=writer,
+            )
+            for k, v in sf.items():
+                spectrogram_files[k].extend(v)
+        # written by matplotlib & ffmpeg rather than the writer
+        for file_path in spectrogram_files["images"] + spectrogram_files["audio"]:
+            recorder.add_file(file_path)
+    return StageProvenance(
         activity_name="Spectrogram extraction",
         activity_description=(
             "Extract audio spectrogram (Numpy array)"
@@ -53,18 +83,26 @@ def run(
         input_data={
             "input_file_path": input_file_path,
             "keyframe_timestamps": str(keyframe_timestamps),
+            "engine": cfg.VISXP_PREP.SPECTROGRAM_ENGINE,
         },
         output_data={
             "spectrogram_files": str(spectrogram_files["spectrograms"]),
+            "spectrogram_count": len(spectrogram_files["spectrograms"]),
             "spectrogram_images": str(spectrogram_files["images"]),
             "audio_samples": str(spectrogram_files["audio"]),
+            "file_writer": asdict(writer.stats),
         },
+        resource_usage=get_resource_usage_since(resource_snapshot),
     )
 
 
+# NOTE: ffmpeg-python, python_speech_features & matplotlib are imported on first use,
+# so importing this module does not slow down the worker's start
 def get_raw_audio(media_file: str, sample_rate: int):
+    import ffmpeg  # type: ignore
+
     out, _ = (
-        ffmpeg.input(media_file)
+        ffmpeg.input(media_file, **get_ffmpeg_input_options())
         .output("-", format="s16le", acodec="pcm_s16le", ac=1, ar=sample_rate)
         .run(quiet=True)
     )
@@ -87,7 +125,10 @@ def raw_audio_to_spectrograms(
     window_size_ms: int,
     z_normalize: bool,
     generate_image: bool,
+    engine: str = REFERENCE_ENGINE,
+    writer: Optional[AsyncFileWriter] = None,
 ):
+    get_spectrogram = SPECTROGRAM_ENGINES[engine]
     fns = defaultdict(list)
     for keyframe_ms in keyframe_timestamps:
         start_frame = get_start_frame(keyframe_ms, window_size_ms, sample_rate)
@@ -95,7 +136,7 @@ def raw_audio_to_spectrograms(
         logger.info(
             f"Extracting window at {keyframe_ms} ms. Frames {start_frame} to {end_frame}."
         )
-        spectrogram = get_spec(raw_audio[start_frame:end_frame], sample_rate)
+        spectrogram = get_spectrogram(raw_audio[start_frame:end_frame], sample_rate)
         logger.info(
             f"Spectrogram is a np array with dimensions: {np.array(spectrogram).shape}"
         )
@@ -111,7 +152,12 @@ def raw_audio_to_spectrograms(
             locations["spectrograms"], f"{keyframe_ms}_{sample_rate}.npz"
         )
         out_dict = {"audio": spectrogram}
-        np.savez(spec_path, out_dict)  # type: ignore
+        if writer:
+            buffer = io.BytesIO()
+            np.savez(buffer, out_dict)  # type: ignore
+            writer.write(spec_path, buffer.getbuffer())
+        else:
+            np.savez(spec_path, out_dict)  # type: ignore
         fns["spectrograms"].append(spec_path)
     return fns
 
@@ -122,7 +168,9 @@ def generate_mp3_samples(
     keyframe_timestamps: list[int],
     window_size_ms: int,
 ):
-    audio = ffmpeg.input(media_file)
+    import ffmpeg  # type: ignore
+
+    audio = ffmpeg.input(media_file, **get_ffmpeg_input_options())
     fns = []
     for timestamp in keyframe_timestamps:
         out_file = os.path.join(location, f"{timestamp}.mp3")
@@ -140,8 +188,16 @@ def generate_mp3_samples(
 
 
 def get_spec(wav_bit: np.ndarray, sample_rate: int):
+    from python_speech_features import logfbank  # type: ignore
+
     spec = logfbank(
-        wav_bit, sample_rate, winlen=0.02, winstep=0.01, nfilt=257, nfft=1024
+        wav_bit,
+        sample_rate,
+        winlen=SPEC_WINLEN_S,
+        winstep=SPEC_WINSTEP_S,
+        nfilt=SPEC_NFILT,
+        nfft=SPEC_NFFT,
+        preemph=SPEC_PREEMPH,
     )
     # Convert to 32-bit float and expand dim
     spec = spec.astype("float32")
@@ -153,7 +209,54 @@ def get_spec(wav_bit: np.ndarray, sample_rate: int):
     return spec
 
 
+# same output as get_spec (within float32 precision), but vectorised with NumPy
+# and with the mel filterbank computed once per sample rate instead of per window
+def get_spec_numpy(wav_bit: np.ndarray, sample_rate: int):
+    frame_len = int(np.floor(SPEC_WINLEN_S * sample_rate + 0.5))  # round half up
+    frame_step = int(np.floor(SPEC_WINSTEP_S * sample_rate + 0.5))
+    signal = np.asarray(wav_bit, dtype=np.float64)
+    signal = np.append(signal[:1], signal[1:] - SPEC_PREEMPH * signal[:-1])
+    frame_count = 1
+    if len(signal) > frame_len:
+        frame_count += int(np.ceil((len(signal) - frame_len) / frame_step))
+    padded = np.zeros((frame_count - 1) * frame_step + frame_len)
+    padded[: len(signal)] = signal
+    frames = np.lib.stride_tricks.sliding_window_view(padded, frame_len)[::frame_step]
+    power_spectrum = np.square(np.abs(np.fft.rfft(frames, SPEC_NFFT))) / SPEC_NFFT
+    feat = power_spectrum @ get_mel_filterbank(sample_rate).T
+    feat[feat == 0] = np.finfo(float).eps  # prevent log(0)
+    return np.expand_dims(np.log(feat).astype("float32").T, axis=0)
+
+
+# the filterbank of python_speech_features.get_filterbanks: nfilt triangular filters
+# on the FFT bins, evenly spaced on the mel scale between 0Hz and sample_rate/2
+@lru_cache(maxsize=None)
+def get_mel_filterbank(sample_rate: int) -> np.ndarray:
+    high_mel = 2595 * np.log10(1 + (sample_rate / 2) / 700.0)
+    mel_points = np.linspace(0, high_mel, SPEC_NFILT + 2)
+    hz_points = 700 * (10 ** (mel_points / 2595.0) - 1)
+    bins = np.floor((SPEC_NFFT + 1) * hz_points / sample_rate)
+    filterbank = np.zeros([SPEC_NFILT, SPEC_NFFT // 2 + 1])
+    for j in range(SPEC_NFILT):
+        left, center, right = bins[j], bins[j + 1], bins[j + 2]
+        rising = np.arange(int(left), int(center))
+        filterbank[j, rising] = (rising - left) / (center - left)
+        falling = np.arange(int(center), int(right))
+        filterbank[j, falling] = (right - falling) / (right - center)
+    filterbank.setflags(write=False)  # shared by all calls
+    return filterbank
+
+
+# computes the spectrogram of a window of raw audio, see VISXP_PREP.SPECTROGRAM_ENGINE
+SPECTROGRAM_ENGINES: Dict[str, Callable[[np.ndarray, int], np.ndarray]] = {
+    REFERENCE_ENGINE: get_spec,
+    "numpy": get_spec_numpy,
+}
+
+
 def generate_spec_image(spectrogram, destination):
+    from matplotlib import pyplot as plt  # type: ignore
+
     fft = np.abs(spectrogram)
     fft[fft == 0] = 0.0000000000001  # prevent zero division
     fig = plt.figure(figsize=(64, 64), dpi=10)
@@ -171,6 +274,8 @@ def extract_audio_spectrograms(
     window_size_ms: int,
     generate_images: bool,
     extract_audio: bool,
+    engine: str = REFERENCE_ENGINE,
+    writer: Optional[AsyncFileWriter] = None,
 ):
     logger.info(f"Convert audio to wav at {sample_rate}Hz.")
     raw_audio = get_raw_audio(media_file=media_file, sample_rate=sample_rate)
@@ -183,6 +288,8 @@ def extract_audio_spectrograms(
         window_size_ms=window_size_ms,
         z_normalize=True,
         generate_image=generate_images,
+        engine=engine,
+        writer=writer,
     )
     if extract_audio:
         audio_files = generate_mp3_samples(
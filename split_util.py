@@ -0,0 +1,469 @@
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass
+import json
+import logging
+import multiprocessing
+from multiprocessing.process import BaseProcess
+import os
+import shutil
+import socket
+import sys
+import threading
+from time import sleep, time
+from typing import Iterator, List, Optional, Tuple
+import uuid
+
+from dane.provenance import obtain_software_versions
+from models import MediaFile, StageProvenance
+from resource_util import get_resource_usage_since, take_resource_snapshot
+from manifest_util import ManifestRecorder, get_run_id
+from writer_util import get_file_writer
+
+
+logger = logging.getLogger(__name__)
+JOB_FILE = "job.json"
+SHOTS_FILE = "shots.json"  # written once all ranges are detected
+DETECT = "detect"
+KEYFRAMES = "keyframes"
+POLL_INTERVAL_S = 0.5
+
+
+@dataclass
+class TimeRange:
+    index: int
+    start_frame: int
+    end_frame: int  # exclusive, -1: until the end of the video
+
+
+# everything a process needs to work on the time ranges of an asset
+@dataclass
+class SplitJob:
+    source_id: str
+    file_path: str  # must be readable by all processes working on the job
+    output_dir: str
+    extract_keyframes: bool
+    overlap_frames: int
+    claim_timeout_s: int
+    ranges: List[TimeRange]
+    run_id: str = ""  # tags the files the helpers record, see ManifestRecorder
+
+    @classmethod
+    def from_json(cls, data: dict) -> "SplitJob":
+        return cls(**{**data, "ranges": [TimeRange(**r) for r in data["ranges"]]})
+
+
+class TimeRangeJob:
+    """Job dir (on storage shared by all worker nodes) through which the time ranges
+    of an asset are processed by any number of processes. A process claims a task
+    (detecting the shots of a range, or extracting its keyframes) by creating the
+    task's claim file and refreshes it while working; a claim that is not refreshed
+    within claim_timeout_s (e.g. its node died) is taken over. Results are written
+    as JSON, atomically, so a task is done once its result file exists"""
+
+    def __init__(self, job_dir: str):
+        self.job_dir = job_dir
+        with open(os.path.join(job_dir, JOB_FILE)) as f:
+            self.job = SplitJob.from_json(json.load(f))
+
+    @classmethod
+    def create(cls, job_dir: str, job: SplitJob) -> "TimeRangeJob":
+        if os.path.exists(job_dir):
+            logger.warning(f"Removing the time range job left behind in {job_dir}")
+            shutil.rmtree(job_dir)
+        os.makedirs(job_dir)
+        _write_json(os.path.join(job_dir, JOB_FILE), asdict(job))
+        return cls(job_dir)
+
+    # the keyframes of a range can only be extracted once all shots are known
+    def get_available_kinds(self) -> List[str]:
+        if self.job.extract_keyframes and os.path.exists(self._path(SHOTS_FILE)):
+            return [DETECT, KEYFRAMES]
+        return [DETECT]
+
+    def claim_next(self, kinds: List[str]) -> Optional[Tuple[str, int]]:
+        for kind in kinds:
+            for time_range in self.job.ranges:
+                if self.get_result(kind, time_range.index) is None and self._claim(
+                    kind, time_range.index
+                ):
+                    return kind, time_range.index
+        return None
+
+    def get_result(self, kind: str, index: int) -> Optional[dict]:
+        try:
+            with open(self._path(f"{kind}_{index}.json")) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    # all results of this kind (ordered by range), None if some are missing
+    def get_results(self, kind: str) -> Optional[List[dict]]:
+        results = [self.get_result(kind, r.index) for r in self.job.ranges]
+        return None if None in results else results  # type: ignore
+
+    def get_shots(self) -> Tuple[List[Tuple[int, int]], float]:
+        with open(self._path(SHOTS_FILE)) as f:
+            shots = json.load(f)
+        return [(start, end) for start, end in shots["shots"]], shots["frame_rate"]
+
+    def set_shots(self, shots: List[Tuple[int, int]], frame_rate: float) -> None:
+        _write_json(self._path(SHOTS_FILE), {"shots": shots, "frame_rate": frame_rate})
+
+    # runs a claimed task, failures are reported as the task's result
+    def process(self, kind: str, index: int) -> None:
+        time_range = self.job.ranges[index]
+        logger.info(f"Processing {kind} of time range {time_range}")
+        with self.keep_alive(f"{kind}_{index}.claim"):
+            try:
+                if kind == DETECT:
+                    result = _detect_range(self.job, time_range)
+                else:
+                    shots, _ = self.get_shots()
+                    result = _extract_range_keyframes(self.job, time_range, shots)
+            except Exception as e:
+                logger.exception(f"Failed to process {kind} of {time_range}")
+                result = {"error": f"{type(e).__name__}: {e}"}
+            _write_json(self._path(f"{kind}_{index}.json"), result)
+
+    # processes the tasks of this kind (also) in this process, until all are done
+    def complete_all(self, kind: str) -> List[dict]:
+        while True:
+            results = self.get_results(kind)
+            if results is not None:
+                return results
+            task = self.claim_next([kind])
+            if task:
+                self.process(*task)
+            else:  # waiting for the tasks claimed by other processes
+                sleep(POLL_INTERVAL_S)
+
+    # the process that created the job refreshes the job file, until it is done
+    def is_abandoned(self) -> bool:
+        job_file_age_s = time() - os.path.getmtime(self._path(JOB_FILE))
+        return job_file_age_s > self.job.claim_timeout_s
+
+    # refreshes (the mtime of) a claim or the job file while processing
+    @contextmanager
+    def keep_alive(self, file_name: str) -> Iterator[None]:
+        path = self._path(file_name)
+        done = threading.Event()
+
+        def refresh():
+            while not done.wait(self.job.claim_timeout_s / 4):
+                try:
+                    os.utime(path)
+                except FileNotFoundError:
+                    break
+
+        refresher = threading.Thread(target=refresh, daemon=True)
+        refresher.start()
+        try:
+            yield
+        finally:
+            done.set()
+            refresher.join()
+
+    def _path(self, file_name: str) -> str:
+        return os.path.join(self.job_dir, file_name)
+
+    def _claim(self, kind: str, index: int) -> bool:
+        claim_file = self._path(f"{kind}_{index}.claim")
+        for _ in range(2):  # 2nd attempt after removing a stale claim
+            try:
+                fd = os.open(claim_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                if not self._remove_stale_claim(claim_file):
+                    return False
+                continue
+            except FileNotFoundError:  # the job is done and was cleaned up
+                return False
+            with os.fdopen(fd, "w") as f:
+                f.write(f"{socket.gethostname()}:{os.getpid()}")
+            return True
+        return False
+
+    # the rename succeeds for only one of the processes trying to take over. NOTE:
+    # if the owner turns out to be alive after all, both write the (same) result
+    def _remove_stale_claim(self, claim_file: str) -> bool:
+        try:
+            if time() - os.path.getmtime(claim_file) < self.job.claim_timeout_s:
+                return False
+            stale_file = f"{claim_file}.{uuid.uuid4().hex}.stale"
+            os.rename(claim_file, stale_file)
+        except FileNotFoundError:
+            return False
+        logger.warning(f"Taking over the stale claim {claim_file}")
+        os.remove(stale_file)
+        return True
+
+
+# only videos of at least min_duration_ms are split (0: never)
+def should_split(media_file: MediaFile, min_duration_ms: int) -> bool:
+    return (
+        media_file.has_video
+        and media_file.fps > 0
+        and min_duration_ms > 0
+        and media_file.duration_ms >= min_duration_ms
+    )
+
+
+def plan_time_ranges(
+    frame_count: int, frame_rate: float, range_duration_ms: int
+) -> List[TimeRange]:
+    range_frames = max(round(range_duration_ms * frame_rate / 1000), 1)
+    starts = list(range(0, max(frame_count, 1), range_frames))
+    ends = starts[1:] + [-1]  # the last range runs until the video ends
+    return [
+        TimeRange(i, start, end) for i, (start, end) in enumerate(zip(starts, ends))
+    ]
+
+
+# the union of the cuts of all ranges delimits the shots (a shot crossing a range
+# boundary is not cut in two). As when detecting on the whole video: no cuts, no shots
+def merge_cuts(
+    detect_results: List[dict],
+) -> List[Tuple[int, int]]:
+    cuts = sorted({cut for result in detect_results for cut in result["cuts"]})
+    if not cuts:
+        return []
+    end_frame = detect_results[-1]["end_frame"]
+    return list(zip([0] + cuts, cuts + [end_frame]))
+
+
+# splits the video in time ranges, which are processed by this process and any
+# helper (see run_helper) sharing jobs_dir, then merges the results into the output
+# of scenedetect_util.run()
+def run(
+    media_file: MediaFile,
+    output_dir: str,
+    extract_keyframes: bool,
+    jobs_dir: str,
+    range_duration_ms: int,
+    overlap_ms: int,
+    claim_timeout_s: int,
+) -> StageProvenance:
+    import scenedetect_util
+
+    start_time = time()
+    resource_snapshot = take_resource_snapshot()
+    frame_count = media_file.frame_count
+    if frame_count <= 0:
+        frame_count = round(media_file.duration_ms * media_file.fps / 1000)
+    ranges = plan_time_ranges(frame_count, media_file.fps, range_duration_ms)
+    logger.info(f"Splitting {media_file.file_path} into {len(ranges)} time ranges")
+
+    job_dir = os.path.join(jobs_dir, media_file.source_id)
+    job = TimeRangeJob.create(
+        job_dir,
+        SplitJob(
+            media_file.source_id,
+            os.path.abspath(media_file.file_path),
+            os.path.abspath(output_dir),
+            extract_keyframes,
+            round(overlap_ms * media_file.fps / 1000),
+            claim_timeout_s,
+            ranges,
+            get_run_id(output_dir),
+        ),
+    )
+    try:
+        with job.keep_alive(JOB_FILE):
+            results = job.complete_all(DETECT)
+            _raise_on_failed_tasks(DETECT, results)
+            shots = merge_cuts(results)
+            frame_rate = results[0]["frame_rate"]
+            job.set_shots(shots, frame_rate)
+            keyframe_timestamps = None
+            if extract_keyframes:
+                keyframe_results = job.complete_all(KEYFRAMES)
+                _raise_on_failed_tasks(KEYFRAMES, keyframe_results)
+                keyframe_timestamps = [
+                    ts for result in keyframe_results for ts in result["timestamps"]
+                ]
+                results += keyframe_results
+    finally:
+        shutil.rmtree(job_dir, ignore_errors=True)
+
+    recorder = ManifestRecorder(output_dir, "scenedetect")
+    output_data = scenedetect_util.write_metadata(
+        output_dir, shots, frame_rate, keyframe_timestamps, recorder
+    )
+    recorder.save()
+    output_data["frames_decoded"] = sum(
+        result["provenance"]["output_data"].get("frames_decoded", 0)
+        for result in results
+    )
+    return StageProvenance(
+        activity_name="Python Scenedetect",
+        activity_description="Shot detection & keyframe extraction, per time range",
+        start_time_unix=start_time,
+        processing_time_ms=(time() - start_time) * 1000,
+        parameters={
+            "time_ranges": len(ranges),
+            "range_duration_ms": range_duration_ms,
+            "overlap_ms": overlap_ms,
+        },
+        software_version=obtain_software_versions(["scenedetect"]),
+        input_data={"input_file": media_file.file_path},
+        output_data=output_data,
+        steps=[StageProvenance.from_json(result["provenance"]) for result in results],
+        resource_usage=get_resource_usage_since(resource_snapshot),
+    )
+
+
+# works on the time ranges of any job in jobs_dir, until stop is set (or nothing
+# was left to do for max_idle_s)
+def run_helper(
+    jobs_dir: str,
+    stop: Optional[threading.Event] = None,
+    max_idle_s: float = -1,
+) -> None:
+    logger.info(f"Helping with the time ranges of the jobs in {jobs_dir}")
+    idle_since = time()
+    while not (stop and stop.is_set()):
+        if _help_with_next_task(jobs_dir):
+            idle_since = time()
+        elif 0 <= max_idle_s < time() - idle_since:
+            break
+        else:
+            sleep(POLL_INTERVAL_S)
+
+
+def start_helper_processes(
+    count: int, jobs_dir: str, log_level: int
+) -> List[BaseProcess]:
+    context = multiprocessing.get_context("spawn")
+    helpers: List[BaseProcess] = [
+        context.Process(
+            target=_run_helper_process, args=(jobs_dir, log_level), daemon=True
+        )
+        for _ in range(count)
+    ]
+    for helper in helpers:
+        helper.start()
+    return helpers
+
+
+def _run_helper_process(jobs_dir: str, log_level: int) -> None:
+    from base_util import LOG_FORMAT
+
+    logging.basicConfig(stream=sys.stdout, format=LOG_FORMAT)
+    logging.getLogger().setLevel(log_level)
+    run_helper(jobs_dir)
+
+
+def _help_with_next_task(jobs_dir: str) -> bool:
+    try:
+        job_names = sorted(os.listdir(jobs_dir))
+    except FileNotFoundError:
+        return False
+    for job_name in job_names:
+        job_dir = os.path.join(jobs_dir, job_name)
+        try:
+            job = TimeRangeJob(job_dir)
+            if job.is_abandoned():
+                logger.warning(f"Removing abandoned time range job {job_dir}")
+                shutil.rmtree(job_dir, ignore_errors=True)
+                continue
+            task = job.claim_next(job.get_available_kinds())
+            if task:
+                job.process(*task)
+                return True
+        except (FileNotFoundError, ValueError):  # e.g. done and cleaned up
+            logger.debug(f"Skipping time range job {job_name}")
+    return False
+
+
+def _detect_range(job: SplitJob, time_range: TimeRange) -> dict:
+    import scenedetect_util
+
+    start_time = time()
+    resource_snapshot = take_resource_snapshot()
+    cuts, end_frame, frame_rate = scenedetect_util.detect_cuts(
+        job.file_path, time_range.start_frame, time_range.end_frame, job.overlap_frames
+    )
+    return {
+        "cuts": cuts,
+        "end_frame": end_frame,
+        "frame_rate": frame_rate,
+        "provenance": _to_range_provenance(
+            "Shot detection in a time range",
+            job,
+            time_range,
+            {
+                "cuts": len(cuts),
+                "frames_decoded": end_frame
+                - max(time_range.start_frame - job.overlap_frames, 0),
+            },
+            start_time,
+            resource_snapshot,
+        ).to_json(),
+    }
+
+
+# extracts the keyframes of the shots starting within the range
+def _extract_range_keyframes(
+    job: SplitJob, time_range: TimeRange, shots: List[Tuple[int, int]]
+) -> dict:
+    import scenedetect_util
+
+    start_time = time()
+    resource_snapshot = take_resource_snapshot()
+    range_shots = [
+        shot
+        for shot in shots
+        if time_range.start_frame <= shot[0]
+        and (time_range.end_frame < 0 or shot[0] < time_range.end_frame)
+    ]
+    recorder = ManifestRecorder(job.output_dir, "scenedetect", job.run_id)
+    with get_file_writer(recorder) as writer:
+        timestamps = scenedetect_util.extract_keyframes(
+            job.file_path, range_shots, job.output_dir, writer
+        )
+    return {
+        "timestamps": timestamps,
+        "provenance": _to_range_provenance(
+            "Keyframe extraction in a time range",
+            job,
+            time_range,
+            {"keyframes": len(timestamps), "file_writer": asdict(writer.stats)},
+            start_time,
+            resource_snapshot,
+        ).to_json(),
+    }
+
+
+def _to_range_provenance(
+    description: str,
+    job: SplitJob,
+    time_range: TimeRange,
+    output_data: dict,
+    start_time: float,
+    resource_snapshot,
+) -> StageProvenance:
+    return StageProvenance(
+        activity_name="Python Scenedetect (time range)",
+        activity_description=description,
+        start_time_unix=start_time,
+        processing_time_ms=(time() - start_time) * 1000,
+        software_version=obtain_software_versions(["scenedetect"]),
+        input_data={"input_file": job.file_path, **asdict(time_range)},
+        output_data={**output_data, "host": socket.gethostname(), "pid": os.getpid()},
+        resource_usage=get_resource_usage_since(resource_snapshot),
+    )
+
+
+def _raise_on_failed_tasks(kind: str, results: List[dict]) -> None:
+    errors = [result["error"] for result in results if "error" in result]
+    if errors:
+        import scenedetect_util
+
+        logger.error(f"{len(errors)} time ranges failed ({kind}): {errors}")
+        raise scenedetect_util.ScenedetectFailureException()
+
+
+def _write_json(path: str, data: dict) -> None:
+    tmp_file = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_file, "w") as f:
+        json.dump(data, f)
+    os.replace(tmp_file, path)
@@ -0,0 +1,74 @@
+import json
+import queue
+import time
+from types import SimpleNamespace
+from typing import Dict, List, Optional
+
+
+# stand-in for a pika BlockingConnection + channel, as used by DANE's base_worker:
+# callbacks added from other threads only run while the consumer thread is polling
+class FakeChannel:
+    def __init__(self, bodies: list, arrival_times: Optional[List[float]] = None):
+        self.prefetch_count = 1
+        self.acked: list = []
+        self.replies: list = []
+        self.poll_times: list = []  # when the consumer thread handled connection events
+        # per delivery tag: when the message was queued, delivered & (n)acked
+        self.arrived_at = dict(enumerate(arrival_times or [0.0] * len(bodies), 1))
+        self.delivered_at: Dict[int, float] = {}
+        self.acked_at: Dict[int, float] = {}
+        self.nacked: list = []
+        self.responses: Dict[int, dict] = {}  # the reply to each delivery
+        self._messages = list(enumerate(bodies, start=1))
+        self._unacked = 0
+        self._callbacks: queue.Queue = queue.Queue()
+
+    def basic_qos(self, prefetch_count: int):
+        self.prefetch_count = prefetch_count
+
+    def consume(self, queue_name: str, inactivity_timeout: float = 1):
+        while True:
+            self._process_events(inactivity_timeout)
+            if (
+                self._messages
+                and self._unacked < self.prefetch_count
+                and self.arrived_at[self._messages[0][0]] <= time.time()
+            ):
+                delivery_tag, body = self._messages.pop(0)
+                self._unacked += 1
+                self.delivered_at[delivery_tag] = time.time()
+                method = SimpleNamespace(delivery_tag=delivery_tag)
+                props = SimpleNamespace(
+                    reply_to="reply-queue", correlation_id=str(delivery_tag)
+                )
+                yield method, props, body
+            else:
+                yield None, None, None
+
+    def _process_events(self, timeout: float):
+        self.poll_times.append(time.time())
+        try:
+            self._callbacks.get(timeout=timeout)()
+        except queue.Empty:
+            pass
+
+    def basic_publish(self, exchange, routing_key, properties, body):
+        self.replies.append(body)
+        self.responses[int(properties.correlation_id)] = json.loads(body)
+
+    def basic_ack(self, delivery_tag):
+        self._unacked -= 1
+        self.acked.append(delivery_tag)
+        self.acked_at[delivery_tag] = time.time()
+
+    def basic_nack(self, delivery_tag, **kwargs):
+        self._unacked -= 1
+        self.nacked.append(delivery_tag)
+
+
+class FakeConnection:
+    def __init__(self, channel: FakeChannel):
+        self.channel = channel
+
+    def add_callback_threadsafe(self, callback):
+        self.channel._callbacks.put(callback)
@@ -0,0 +1,74 @@
+import io
+import threading
+import time
+import uuid
+
+from botocore.exceptions import ClientError
+
+
+MIN_PART_SIZE = 5 * 1024 * 1024
+
+
+# in-memory stand-in for the boto3 S3 client calls this worker uses
+class FakeS3Client:
+    def __init__(self, part_delay_s: float = 0, fail_part_number: int = -1):
+        self.objects: dict = {}  # (bucket, key) -> bytes
+        self.uploads: dict = {}  # upload_id -> {part_number: bytes}
+        self.aborted: list = []
+        self.part_delay_s = part_delay_s  # to simulate network latency
+        self.fail_part_number = fail_part_number
+        self.max_parallel_parts = 0
+        self._parallel_parts = 0
+        self._lock = threading.Lock()
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        self.objects[(Bucket, Key)] = bytes(Body)
+        return {}
+
+    # Range: "bytes=<first>-<last>" (inclusive), as the worker requests it
+    def get_object(self, Bucket, Key, Range=None):
+        if (Bucket, Key) not in self.objects:
+            raise ClientError({"Error": {"Code": "NoSuchKey"}}, "GetObject")
+        data = self.objects[(Bucket, Key)]
+        if Range:
+            first, last = Range.split("=")[1].split("-")
+            data = data[int(first) : int(last) + 1]
+        return {"Body": io.BytesIO(data), "ContentLength": len(data)}
+
+    def upload_file(self, Filename, Bucket, Key, Config=None):
+        with open(Filename, "rb") as f:
+            self.objects[(Bucket, Key)] = f.read()
+
+    def create_multipart_upload(self, Bucket, Key):
+        upload_id = str(uuid.uuid4())
+        self.uploads[upload_id] = {}
+        return {"UploadId": upload_id}
+
+    def upload_part(self, Bucket, Key, PartNumber, UploadId, Body):
+        with self._lock:
+            self._parallel_parts += 1
+            self.max_parallel_parts = max(self.max_parallel_parts, self._parallel_parts)
+        try:
+            time.sleep(self.part_delay_s)
+            if PartNumber == self.fail_part_number:
+                raise ClientError({"Error": {"Code": "InternalError"}}, "UploadPart")
+            self.uploads[UploadId][PartNumber] = bytes(Body)
+            return {"ETag": f'"{PartNumber}"'}
+        finally:
+            with self._lock:
+                self._parallel_parts -= 1
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        parts = self.uploads.pop(UploadId)
+        numbers = [p["PartNumber"] for p in MultipartUpload["Parts"]]
+        assert numbers == sorted(parts.keys()), "parts missing or out of order"
+        for n in numbers[:-1]:
+            if len(parts[n]) < MIN_PART_SIZE:
+                raise ClientError({"Error": {"Code": "EntityTooSmall"}}, "Complete")
+        self.objects[(Bucket, Key)] = b"".join(parts[n] for n in numbers)
+        return {}
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self.uploads.pop(UploadId, None)
+        self.aborted.append(Key)
+        return {}
@@ -0,0 +1,204 @@
+"""Checks each spectrogram engine (spectrogram.SPECTROGRAM_ENGINES) against the golden
+output in tests/data/spectrograms and measures its time per window & peak memory.
+
+tests/unit/test_spectrogram.py only checks the output. The time & memory checks
+depend on the machine (and its load), so they're run separately, from the root of
+this repo (add --update-baseline after a deliberate change in the speed or memory
+use of an engine):
+
+    python -m tests.unit.spectrogram_harness [--update-baseline]
+"""
+
+from argparse import ArgumentParser
+from dataclasses import asdict, dataclass
+import json
+import os
+import sys
+import tempfile
+from time import perf_counter
+import tracemalloc
+from typing import Dict, List
+
+import numpy as np
+
+from media_file_util import get_end_frame, get_start_frame
+import spectrogram
+
+
+DATA_DIR = os.path.normpath(os.path.join(os.path.dirname(__file__), "..", "data"))
+TEST_FILE = os.path.join(DATA_DIR, "mp4s", "test.mp4")
+GOLDEN_DIR = os.path.join(DATA_DIR, "spectrograms", "test_example_output")
+BASELINE_FILE = os.path.join(DATA_DIR, "spectrograms", "engine_baseline.json")
+# the settings the golden output was generated with
+KEYFRAME_TIMESTAMPS = [500, 1500, 2500]
+SAMPLE_RATE = 24000
+WINDOW_SIZE_MS = 1000
+# max. absolute difference with the golden (z-normalized) spectrograms. The audio
+# decoded by different ffmpeg versions differs slightly, which already changes the
+# reference output by up to ~3e-4
+TOLERANCE = 1e-3
+# timings vary between machines: the time per window of an engine is compared
+# relative to the reference engine, measured in the same run
+TIME_SLACK = 1.5  # fail if an engine gets 50% slower than its baseline
+MEMORY_SLACK = 1.5
+
+
+@dataclass
+class EngineResult:
+    engine: str
+    max_abs_diff: float  # compared to the golden output
+    ms_per_window: float
+    relative_time: float  # ms_per_window / that of the reference engine
+    peak_memory_bytes: int  # allocated while computing a window (tracemalloc)
+
+
+def load_golden() -> List[np.ndarray]:
+    return [
+        np.load(os.path.join(GOLDEN_DIR, f"{i}.npz"), allow_pickle=True)[
+            "arr_0"
+        ].item()["audio"]
+        for i in range(len(KEYFRAME_TIMESTAMPS))
+    ]
+
+
+# runs the whole extraction (from the media file to .npz files) with this engine
+def extract_spectrograms(engine: str, output_dir: str) -> List[np.ndarray]:
+    fns = spectrogram.extract_audio_spectrograms(
+        media_file=TEST_FILE,
+        keyframe_timestamps=KEYFRAME_TIMESTAMPS,
+        locations={"spectrograms": output_dir},
+        sample_rate=SAMPLE_RATE,
+        window_size_ms=WINDOW_SIZE_MS,
+        generate_images=False,
+        extract_audio=False,
+        engine=engine,
+    )
+    return [
+        np.load(fn, allow_pickle=True)["arr_0"].item()["audio"]
+        for fn in fns["spectrograms"]
+    ]
+
+
+def get_max_abs_diff(spectrograms: List[np.ndarray], golden: List[np.ndarray]):
+    assert len(spectrograms) == len(golden), "Wrong number of spectrograms"
+    for spec, golden_spec in zip(spectrograms, golden):
+        assert spec.shape == golden_spec.shape, f"Wrong shape {spec.shape}"
+        assert spec.dtype == golden_spec.dtype, f"Wrong dtype {spec.dtype}"
+    return max(
+        float(np.max(np.abs(spec - golden_spec)))
+        for spec, golden_spec in zip(spectrograms, golden)
+    )
+
+
+# returns the best time per window over the repeats & the peak memory of a window
+def measure_engine(engine: str, windows: List[np.ndarray], repeats: int):
+    get_spectrogram = spectrogram.SPECTROGRAM_ENGINES[engine]
+    get_spectrogram(windows[0], SAMPLE_RATE)  # warm up (imports, caches)
+    best_s = float("inf")
+    for _ in range(repeats):
+        start = perf_counter()
+        for window in windows:
+            get_spectrogram(window, SAMPLE_RATE)
+        best_s = min(best_s, perf_counter() - start)
+
+    tracemalloc.start()
+    try:
+        get_spectrogram(windows[0], SAMPLE_RATE)
+        _, peak_memory = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return best_s * 1000 / len(windows), peak_memory
+
+
+def run_harness(repeats: int = 10) -> Dict[str, EngineResult]:
+    golden = load_golden()
+    raw_audio = spectrogram.get_raw_audio(TEST_FILE, SAMPLE_RATE)
+    windows = [
+        raw_audio[
+            get_start_frame(ms, WINDOW_SIZE_MS, SAMPLE_RATE) : get_end_frame(
+                ms, WINDOW_SIZE_MS, SAMPLE_RATE
+            )
+        ]
+        for ms in KEYFRAME_TIMESTAMPS
+    ]
+    results = {}
+    with tempfile.TemporaryDirectory() as output_dir:
+        for engine in spectrogram.SPECTROGRAM_ENGINES:
+            engine_dir = os.path.join(output_dir, engine)
+            os.makedirs(engine_dir)
+            max_abs_diff = get_max_abs_diff(
+                extract_spectrograms(engine, engine_dir), golden
+            )
+            ms_per_window, peak_memory = measure_engine(engine, windows, repeats)
+            results[engine] = EngineResult(
+                engine, max_abs_diff, ms_per_window, 1.0, peak_memory
+            )
+    reference_ms = results[spectrogram.REFERENCE_ENGINE].ms_per_window
+    for result in results.values():
+        result.relative_time = result.ms_per_window / reference_ms
+    return results
+
+
+def load_baseline() -> Dict[str, dict]:
+    with open(BASELINE_FILE) as f:
+        return json.load(f)
+
+
+# returns a message per check that failed (empty: all engines are fine)
+def check_results(
+    results: Dict[str, EngineResult], baseline: Dict[str, dict]
+) -> List[str]:
+    failures = []
+    for engine, result in results.items():
+        if result.max_abs_diff > TOLERANCE:
+            failures.append(
+                f"{engine}: differs {result.max_abs_diff} from the golden output"
+            )
+        if engine not in baseline:
+            failures.append(f"{engine}: no baseline, run with --update-baseline")
+            continue
+        if result.relative_time > baseline[engine]["relative_time"] * TIME_SLACK:
+            failures.append(
+                f"{engine}: {result.relative_time:.2f}x the reference time, "
+                f"baseline {baseline[engine]['relative_time']:.2f}x"
+            )
+        if (
+            result.peak_memory_bytes
+            > baseline[engine]["peak_memory_bytes"] * MEMORY_SLACK
+        ):
+            failures.append(
+                f"{engine}: peak memory {result.peak_memory_bytes} bytes, "
+                f"baseline {baseline[engine]['peak_memory_bytes']}"
+            )
+    return failures
+
+
+def main() -> int:
+    parser = ArgumentParser(description="Spectrogram engine harness")
+    parser.add_argument("--repeats", type=int, default=10)
+    parser.add_argument("--update-baseline", action="store_true")
+    args = parser.parse_args()
+
+    results = run_harness(args.repeats)
+    print(
+        f"{'engine':<24}{'max diff':>10}{'ms/window':>11}{'relative':>10}{'peak KB':>9}"
+    )
+    for r in results.values():
+        print(
+            f"{r.engine:<24}{r.max_abs_diff:>10.2e}{r.ms_per_window:>11.2f}"
+            f"{r.relative_time:>10.2f}{r.peak_memory_bytes // 1024:>9}"
+        )
+    if args.update_baseline:
+        with open(BASELINE_FILE, "w") as f:
+            json.dump({e: asdict(r) for e, r in results.items()}, f, indent=4)
+            f.write("\n")
+        print(f"Wrote {BASELINE_FILE}")
+        return 0
+    failures = check_results(results, load_baseline())
+    for failure in failures:
+        print(failure)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,60 @@
+import os
+import shutil
+
+import pytest
+
+from archive_util import Compression, get_compression, open_archive, write_archive
+from io_util import get_output_file_name
+
+
+@pytest.fixture
+def output_dirs(tmp_path):
+    dirs = []
+    for name, data in [
+        ("keyframes", os.urandom(100000)),  # like jpgs: incompressible
+        ("metadata", b"[(0, 2000), (2000, 4000)]" * 4000),
+    ]:
+        output_dir = os.path.join(tmp_path, "output", name)
+        os.makedirs(output_dir)
+        with open(os.path.join(output_dir, f"{name}.bin"), "wb") as f:
+            f.write(data)
+        dirs.append(output_dir)
+    return dirs
+
+
+@pytest.mark.parametrize("compression", list(Compression))
+def test_write_archive(compression, output_dirs, tmp_path):
+    if compression == Compression.ZSTD and shutil.which("zstd") is None:
+        pytest.skip("zstd not installed")
+    archive_path = os.path.join(tmp_path, get_output_file_name("test", compression))
+    with open(archive_path, "wb") as f:
+        stats = write_archive(f, output_dirs, compression)
+
+    assert stats.file_count == 2
+    assert stats.uncompressed_bytes == 200000
+    assert stats.compressed_bytes == os.path.getsize(archive_path)
+    assert stats.compression_time_ms >= 0
+    if compression == Compression.NONE:
+        assert stats.compression_ratio < 1  # tar headers only
+    else:
+        assert stats.compression_ratio > 1.5
+    with open_archive(archive_path) as tar:
+        with open(os.path.join(output_dirs[1], "metadata.bin"), "rb") as f:
+            assert tar.extractfile("metadata/metadata.bin").read() == f.read()
+
+
+@pytest.mark.parametrize(
+    "archive_name, compression",
+    [
+        ("visxp_prep__test.tar", Compression.NONE),
+        ("visxp_prep__test.tar.gz", Compression.GZIP),
+        ("s3://bucket/assets/test/visxp_prep__test.tar.zst", Compression.ZSTD),
+    ],
+)
+def test_get_compression(archive_name, compression):
+    assert get_compression(archive_name) == compression
+
+
+def test_get_compression_unknown():
+    with pytest.raises(ValueError):
+        get_compression("visxp_prep__test.zip")
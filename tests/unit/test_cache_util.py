@@ -0,0 +1,99 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+from cache_util import REFS_DIR, InputCache
+
+# acquires argv[2] from the cache in argv[1], then waits to be killed
+REF_HOLDER = """
+import sys, time
+from cache_util import InputCache
+cache = InputCache(sys.argv[1], quota_bytes=250, verify_checksum=False)
+assert cache.acquire(sys.argv[2])
+print("acquired", flush=True)
+time.sleep(60)
+"""
+
+
+def add_file(cache: InputCache, name: str, size: int) -> str:
+    file_path = os.path.join(cache.cache_dir, name)
+    with open(file_path, "wb") as f:
+        f.write(os.urandom(size))
+    cache.add(file_path, "")
+    return file_path
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return InputCache(str(tmp_path), quota_bytes=250, verify_checksum=True)
+
+
+def test_lru_eviction(cache):
+    a = add_file(cache, "a.mp4", 100)
+    b = add_file(cache, "b.mp4", 100)
+    cache.release(a)
+    cache.release(b)
+    assert cache.acquire(a)  # a is now used more recently than b
+    cache.release(a)
+
+    add_file(cache, "c.mp4", 100)  # over quota: b goes
+    assert os.path.exists(a)
+    assert not os.path.exists(b)
+    assert cache.get_stats() == {
+        "hits": 1,
+        "misses": 3,
+        "evictions": 1,
+        "files": 2,
+        "size_bytes": 200,
+    }
+
+
+def test_referenced_files_are_not_evicted(cache):
+    a = add_file(cache, "a.mp4", 200)
+    b = add_file(cache, "b.mp4", 200)
+    assert os.path.exists(a) and os.path.exists(b)  # over quota, but both in use
+    cache.release(b)
+    assert os.path.exists(a) and not os.path.exists(b)
+
+
+def test_references_of_other_processes(cache):
+    a = add_file(cache, "a.mp4", 200)
+    cache.release(a)
+    # another process (e.g. in another container) uses a, until it's killed
+    process = subprocess.Popen(
+        [sys.executable, "-c", REF_HOLDER, cache.cache_dir, a],
+        stdout=subprocess.PIPE,
+        cwd=os.path.dirname(os.path.dirname(os.path.dirname(__file__))),
+    )
+    assert process.stdout.readline() == b"acquired\n"
+    b = add_file(cache, "b.mp4", 100)
+    cache.release(b)
+    assert os.path.exists(a)  # over quota, but in use
+
+    process.kill()
+    process.wait()
+    add_file(cache, "c.mp4", 100)
+    assert not os.path.exists(a)
+    # only the reference of this process to c is left
+    assert len(os.listdir(os.path.join(cache.cache_dir, REFS_DIR))) == 1
+
+
+@pytest.mark.parametrize(
+    "corrupt, size_matches",
+    [(b"", False), (b"x" * 100, True)],  # truncated, other content of the same size
+)
+def test_invalid_files_are_not_used(corrupt, size_matches, cache):
+    a = add_file(cache, "a.mp4", 100)
+    with open(a, "wb") as f:
+        f.write(corrupt)
+    assert cache.contains(a) == size_matches  # contains() only checks the size
+    assert cache.acquire(a) is None
+    assert not os.path.exists(a)
+
+
+def test_lock_is_reentrant(cache):
+    with cache.lock("a.mp4"):
+        with cache.lock("a.mp4"):
+            pass
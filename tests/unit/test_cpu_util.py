@@ -0,0 +1,37 @@
+import os
+
+import pytest
+
+import cpu_util
+
+
+@pytest.fixture
+def clean_env(monkeypatch):
+    for env_var in [cpu_util.CPU_THREADS_ENV_VAR] + cpu_util.BLAS_THREADS_ENV_VARS:
+        monkeypatch.delenv(env_var, raising=False)
+
+
+@pytest.mark.parametrize(
+    "threads, ffmpeg_args, ffmpeg_options",
+    [
+        (0, [], {}),
+        (-1, [], {}),
+        (2, ["-threads", "2"], {"threads": 2}),
+    ],
+)
+def test_apply_cpu_budget(clean_env, threads, ffmpeg_args, ffmpeg_options):
+    cpu_util.apply_cpu_budget(threads)
+    assert cpu_util.get_cpu_threads() == max(threads, 0)
+    assert cpu_util.get_ffmpeg_thread_args() == ffmpeg_args
+    assert cpu_util.get_ffmpeg_input_options() == ffmpeg_options
+    for env_var in cpu_util.BLAS_THREADS_ENV_VARS:
+        assert os.environ.get(env_var) == (str(threads) if threads > 0 else None)
+
+
+def test_apply_cpu_affinity(clean_env):
+    cpus = sorted(os.sched_getaffinity(0))
+    try:
+        cpu_util.apply_cpu_budget(0, cpus[:1])
+        assert os.sched_getaffinity(0) == {cpus[0]}
+    finally:
+        os.sched_setaffinity(0, cpus)
@@ -0,0 +1,104 @@
+import json
+import os
+
+import cv2  # type: ignore
+import numpy as np
+import pytest
+
+import dedup_util
+from metadata_util import get_shots_file, read_shot_table, to_shot_table
+from models import OutputType, ScenedetectOutput
+
+BLACK = -1
+
+
+# random blocks per pattern, with a bit of noise (e.g. a flash or jitter). Pattern
+# BLACK is a black frame
+def make_keyframe(pattern: int, noise: int = 0) -> np.ndarray:
+    if pattern == BLACK:
+        return np.zeros((240, 320), dtype=np.uint8)
+    blocks = np.random.default_rng(pattern).integers(0, 256, (6, 8))
+    image = cv2.resize(
+        blocks.astype(np.uint8), (320, 240), interpolation=cv2.INTER_NEAREST
+    )
+    if noise:
+        image = image + np.random.default_rng(noise).normal(noise, 2, image.shape)
+    return np.clip(image, 0, 255).astype(np.uint8)
+
+
+@pytest.mark.parametrize(
+    "hashes, max_distance, duplicates",
+    [
+        ([0b0, 0b1, 0b11, 0b111], 2, {20: 10, 30: 10}),  # compared to the first
+        ([0b0, 0b1, 0b11, 0b111], 0, {}),
+        ([0b0, 0b1111, 0b0], 1, {}),  # only neighbours are duplicates
+        ([0b0, 0b0, 0b1111, 0b1111], 0, {20: 10, 40: 30}),
+    ],
+)
+def test_find_duplicates(hashes, max_distance, duplicates):
+    timestamps = [10 * (i + 1) for i in range(len(hashes))]
+    assert (
+        dedup_util.find_duplicates(
+            timestamps, np.array(hashes, dtype=np.uint64), max_distance
+        )
+        == duplicates
+    )
+
+
+# writes the keyframes {timestamp: (pattern, noise)} & their timestamps
+def write_output(output_dir, keyframes: dict):
+    keyframe_dir = output_dir / OutputType.KEYFRAMES.value
+    metadata_dir = output_dir / OutputType.METADATA.value
+    keyframe_dir.mkdir(parents=True)
+    metadata_dir.mkdir()
+    for ts, (pattern, noise) in keyframes.items():
+        cv2.imwrite(str(keyframe_dir / f"{ts}.jpg"), make_keyframe(pattern, noise))
+    timestamps_file = metadata_dir / ScenedetectOutput.KEYFRAME_TIMESTAMPS.value
+    timestamps_file.write_text(str(list(keyframes)))
+    return keyframe_dir, timestamps_file
+
+
+@pytest.mark.parametrize("mode", ["mark", "drop"])
+def test_run(tmp_path, mode):
+    # a flash of the same shot and two different shots
+    keyframes = {1000: (0, 0), 2000: (0, 10), 3000: (1, 0), 4000: (2, 0)}
+    keyframe_dir, timestamps_file = write_output(tmp_path, keyframes)
+    shots = [(0, 50), (50, 51), (51, 99), (99, 101)]  # with those keyframes at 25fps
+    to_shot_table(shots, 25, list(keyframes)).save(get_shots_file(str(tmp_path)))
+
+    provenance = dedup_util.run(str(tmp_path), "asset", mode, 4)
+
+    with open(provenance.output_data["keyframe_duplicates"]) as f:
+        assert json.load(f) == {"2000": 1000}
+    assert provenance.output_data["keyframe_reduction_rate"] == 0.25
+    kept = [1000, 3000, 4000] if mode == "drop" else list(keyframes)
+    assert json.loads(timestamps_file.read_text()) == kept
+    assert sorted(os.listdir(keyframe_dir)) == [f"{ts}.jpg" for ts in kept]
+    shot_table = read_shot_table(str(tmp_path))  # each shot resolves to a keyframe
+    assert shot_table.keyframe_timestamps() == kept
+    assert shot_table.keyframe_ms[1] == (1000 if mode == "drop" else 2000)
+
+
+def test_run_references_recurring_keyframes(tmp_path):
+    index_path = str(tmp_path / "fingerprints.db")
+    write_output(tmp_path / "a", {1000: (0, 0), 2000: (1, 0)})
+    write_output(tmp_path / "b", {5000: (2, 0), 6000: (1, 0)})  # shot 1 recurs
+
+    dedup_util.run(str(tmp_path / "a"), "a", "none", 4, index_path)
+    provenance = dedup_util.run(str(tmp_path / "b"), "b", "none", 4, index_path)
+
+    assert "keyframe_duplicates" not in provenance.output_data
+    assert provenance.output_data["recurring_keyframe_rate"] == 0.5
+    with open(provenance.output_data["keyframe_matches"]) as f:
+        assert json.load(f) == {"6000": {"source_id": "a", "timestamp_ms": 2000}}
+
+
+def test_black_keyframes_do_not_recur(tmp_path):
+    index_path = str(tmp_path / "fingerprints.db")
+    write_output(tmp_path / "a", {1000: (BLACK, 0), 2000: (1, 0)})
+    write_output(tmp_path / "b", {5000: (BLACK, 0), 6000: (2, 0)})
+
+    dedup_util.run(str(tmp_path / "a"), "a", "none", 4, index_path)
+    provenance = dedup_util.run(str(tmp_path / "b"), "b", "none", 4, index_path)
+
+    assert provenance.output_data["recurring_keyframes"] == 0
@@ -0,0 +1,134 @@
+import os
+import shutil
+
+from dane.config import cfg
+import pytest
+
+import estimate_util
+from estimate_util import Calibration, LinearModel
+from media_file_util import probe_media_file
+from models import MediaFile
+
+TEST_MP4 = "./tests/data/mp4s/test.mp4"
+MEDIA_FILE = MediaFile(
+    "video.mp4",
+    "video",
+    duration_ms=120000,
+    fps=25,
+    frame_count=3000,
+    width=1000,
+    height=500,
+    file_size=10**8,
+)
+CALIBRATION = Calibration(
+    keyframes_per_minute=10,
+    models={
+        "scenedetect.runtime_s": LinearModel(["one", "megapixel_frames"], [1, 0.01]),
+        "scenedetect.output_bytes": LinearModel(["keyframe_megapixels"], [10**5]),
+        "spectrogram.runtime_s": LinearModel(["audio_seconds"], [0.1]),
+        "spectrogram.output_bytes": LinearModel(["spectrograms"], [10**5]),
+        "archive.runtime_s": LinearModel(["output_megabytes"], [0.5]),
+        "archive.output_bytes": LinearModel(["output_megabytes"], [5 * 10**5]),
+    },
+)
+
+
+@pytest.fixture
+def unfrozen_cfg():
+    cfg.defrost()
+    yield cfg
+    cfg.freeze()
+
+
+def test_fit_linear_model():
+    samples = [{"one": 1, "x": x, "y": x**2} for x in range(5)]
+    targets = [2 + 3 * s["x"] + 0.5 * s["y"] for s in samples]
+    model = LinearModel.fit(["one", "x", "y"], samples, targets)
+    assert model.coefficients == pytest.approx([2, 3, 0.5])
+    assert model.predict({"one": 1, "x": 10, "y": 100}) == pytest.approx(82)
+    assert LinearModel(["x"], [-1]).predict({"x": 1}) == 0  # never negative
+
+
+@pytest.mark.parametrize(
+    "run_audio_extraction, transfer, has_audio, stages, output_bytes",
+    [
+        (False, False, True, {"scenedetect": (16, 10**6)}, 10**6),
+        (
+            True,
+            True,
+            True,
+            {
+                "scenedetect": (16, 10**6),
+                "spectrogram": (24, 4 * 10**6),
+                "archive": (2.5, 2.5 * 10**6),
+            },
+            2.5 * 10**6,
+        ),
+        (
+            True,
+            False,
+            False,  # no spectrograms without audio
+            {"scenedetect": (16, 10**6)},
+            10**6,
+        ),
+    ],
+)
+def test_estimate_media_file(
+    unfrozen_cfg,
+    monkeypatch,
+    run_audio_extraction,
+    transfer,
+    has_audio,
+    stages,
+    output_bytes,
+):
+    monkeypatch.setattr(cfg.VISXP_PREP, "RUN_KEYFRAME_EXTRACTION", True)
+    monkeypatch.setattr(cfg.VISXP_PREP, "RUN_AUDIO_EXTRACTION", run_audio_extraction)
+    monkeypatch.setattr(cfg.VISXP_PREP, "SPECTROGRAM_SAMPLERATE_HZ", [16000, 24000])
+    monkeypatch.setattr(cfg.OUTPUT, "TRANSFER_ON_COMPLETION", transfer)
+    media_file = MediaFile(**{**MEDIA_FILE.__dict__, "has_audio": has_audio})
+
+    estimate = estimate_util.estimate_media_file(media_file, CALIBRATION)
+
+    assert estimate.keyframes == 20
+    assert {
+        name: (stage.runtime_s, stage.output_bytes)
+        for name, stage in estimate.stages.items()
+    } == pytest.approx(stages)
+    assert estimate.runtime_s == pytest.approx(sum(s[0] for s in stages.values()))
+    assert estimate.output_bytes == output_bytes
+
+    totals = estimate_util.summarize([estimate, estimate_util.Estimate("missing")])
+    assert totals["assets"] == 2
+    assert totals["not_probed"] == ["missing"]
+    assert totals["media_hours"] == pytest.approx(120 / 3600)
+    assert totals["input_bytes"] == 10**8
+    assert totals["node_hours"] == pytest.approx(estimate.runtime_s / 3600)
+    assert totals["output_bytes"] == output_bytes
+
+
+def test_calibration_json(tmp_path):
+    calibration_file = str(tmp_path / "calibration.json")
+    estimate_util.save_calibration(CALIBRATION, calibration_file)
+    assert estimate_util.load_calibration(calibration_file) == CALIBRATION
+
+
+def test_read_manifest(tmp_path):
+    manifest_file = tmp_path / "manifest.txt"
+    manifest_file.write_text("# backfill\nhttps://host/a.mp4\n\n  s3://bucket/b.mp4 \n")
+    assert estimate_util.read_manifest(str(manifest_file)) == [
+        "https://host/a.mp4",
+        "s3://bucket/b.mp4",
+    ]
+
+
+@pytest.mark.skipif(shutil.which("ffprobe") is None, reason="ffprobe not installed")
+def test_calibrate(tmp_path):
+    calibration = estimate_util.calibrate([TEST_MP4], str(tmp_path))
+    assert os.listdir(tmp_path) == []  # the output is removed once measured
+    assert calibration.samples == 1
+    assert set(calibration.models) == set(estimate_util.MODEL_FEATURES)
+    media_file = probe_media_file(TEST_MP4)
+    assert media_file
+    estimate = estimate_util.estimate_media_file(media_file, calibration)
+    assert estimate.stages["scenedetect"].runtime_s > 0
@@ -0,0 +1,66 @@
+import threading
+
+import pytest
+
+from fingerprint_util import FingerprintIndex, is_distinctive
+
+
+# distinct hashes with enough bits set to be indexed
+def to_hash(i: int) -> int:
+    return (i << 32) | 0xFFFF
+
+
+A, B, C = 0x0F0F, 0xF0F0, 0xFF00
+
+
+def test_add_and_lookup(tmp_path):
+    index_path = str(tmp_path / "fingerprints.db")
+    high_bit = 0xFFFF_0000_0000_0001  # stored as a negative SQLite integer
+    with FingerprintIndex(index_path) as index:
+        index.add("a", [(A, 1000), (high_bit, 2000), (A, 3000)])
+        index.add("a", [(A, 1000)])  # added again, e.g. when reprocessed
+        index.add("b", [(B, 500)])
+        assert index.count() == 4
+        assert index.lookup([A, high_bit, B, C], exclude_source_id="b") == {
+            A: ("a", 1000),
+            high_bit: ("a", 2000),
+        }
+        assert index.lookup([A, B], exclude_source_id="a") == {B: ("b", 500)}
+
+
+@pytest.mark.parametrize(
+    "h, distinctive",
+    [(0, False), (0b11, False), (0b111, True), (2**64 - 1, False), (2**62, False)],
+)
+def test_flat_frames_are_not_indexed(tmp_path, h, distinctive):
+    assert is_distinctive(h) == distinctive
+    with FingerprintIndex(str(tmp_path / "fingerprints.db")) as index:
+        index.add("a", [(h, 1000)])
+        assert index.count() == int(distinctive)
+        assert bool(index.lookup([h], exclude_source_id="b")) == distinctive
+
+
+def test_concurrent_readers(tmp_path):
+    index_path = str(tmp_path / "fingerprints.db")
+    with FingerprintIndex(index_path) as index:
+        index.add("a", [(to_hash(h), h) for h in range(1000)])
+    errors = []
+
+    def read():
+        try:
+            with FingerprintIndex(index_path) as reader:
+                for _ in range(20):
+                    hashes = [to_hash(h) for h in range(1000)]
+                    assert len(reader.lookup(hashes)) == 1000
+        except Exception as e:
+            errors.append(e)
+
+    readers = [threading.Thread(target=read) for _ in range(4)]
+    for reader in readers:
+        reader.start()
+    with FingerprintIndex(index_path) as writer:  # does not block the readers
+        for i in range(20):
+            writer.add(f"b{i}", [(to_hash(h), h) for h in range(1000, 1100)])
+    for reader in readers:
+        reader.join()
+    assert not errors
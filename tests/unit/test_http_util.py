@@ -0,0 +1,230 @@
+import hashlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import os
+import threading
+
+import pytest
+
+from http_util import (
+    HttpDownloadException,
+    HttpDownloadSettings,
+    PARTIAL_DOWNLOAD_SUFFIX,
+    download_file,
+    split_into_ranges,
+)
+
+PAYLOAD = os.urandom(3 * 1024 * 1024 + 17)
+CHANGED_PAYLOAD = os.urandom(len(PAYLOAD))  # a new version of the same file
+
+
+# serves PAYLOAD with (optional) Range support, can be told to drop connections
+class MediaRequestHandler(BaseHTTPRequestHandler):
+    accept_ranges = True
+    drop_after_bytes = -1  # close the connection after sending this many bytes (once)
+    range_requests = 0
+    ignore_range_start = False  # reply 206, but from byte 0 (a misbehaving server)
+    change_on_drop = False  # replace the file (by CHANGED_PAYLOAD) when dropping
+    payload = PAYLOAD
+    etag = '"v1"'
+    head_size_error = 0  # added to the size reported by HEAD
+
+    def do_HEAD(self):
+        self._send_headers(200, len(self.payload) + self.head_size_error)
+
+    def do_GET(self):
+        if self.path != "/test.mp4":
+            self.send_error(404)
+            return
+        payload = MediaRequestHandler.payload
+        start, end = 0, len(payload) - 1
+        range_header = self.headers.get("Range")
+        if_range = self.headers.get("If-Range", self.etag)
+        if range_header and self.accept_ranges and if_range == self.etag:
+            MediaRequestHandler.range_requests += 1
+            first, last = range_header.replace("bytes=", "").split("-")
+            start, end = int(first), int(last) if last else end
+            if start >= len(payload):
+                self._send_headers(416, 0, f"bytes */{len(payload)}")
+                return
+            if MediaRequestHandler.ignore_range_start:
+                start = 0
+            self._send_headers(
+                206, end - start + 1, f"bytes {start}-{end}/{len(payload)}"
+            )
+        else:
+            self._send_headers(200, len(payload))
+        body = payload[start : end + 1]
+        if MediaRequestHandler.drop_after_bytes >= 0:
+            body = body[: MediaRequestHandler.drop_after_bytes]
+            MediaRequestHandler.drop_after_bytes = -1
+            self.close_connection = True
+            if MediaRequestHandler.change_on_drop:
+                MediaRequestHandler.payload = CHANGED_PAYLOAD
+                MediaRequestHandler.etag = '"v2"'
+        self.wfile.write(body)
+
+    def _send_headers(self, status, content_length, content_range=None):
+        self.send_response(status)
+        self.send_header("Content-Type", "video/mp4")
+        self.send_header("Content-Length", str(content_length))
+        self.send_header("ETag", self.etag)
+        if self.accept_ranges:
+            self.send_header("Accept-Ranges", "bytes")
+        if content_range:
+            self.send_header("Content-Range", content_range)
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def media_url():
+    MediaRequestHandler.accept_ranges = True
+    MediaRequestHandler.drop_after_bytes = -1
+    MediaRequestHandler.range_requests = 0
+    MediaRequestHandler.ignore_range_start = False
+    MediaRequestHandler.change_on_drop = False
+    MediaRequestHandler.payload = PAYLOAD
+    MediaRequestHandler.etag = '"v1"'
+    MediaRequestHandler.head_size_error = 0
+    server = ThreadingHTTPServer(("127.0.0.1", 0), MediaRequestHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_port}/test.mp4"
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.mark.parametrize(
+    "settings, drop_after_bytes, expected_resumes",
+    [
+        (HttpDownloadSettings(chunk_size=64 * 1024), -1, 0),
+        (HttpDownloadSettings(chunk_size=64 * 1024), 1024 * 1024, 1),
+        (
+            HttpDownloadSettings(parallel_connections=4, parallel_threshold_bytes=1),
+            -1,
+            0,
+        ),
+        (
+            HttpDownloadSettings(parallel_connections=4, parallel_threshold_bytes=1),
+            10000,
+            1,
+        ),
+    ],
+)
+def test_download_file(
+    media_url, tmp_path, settings, drop_after_bytes, expected_resumes
+):
+    MediaRequestHandler.drop_after_bytes = drop_after_bytes
+    output_file = os.path.join(tmp_path, "test.mp4")
+    info = download_file(media_url, output_file, settings)
+
+    with open(output_file, "rb") as f:
+        assert f.read() == PAYLOAD
+    assert not os.path.exists(output_file + PARTIAL_DOWNLOAD_SUFFIX)
+    assert info.checksum == hashlib.sha256(PAYLOAD).hexdigest()
+    assert info.content_length == len(PAYLOAD)
+    assert info.mime_type == "video/mp4"
+    assert info.resumes == expected_resumes
+    assert info.connections == settings.parallel_connections
+
+
+def test_download_file_resumes_partial_file(media_url, tmp_path):
+    output_file = os.path.join(tmp_path, "test.mp4")
+    with open(output_file + PARTIAL_DOWNLOAD_SUFFIX, "wb") as f:
+        f.write(PAYLOAD[:12345])  # left behind by an earlier, interrupted run
+    info = download_file(media_url, output_file)
+    assert MediaRequestHandler.range_requests == 1
+    assert info.checksum == hashlib.sha256(PAYLOAD).hexdigest()
+
+
+def test_download_file_checks_the_resumed_range(media_url, tmp_path):
+    MediaRequestHandler.ignore_range_start = True
+    output_file = os.path.join(tmp_path, "test.mp4")
+    with open(output_file + PARTIAL_DOWNLOAD_SUFFIX, "wb") as f:
+        f.write(PAYLOAD[:12345])
+    info = download_file(media_url, output_file)
+    assert info.resumes == 1  # restarted from scratch
+    with open(output_file, "rb") as f:
+        assert f.read() == PAYLOAD
+
+
+@pytest.mark.parametrize(
+    "partial_content, expected_range_requests",
+    [
+        (PAYLOAD, 1),  # already complete
+        (PAYLOAD + b"garbage", 1),  # too large: restarted without a Range header
+    ],
+)
+def test_download_file_with_unsatisfiable_range(
+    media_url, tmp_path, partial_content, expected_range_requests
+):
+    output_file = os.path.join(tmp_path, "test.mp4")
+    with open(output_file + PARTIAL_DOWNLOAD_SUFFIX, "wb") as f:
+        f.write(partial_content)
+    info = download_file(media_url, output_file)
+    assert MediaRequestHandler.range_requests == expected_range_requests
+    assert info.checksum == hashlib.sha256(PAYLOAD).hexdigest()
+    with open(output_file, "rb") as f:
+        assert f.read() == PAYLOAD
+
+
+def test_download_file_restarts_if_the_file_changed(media_url, tmp_path):
+    MediaRequestHandler.drop_after_bytes = 1024 * 1024
+    MediaRequestHandler.change_on_drop = True
+    output_file = os.path.join(tmp_path, "test.mp4")
+    info = download_file(media_url, output_file)
+    assert info.resumes == 1
+    assert MediaRequestHandler.range_requests == 0  # If-Range did not match
+    assert info.checksum == hashlib.sha256(CHANGED_PAYLOAD).hexdigest()
+    with open(output_file, "rb") as f:
+        assert f.read() == CHANGED_PAYLOAD
+
+
+def test_download_file_removes_the_partial_file_on_a_size_mismatch(media_url, tmp_path):
+    MediaRequestHandler.head_size_error = 1
+    output_file = os.path.join(tmp_path, "test.mp4")
+    with pytest.raises(HttpDownloadException):
+        download_file(media_url, output_file)
+    assert not os.path.exists(output_file + PARTIAL_DOWNLOAD_SUFFIX)
+
+
+def test_failed_parallel_download_removes_the_partial_file(media_url, tmp_path):
+    MediaRequestHandler.drop_after_bytes = 10000
+    output_file = os.path.join(tmp_path, "test.mp4")
+    settings = HttpDownloadSettings(
+        parallel_connections=4, parallel_threshold_bytes=1, max_retries=0
+    )
+    with pytest.raises(HttpDownloadException):
+        download_file(media_url, output_file, settings)
+    # so a next (streaming) attempt doesn't try to resume at the full size
+    assert not os.path.exists(output_file + PARTIAL_DOWNLOAD_SUFFIX)
+
+
+def test_download_file_without_range_support(media_url, tmp_path):
+    MediaRequestHandler.accept_ranges = False
+    MediaRequestHandler.drop_after_bytes = 1000
+    output_file = os.path.join(tmp_path, "test.mp4")
+    info = download_file(media_url, output_file, HttpDownloadSettings(max_retries=1))
+    assert info.resumes == 1  # restarted from scratch
+    with open(output_file, "rb") as f:
+        assert f.read() == PAYLOAD
+
+
+def test_download_file_gives_up(media_url, tmp_path):
+    output_file = os.path.join(tmp_path, "missing.mp4")
+    with pytest.raises(HttpDownloadException):
+        download_file(media_url.replace("test.mp4", "missing.mp4"), output_file)
+    assert not os.path.exists(output_file)
+
+
+@pytest.mark.parametrize(
+    "content_length, n, ranges",
+    [
+        (10, 1, [(0, 9)]),
+        (10, 3, [(0, 3), (4, 7), (8, 9)]),
+        (2, 4, [(0, 0), (1, 1)]),
+    ],
+)
+def test_split_into_ranges(content_length, n, ranges):
+    assert split_into_ranges(content_length, n) == ranges
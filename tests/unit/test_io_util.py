@@ -0,0 +1,202 @@
+import io
+import json
+import os
+import tarfile
+
+from dane.config import cfg
+from dane.provenance import Provenance
+import pytest
+
+from archive_util import open_archive
+import io_util
+from io_util import IncrementalOutputUpload, generate_output_dirs
+from manifest_util import ManifestRecorder, finalize_manifest
+from models import OutputType
+from tests.unit.fake_s3 import FakeS3Client
+
+SOURCE_ID = "test_source"
+
+
+FAKE_S3 = FakeS3Client()
+
+
+@pytest.fixture
+def unfrozen_cfg():
+    cfg.defrost()
+    yield cfg
+    cfg.freeze()
+
+
+@pytest.fixture
+def output_dirs(unfrozen_cfg, tmp_path, monkeypatch):
+    monkeypatch.setattr(cfg.FILE_SYSTEM, "BASE_MOUNT", str(tmp_path))
+    monkeypatch.setattr(cfg.OUTPUT, "S3_BUCKET", "test-bucket")
+    monkeypatch.setattr(cfg.OUTPUT, "S3_FOLDER_IN_BUCKET", "assets")
+    monkeypatch.setattr(io_util, "get_s3_client", lambda: FAKE_S3)
+    monkeypatch.setattr(io_util, "get_s3_client_stats", lambda: {})
+    FAKE_S3.objects.clear()
+    output_dirs = generate_output_dirs(SOURCE_ID)
+    for output_dir in output_dirs.values():
+        with open(os.path.join(output_dir, "output.txt"), "w") as f:
+            f.write(output_dir)
+    return output_dirs
+
+
+@pytest.mark.parametrize("streaming_upload", [False, True])
+def test_incremental_output_upload(streaming_upload, output_dirs, monkeypatch):
+    monkeypatch.setattr(cfg.OUTPUT, "STREAMING_UPLOAD", streaming_upload)
+    output_upload = IncrementalOutputUpload(SOURCE_ID, 2)
+    output_upload.upload([OutputType.METADATA, OutputType.KEYFRAMES])
+    provenance = output_upload.finish()
+
+    assert provenance is not None
+    manifest_key = (
+        "test-bucket",
+        f"assets/{SOURCE_ID}/{io_util.get_manifest_file_name(SOURCE_ID)}",
+    )
+    manifest = json.loads(FAKE_S3.objects[manifest_key])
+    assert set(manifest["archives"]) == set(output_dirs)
+    for archive in manifest["archives"].values():
+        assert ("test-bucket", f"assets/{SOURCE_ID}/{archive['file_name']}") in (
+            FAKE_S3.objects
+        )
+        assert archive["file_count"] == 1
+
+
+def test_transfer_output_uses_the_manifest(output_dirs):
+    output_dir = io_util.get_base_output_dir(SOURCE_ID)
+    recorder = ManifestRecorder(output_dir, "test")
+    for path in output_dirs.values():
+        recorder.add_file(os.path.join(path, "output.txt"))
+    recorder.save()
+    finalize_manifest(output_dir)
+    with open(os.path.join(output_dirs["keyframes"], "stray.jpg"), "w") as f:
+        f.write("not in the manifest")
+
+    assert io_util.transfer_output(SOURCE_ID)
+    archive_key = io_util.get_output_file_name(SOURCE_ID)  # by default one .tar.gz
+    archive = FAKE_S3.objects[("test-bucket", f"assets/{SOURCE_ID}/{archive_key}")]
+    with tarfile.open(fileobj=io.BytesIO(archive)) as tar:
+        names = tar.getnames()
+    assert [n for n in names if n.startswith("keyframes")] == [
+        "keyframes",
+        "keyframes/output.txt",
+    ]
+    assert [n for n in names if n.startswith("provenance")] == [
+        "provenance",
+        "provenance/output.txt",
+        "provenance/output_manifest.json",
+    ]
+
+    os.remove(os.path.join(output_dirs["keyframes"], "output.txt"))
+    assert io_util.transfer_output(SOURCE_ID) is None  # incomplete output
+
+
+def test_transfer_output_to_shard(output_dirs, tmp_path, monkeypatch):
+    monkeypatch.setattr(cfg.OUTPUT, "SHARD_UPLOAD", True)
+    monkeypatch.setattr(cfg.OUTPUT, "SHARD_SPOOL_DIR", str(tmp_path / "spool"))
+    monkeypatch.setattr(io_util, "_shard_spool", None)
+    output_dir = io_util.get_base_output_dir(SOURCE_ID)
+    recorder = ManifestRecorder(output_dir, "test")
+    for path in output_dirs.values():
+        recorder.add_file(os.path.join(path, "output.txt"))
+    recorder.save()
+    finalize_manifest(output_dir)
+
+    provenance = io_util.transfer_output(SOURCE_ID)
+    assert provenance is not None
+    assert not FAKE_S3.objects  # the shard is uploaded later
+    top_level_provenance = Provenance(
+        "test", "test", input_data={}, start_time_unix=0, steps=[provenance]
+    )
+    location = io_util.get_shard_location(top_level_provenance)
+    assert location is not None
+    assert set(location.archives) == {
+        io_util.get_output_file_name(SOURCE_ID, compression)
+        for compression in io_util.get_archive_groups()
+    }
+    assert not io_util.wait_for_shard_upload(location, 0)  # not due yet
+    monkeypatch.setattr(io_util.get_shard_spool(), "max_age_s", 0)
+    assert io_util.wait_for_shard_upload(location, 10)
+
+    names = []
+    for file_name in location.archives:
+        archive = tmp_path / file_name
+        archive.write_bytes(io_util.read_shard_archive(location, file_name))
+        with open_archive(str(archive)) as tar:
+            names.extend(tar.getnames())
+    assert sorted(names) == sorted(
+        [ot for ot in output_dirs]
+        + [f"{ot}/output.txt" for ot in output_dirs]
+        + ["provenance/output_manifest.json"]
+    )
+
+
+@pytest.mark.parametrize("stray_file", [False, True])
+def test_delete_local_output(output_dirs, stray_file):
+    output_dir = io_util.get_base_output_dir(SOURCE_ID)
+    assert not io_util.delete_local_output(SOURCE_ID)  # no manifest yet
+    recorder = ManifestRecorder(output_dir, "test")
+    for path in output_dirs.values():
+        recorder.add_file(os.path.join(path, "output.txt"))
+    recorder.save()
+    finalize_manifest(output_dir)
+    if stray_file:  # not written by this worker
+        with open(os.path.join(output_dirs["keyframes"], "stray.jpg"), "w") as f:
+            f.write("not in the manifest")
+
+    assert io_util.delete_local_output(SOURCE_ID)
+    if stray_file:
+        assert os.listdir(output_dir) == ["keyframes"]
+        assert os.listdir(output_dirs["keyframes"]) == ["stray.jpg"]
+    else:
+        assert not os.path.exists(output_dir)
+
+
+def test_incremental_output_upload_abort(output_dirs):
+    output_upload = IncrementalOutputUpload(SOURCE_ID, 2)
+    output_upload.upload([OutputType.METADATA])
+    output_upload.abort()
+    assert not any(key.endswith(".manifest.json") for _, key in FAKE_S3.objects)
+
+
+@pytest.fixture
+def scratch_dir(unfrozen_cfg, tmp_path, monkeypatch):
+    monkeypatch.setattr(cfg.FILE_SYSTEM, "BASE_MOUNT", str(tmp_path / "shared"))
+    monkeypatch.setattr(cfg.FILE_SYSTEM, "SCRATCH_DIR", str(tmp_path / "scratch"))
+    monkeypatch.setattr(cfg.FILE_SYSTEM, "SCRATCH_MAX_BYTES", 100)
+    return tmp_path / "scratch"
+
+
+@pytest.mark.parametrize(
+    "use_scratch, scratch_bytes, staged",
+    [(True, 0, True), (True, 100, False), (False, 0, False)],
+)
+def test_publish_output(scratch_dir, use_scratch, scratch_bytes, staged):
+    (scratch_dir / "other_source").mkdir(parents=True)
+    (scratch_dir / "other_source" / "output.bin").write_bytes(b"0" * scratch_bytes)
+    shared_dir = io_util.get_shared_output_dir(SOURCE_ID)
+    scratch_output_dir = io_util.get_scratch_output_dir(SOURCE_ID)
+
+    output_dirs = generate_output_dirs(SOURCE_ID, use_scratch)
+    base_output_dir = scratch_output_dir if staged else shared_dir
+    assert io_util.get_base_output_dir(SOURCE_ID) == base_output_dir
+    for output_dir in output_dirs.values():
+        assert output_dir.startswith(base_output_dir)
+        with open(os.path.join(output_dir, "output.txt"), "w") as f:
+            f.write("output")
+
+    assert io_util.publish_output(SOURCE_ID)
+    assert not os.path.exists(scratch_output_dir)
+    assert io_util.get_base_output_dir(SOURCE_ID) == shared_dir
+    assert sorted(os.listdir(shared_dir)) == sorted(output_dirs)
+    assert os.listdir(os.path.dirname(shared_dir)) == [SOURCE_ID]  # no temp dirs
+
+
+def test_publish_output_replaces_earlier_output(scratch_dir):
+    generate_output_dirs(SOURCE_ID)
+    shared_dir = io_util.get_shared_output_dir(SOURCE_ID)
+    os.makedirs(os.path.join(shared_dir, "earlier_output"))
+    assert io_util.publish_output(SOURCE_ID)
+    assert "earlier_output" not in os.listdir(shared_dir)
+    assert OutputType.PROVENANCE.value in os.listdir(shared_dir)
@@ -0,0 +1,93 @@
+import os
+import time
+from types import SimpleNamespace
+
+from dane.config import cfg
+import pytest
+
+import io_util
+import main_data_processor
+from models import MediaFile, VisXPFeatureExtractionInput
+import pipeline_util
+
+SOURCE_ID = "test_source"
+
+
+@pytest.fixture
+def unfrozen_cfg():
+    cfg.defrost()
+    yield cfg
+    cfg.freeze()
+
+
+@pytest.fixture
+def scratch_dir(unfrozen_cfg, tmp_path, monkeypatch):
+    monkeypatch.setattr(cfg.FILE_SYSTEM, "BASE_MOUNT", str(tmp_path / "shared"))
+    monkeypatch.setattr(cfg.FILE_SYSTEM, "SCRATCH_DIR", str(tmp_path / "scratch"))
+    monkeypatch.setattr(cfg.FILE_SYSTEM, "SCRATCH_MAX_BYTES", 0)
+    return tmp_path / "scratch"
+
+
+def test_failed_transfer_discards_the_scratch_output(scratch_dir, monkeypatch):
+    monkeypatch.setattr(main_data_processor, "transfer_output", lambda *args: None)
+    io_util.generate_output_dirs(SOURCE_ID)
+    assert os.path.isdir(scratch_dir / SOURCE_ID)
+
+    response = main_data_processor.apply_desired_io_on_output(
+        VisXPFeatureExtractionInput(
+            200, "Success", MediaFile(f"/input/{SOURCE_ID}.mp4", SOURCE_ID)
+        ),
+        delete_input_on_completion=False,
+        delete_output_on_completetion=False,
+        transfer_output_on_completion=True,
+    )
+
+    assert response["state"] == 500
+    assert not os.path.exists(scratch_dir / SOURCE_ID)
+
+
+class FakePipelinedDownload:
+    duration_ms = 0
+    opened_streams: list = []
+
+    def __init__(self, url, output_file, settings):
+        self.output_file = output_file
+        self.start_time = time.time()
+
+    def start(self):
+        return self
+
+    def is_streamable(self):
+        return True
+
+    def probe(self):
+        return MediaFile(
+            self.output_file, SOURCE_ID, duration_ms=self.duration_ms, fps=25
+        )
+
+    def open_video_stream(self, media_file):
+        self.opened_streams.append(media_file)
+        raise pipeline_util.PipelineException("no actual video")
+
+    def wait(self):
+        return SimpleNamespace(mime_type="video/mp4", content_length=1, checksum="")
+
+
+@pytest.mark.parametrize("duration_ms, pipelined", [(30000, True), (120000, False)])
+def test_long_assets_are_not_detected_while_downloading(
+    duration_ms, pipelined, scratch_dir, monkeypatch
+):
+    monkeypatch.setattr(cfg.SPLIT, "MIN_DURATION_MS", 60000)
+    monkeypatch.setattr(pipeline_util, "PipelinedDownload", FakePipelinedDownload)
+    monkeypatch.setattr(FakePipelinedDownload, "duration_ms", duration_ms)
+    monkeypatch.setattr(FakePipelinedDownload, "opened_streams", [])
+
+    download_result, provenance = (
+        main_data_processor._pipelined_download_and_detect_shots(
+            "http://host/video.mp4", str(scratch_dir / "video.mp4")
+        )
+    )
+
+    assert download_result is not None
+    assert provenance is None  # detected on the downloaded file (split if long)
+    assert bool(FakePipelinedDownload.opened_streams) == pipelined
@@ -0,0 +1,84 @@
+import os
+
+import pytest
+
+from manifest_util import (
+    ManifestRecorder,
+    finalize_manifest,
+    read_manifest,
+    set_run_id,
+    verify_manifest,
+)
+from writer_util import AsyncFileWriter
+
+
+@pytest.fixture
+def output_dir(tmp_path):
+    for output_type in ["keyframes", "metadata", "provenance"]:
+        (tmp_path / output_type).mkdir()
+    return str(tmp_path)
+
+
+def test_finalize_manifest(output_dir):
+    scenedetect = ManifestRecorder(output_dir, "scenedetect")
+    with AsyncFileWriter(2, 4, recorder=scenedetect) as writer:
+        for ts in [1000, 2000]:
+            writer.write(os.path.join(output_dir, "keyframes", f"{ts}.jpg"), b"jpg")
+    dedup = ManifestRecorder(output_dir, "dedup")  # e.g. in another process
+    os.remove(os.path.join(output_dir, "keyframes", "2000.jpg"))
+    dedup.remove(os.path.join(output_dir, "keyframes", "2000.jpg"))
+    dedup.add(os.path.join(output_dir, "metadata", "duplicates.json"), b"{}")
+    dedup.save()
+
+    manifest = finalize_manifest(output_dir)
+
+    assert read_manifest(output_dir) == manifest
+    assert manifest["file_count"] == 2
+    assert manifest["total_bytes"] == 5
+    assert manifest["files"][0] == {
+        "path": "keyframes/1000.jpg",
+        "size": 3,
+        "sha256": "f8146b6cb4961f87a1519047b8c83402754ed108ade55457d43166e564b7b4fe",
+        "stage": "scenedetect",
+    }
+    assert manifest["files"][1]["stage"] == "dedup"
+    assert not os.path.exists(os.path.join(output_dir, ".manifest"))
+
+
+def test_finalize_manifest_skips_earlier_runs(output_dir):
+    set_run_id(output_dir, "run1")
+    earlier_run = ManifestRecorder(output_dir, "scenedetect")
+    set_run_id(output_dir, "run2")
+    run = ManifestRecorder(output_dir, "scenedetect")
+    run.add(os.path.join(output_dir, "keyframes", "1000.jpg"), b"jpg")
+    run.save()
+    # e.g. a process of the earlier run that was still writing its output
+    earlier_run.add(os.path.join(output_dir, "keyframes", "2000.jpg"), b"jpg")
+    earlier_run.save()
+
+    manifest = finalize_manifest(output_dir)
+
+    assert [entry["path"] for entry in manifest["files"]] == ["keyframes/1000.jpg"]
+    assert finalize_manifest(output_dir, "run1")["file_count"] == 0
+
+
+@pytest.mark.parametrize(
+    "content, verify_checksums, invalid",
+    [
+        (b"jpg", True, []),
+        (b"JPG", False, []),  # same size
+        (b"JPG", True, ["keyframes/1000.jpg"]),
+        (b"jpeg", False, ["keyframes/1000.jpg"]),
+        (None, False, ["keyframes/1000.jpg"]),
+    ],
+)
+def test_verify_manifest(output_dir, content, verify_checksums, invalid):
+    path = os.path.join(output_dir, "keyframes", "1000.jpg")
+    recorder = ManifestRecorder(output_dir, "scenedetect")
+    recorder.add(path, b"jpg")
+    recorder.save()
+    manifest = finalize_manifest(output_dir)
+    if content:
+        with open(path, "wb") as f:
+            f.write(content)
+    assert verify_manifest(output_dir, manifest, verify_checksums) == invalid
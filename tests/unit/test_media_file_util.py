@@ -0,0 +1,96 @@
+import pytest
+import shutil
+from media_file_util import probe_media_file, to_media_file
+
+TEST_MP4 = "./tests/data/mp4s/test.mp4"
+
+FFPROBE_OUTPUT = {
+    "streams": [
+        {
+            "index": 0,
+            "codec_name": "h264",
+            "codec_type": "video",
+            "width": 480,
+            "height": 270,
+            "r_frame_rate": "30000/1001",
+            "avg_frame_rate": "30000/1001",
+            "duration": "10.010000",
+            "nb_frames": "300",
+        },
+        {
+            "index": 1,
+            "codec_name": "aac",
+            "codec_type": "audio",
+            "sample_rate": "44100",
+            "channels": 2,
+        },
+    ],
+    "format": {"duration": "10.010000", "size": "1048576"},
+}
+
+
+@pytest.mark.parametrize(
+    "probe_data, expected",
+    [
+        (
+            FFPROBE_OUTPUT,
+            {
+                "source_id": "test",
+                "duration_ms": 10010,
+                "fps": 30000 / 1001,
+                "frame_count": 300,
+                "width": 480,
+                "height": 270,
+                "video_codec": "h264",
+                "audio_codec": "aac",
+                "audio_sample_rate": 44100,
+                "audio_channels": 2,
+                "has_video": True,
+                "has_audio": True,
+                "file_size": 1048576,
+            },
+        ),
+        (
+            {
+                "streams": [
+                    {"codec_type": "audio", "codec_name": "mp3", "duration": "2.5"},
+                    {
+                        "codec_type": "video",
+                        "codec_name": "mjpeg",
+                        "disposition": {"attached_pic": 1},  # cover art
+                    },
+                ],
+                "format": {},
+            },
+            {"duration_ms": 2500, "has_video": False, "has_audio": True},
+        ),
+        (
+            {
+                "streams": [
+                    {
+                        "codec_type": "video",
+                        "avg_frame_rate": "0/0",
+                        "r_frame_rate": "25/1",
+                    }
+                ],
+                "format": {"duration": "4.0"},
+            },
+            {"fps": 25, "frame_count": 100, "has_audio": False},
+        ),
+        ({}, {"duration_ms": -1, "has_video": False, "has_audio": False}),
+    ],
+)
+def test_to_media_file(probe_data, expected):
+    media_file = to_media_file(TEST_MP4, probe_data)
+    for field, value in expected.items():
+        assert getattr(media_file, field) == value
+
+
+@pytest.mark.skipif(shutil.which("ffprobe") is None, reason="ffprobe not installed")
+def test_probe_media_file():
+    media_file = probe_media_file(TEST_MP4)
+    assert media_file is not None
+    assert media_file.duration_ms == 10010
+    assert media_file.width == 480 and media_file.height == 270
+    assert media_file.has_video
+    assert probe_media_file(TEST_MP4) == media_file  # served from the cache
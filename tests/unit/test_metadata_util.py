@@ -0,0 +1,50 @@
+import numpy as np
+import pytest
+
+from metadata_util import NO_KEYFRAME, ShotTable, read_keyframe_timestamps
+from metadata_util import to_shot_table
+from scenedetect_util import get_shot_boundaries, to_scene_list
+
+SHOTS = [(0, 30), (30, 31), (31, 100), (100, 250)]
+FRAME_RATE = 29.97
+
+
+def test_to_shot_table_matches_text_files():
+    shot_table = to_shot_table(SHOTS, FRAME_RATE, [500, 5839])  # of shots 0 & 3
+    assert list(zip(shot_table.start_ms.tolist(), shot_table.end_ms.tolist())) == (
+        get_shot_boundaries(to_scene_list(SHOTS, FRAME_RATE))
+    )
+    assert shot_table.start_frame.tolist() == [0, 30, 31, 100]
+    assert shot_table.keyframe_frame.tolist() == [15, NO_KEYFRAME, NO_KEYFRAME, 175]
+    assert shot_table.keyframe_ms.tolist() == [500, NO_KEYFRAME, NO_KEYFRAME, 5839]
+    assert shot_table.start_ms.dtype == np.int64
+
+
+@pytest.mark.parametrize(
+    "timestamp_ms, shot",
+    [
+        (-1, -1),
+        (0, 0),
+        (1000, 0),
+        (1001, 1),
+        (1033, 1),
+        (1034, 2),
+        (3336, 3),
+        (8340, 3),
+        (8341, -1),
+    ],
+)
+def test_shot_at(timestamp_ms, shot):
+    shot_table = to_shot_table(SHOTS, FRAME_RATE, None)
+    assert shot_table.shot_at(timestamp_ms) == shot
+
+
+def test_save_and_load(tmp_path):
+    (tmp_path / "metadata").mkdir()
+    shot_table = to_shot_table(SHOTS, FRAME_RATE, [500, 5839])
+    shot_table.save(str(tmp_path / "metadata" / "shots.npz"))
+    loaded = ShotTable.load(str(tmp_path / "metadata" / "shots.npz"))
+    assert loaded.frame_rate == FRAME_RATE
+    assert loaded.end_frame.tolist() == shot_table.end_frame.tolist()
+    assert loaded.shots_at([500, 5839]).tolist() == [0, 3]  # keyframe -> shot
+    assert read_keyframe_timestamps(str(tmp_path)) == [500, 5839]
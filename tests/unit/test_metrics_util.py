@@ -0,0 +1,94 @@
+from urllib.error import HTTPError
+from urllib.request import urlopen
+
+from dane.provenance import Provenance
+import pytest
+
+import metrics_util
+from models import StageProvenance
+
+
+def to_step(activity_name: str, processing_time_ms: float, output_data: dict):
+    return StageProvenance(
+        activity_name=activity_name,
+        activity_description="",
+        input_data={},
+        start_time_unix=0,
+        processing_time_ms=processing_time_ms,
+        output_data=output_data,
+    )
+
+
+def test_record_task():
+    metrics = [
+        metrics_util.MEDIA_SECONDS,
+        metrics_util.FRAMES_DECODED,
+        metrics_util.KEYFRAMES,
+        metrics_util.UPLOADED_BYTES,
+        metrics_util.TASK_ERRORS,
+    ]
+    before = [metric.get() for metric in metrics]
+    transfers_before = metrics_util.STAGE_DURATION.get_count(stage="transfer")
+    provenance = Provenance("task", "", {}, 0)
+    provenance.steps = [
+        to_step("Probe VisXP input", 20, {"media_file": {"duration_ms": 60000}}),
+        to_step(
+            "Python Scenedetect", 3000, {"frames_decoded": 1500, "keyframe_count": 12}
+        ),
+        to_step(
+            "Transfer VisXP output",
+            500,
+            {"archives": {"a.tar": {"compressed_bytes": 100}, "b.tar": {}}},
+        ),
+    ]
+
+    metrics_util.record_task({"state": 200, "message": "ok"}, provenance)
+
+    assert [metric.get() - b for metric, b in zip(metrics, before)] == [
+        60,
+        1500,
+        12,
+        100,
+        0,
+    ]
+    assert metrics_util.STAGE_DURATION.get_count(stage="transfer") == (
+        transfers_before + 1
+    )
+
+
+@pytest.mark.parametrize("result, state", [({"state": 500}, "500"), (None, "error")])
+def test_record_failed_task(result, state):
+    errors_before = metrics_util.TASK_ERRORS.get()
+    tasks_before = metrics_util.TASKS.get(state=state)
+    metrics_util.record_task(result, None)
+    assert metrics_util.TASK_ERRORS.get() == errors_before + 1
+    assert metrics_util.TASKS.get(state=state) == tasks_before + 1
+
+
+def test_histogram_buckets_are_cumulative():
+    histogram = metrics_util.Histogram("test_seconds", "test", [1, 10])
+    for value in [0.5, 1, 5, 50]:
+        histogram.observe(value, stage="x")
+    assert histogram.render()[2:] == [
+        'visxp_prep_test_seconds_bucket{stage="x",le="1"} 2',
+        'visxp_prep_test_seconds_bucket{stage="x",le="10"} 3',
+        'visxp_prep_test_seconds_bucket{stage="x",le="+Inf"} 4',
+        'visxp_prep_test_seconds_sum{stage="x"} 56.5',
+        'visxp_prep_test_seconds_count{stage="x"} 4',
+    ]
+
+
+def test_metrics_server():
+    server = metrics_util.start_metrics_server(0, "127.0.0.1")
+    url = f"http://127.0.0.1:{server.server_address[1]}"
+    try:
+        with urlopen(f"{url}/metrics") as response:
+            assert response.headers["Content-Type"] == metrics_util.CONTENT_TYPE
+            body = response.read().decode("utf-8")
+        assert "# TYPE visxp_prep_tasks_in_flight gauge" in body
+        assert "visxp_prep_uploaded_bytes_total " in body
+        with pytest.raises(HTTPError):
+            urlopen(f"{url}/other")
+    finally:
+        server.shutdown()
+        server.server_close()
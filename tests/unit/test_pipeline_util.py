@@ -0,0 +1,113 @@
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+import os
+import shutil
+import struct
+import subprocess
+import threading
+import time
+
+import pytest
+
+from models import MediaFile
+from pipeline_util import (
+    GrowingFileReader,
+    PipelinedDownload,
+    is_streamable_container,
+)
+import scenedetect_util
+
+
+def box(box_type: bytes, size: int = 16) -> bytes:
+    return struct.pack(">I4s", size, box_type) + b"\0" * (size - 8)
+
+
+@pytest.mark.parametrize(
+    "head, streamable",
+    [
+        (b"", None),
+        (box(b"ftyp") + box(b"moov"), True),  # faststart
+        (box(b"ftyp") + box(b"free") + box(b"mdat"), False),  # moov at the end
+        (box(b"ftyp") + box(b"free"), None),  # need more data
+        (box(b"ftyp", 64), None),
+        (struct.pack(">I4sQ", 1, b"ftyp", 24) + b"\0" * 8 + box(b"moov"), True),
+        (b"\x1a\x45\xdf\xa3" + b"\0" * 12, True),  # Matroska
+        (b"\x47" + b"\0" * 187, True),  # MPEG-TS
+    ],
+)
+def test_is_streamable_container(head, streamable):
+    assert is_streamable_container(head) == streamable
+
+
+def test_growing_file_reader(tmp_path):
+    file_path = os.path.join(tmp_path, "growing.bin")
+    finished = threading.Event()
+
+    def write_slowly():
+        with open(file_path, "wb") as f:
+            for i in range(5):
+                f.write(bytes([i]) * 1000)
+                f.flush()
+                time.sleep(0.05)
+        finished.set()
+
+    threading.Thread(target=write_slowly).start()
+    data = b"".join(GrowingFileReader([file_path], finished, chunk_size=300))
+    assert data == b"".join(bytes([i]) * 1000 for i in range(5))
+
+
+@pytest.fixture
+def faststart_video_url(tmp_path):
+    video_dir = os.path.join(tmp_path, "server")
+    os.makedirs(video_dir)
+    subprocess.run(
+        [
+            "ffmpeg",
+            "-v",
+            "error",
+            "-f",
+            "lavfi",
+            "-i",
+            "color=c=red:s=320x240:d=2:r=25",
+            "-f",
+            "lavfi",
+            "-i",
+            "testsrc=s=320x240:d=2:r=25",
+            "-filter_complex",
+            "[0][1]concat=n=2:v=1",
+            "-movflags",
+            "+faststart",
+            os.path.join(video_dir, "video.mp4"),
+        ],
+        check=True,
+    )
+    handler = partial(SimpleHTTPRequestHandler, directory=video_dir)
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_port}/video.mp4"
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.mark.skipif(shutil.which("ffmpeg") is None, reason="ffmpeg not installed")
+def test_detect_shots_while_downloading(faststart_video_url, tmp_path):
+    output_dir = os.path.join(tmp_path, "output")
+    for subdir in ["metadata", "keyframes"]:
+        os.makedirs(os.path.join(output_dir, subdir))
+    output_file = os.path.join(tmp_path, "video.mp4")
+    media_file = MediaFile(
+        output_file, "video", duration_ms=4000, fps=25, width=320, height=240
+    )
+
+    download = PipelinedDownload(faststart_video_url, output_file).start()
+    assert download.is_streamable()
+    video_stream = download.open_video_stream(media_file)
+    provenance = scenedetect_util.run(media_file, output_dir, True, video_stream)
+
+    assert download.wait() is not None
+    assert video_stream.returncode == 0
+    assert video_stream.frame_number == 100
+    with open(provenance.output_data["shot_boundaries"]) as f:
+        assert f.read() == "[(0, 2000), (2000, 4000)]"
+    with open(provenance.output_data["keyframe_timestamps"]) as f:
+        assert f.read() == "[1000, 3000]"
@@ -0,0 +1,54 @@
+import os
+
+import pytest
+
+from prefork_util import TaskProcessDied, WarmProcessPool
+
+
+# the functions below run in the pool's (spawned) processes, so they must be importable
+def get_pid() -> int:
+    return os.getpid()
+
+
+def fail(exit_code: int) -> None:
+    if exit_code:
+        os._exit(exit_code)  # a crash, e.g. a segfault in a native library
+    raise ValueError("task failed")
+
+
+@pytest.mark.parametrize(
+    "max_tasks_per_process, max_rss_bytes, expected_pids, recycled",
+    [
+        (0, 0, [0, 0, 0, 0], 0),
+        (2, 0, [0, 0, 1, 1], 2),
+        (0, 1, [0, 1, 2, 3], 4),  # always over the RSS limit: a new process per task
+    ],
+)
+def test_recycling(max_tasks_per_process, max_rss_bytes, expected_pids, recycled):
+    pool = WarmProcessPool(1, ["json"], max_tasks_per_process, max_rss_bytes)
+    try:
+        pids = [pool.submit(get_pid).result() for _ in range(4)]
+    finally:
+        pool.shutdown()
+    assert [sorted(set(pids), key=pids.index).index(p) for p in pids] == expected_pids
+    assert os.getpid() not in pids
+    stats = pool.get_stats()
+    assert stats["tasks_completed"] == 4
+    assert stats["processes_recycled"] == recycled
+    assert len(stats["warmup_s"]) == stats["processes_started"]
+    assert stats["first_task_latency_s"] > 0
+    assert stats["rss_bytes"] == {}  # all processes stopped
+
+
+@pytest.mark.parametrize(
+    "exit_code, exception", [(0, ValueError), (3, TaskProcessDied)]
+)
+def test_failing_task_is_isolated(exit_code, exception):
+    pool = WarmProcessPool(1, [])
+    try:
+        with pytest.raises(exception):
+            pool.submit(fail, exit_code).result()
+        assert pool.submit(get_pid).result() != os.getpid()  # the pool still works
+    finally:
+        pool.shutdown()
+    assert pool.get_stats()["processes_died"] == (1 if exit_code else 0)
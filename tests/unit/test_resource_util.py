@@ -0,0 +1,46 @@
+import os
+import subprocess
+import sys
+from time import time
+
+from models import StageProvenance
+from resource_util import get_resource_usage_since, take_resource_snapshot
+
+
+def test_get_resource_usage_since(tmp_path):
+    snapshot = take_resource_snapshot()
+    sum(i * i for i in range(200000))  # burn some CPU in this process
+    subprocess.run([sys.executable, "-c", "sum(i * i for i in range(200000))"])
+    with open(os.path.join(tmp_path, "out.bin"), "wb") as f:
+        f.write(b"0" * 4096)
+    usage = get_resource_usage_since(snapshot)
+
+    assert usage.cpu_user_time_ms + usage.cpu_system_time_ms > 0
+    assert usage.children_cpu_user_time_ms + usage.children_cpu_system_time_ms > 0
+    assert usage.peak_rss_kb > 0
+    assert usage.peak_rss_delta_kb >= 0
+    if sys.platform.startswith("linux"):
+        assert usage.write_bytes >= 4096
+
+
+def test_stage_provenance_to_json():
+    snapshot = take_resource_snapshot()
+    provenance = StageProvenance(
+        activity_name="test",
+        activity_description="test",
+        input_data={},
+        start_time_unix=time(),
+        resource_usage=get_resource_usage_since(snapshot),
+    )
+    as_json = provenance.to_json()
+    assert as_json["activity_name"] == "test"
+    assert "cpu_user_time_ms" in as_json["resource_usage"]
+    assert (
+        StageProvenance(
+            activity_name="test",
+            activity_description="test",
+            input_data={},
+            start_time_unix=time(),
+        ).to_json()["resource_usage"]
+        is None
+    )
@@ -0,0 +1,112 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import io
+import os
+import shutil
+import tarfile
+import threading
+
+import pytest
+
+from archive_util import Compression
+from s3_transfer_util import (
+    MIN_PART_SIZE,
+    MultipartUploadWriter,
+    get_pooled_s3_client,
+    stream_tar_to_s3,
+)
+from tests.unit.fake_s3 import FakeS3Client
+
+BUCKET = "test-bucket"
+KEY = "assets/source_id/visxp_prep__source_id.tar.gz"
+
+
+@pytest.fixture
+def output_dirs(tmp_path):
+    dirs = []
+    for name, size in [("keyframes", 3 * MIN_PART_SIZE), ("metadata", 100)]:
+        output_dir = os.path.join(tmp_path, name)
+        os.makedirs(output_dir)
+        with open(os.path.join(output_dir, f"{name}.bin"), "wb") as f:
+            f.write(os.urandom(size))  # incompressible, so we get several parts
+        dirs.append(output_dir)
+    return dirs
+
+
+def test_stream_tar_to_s3(output_dirs):
+    s3 = FakeS3Client(part_delay_s=0.05)
+    assert stream_tar_to_s3(s3, BUCKET, KEY, output_dirs, MIN_PART_SIZE, 2)
+
+    assert s3.max_parallel_parts == 2
+    with tarfile.open(fileobj=io.BytesIO(s3.objects[(BUCKET, KEY)])) as tar:
+        names = tar.getnames()
+        for output_dir in output_dirs:
+            name = os.path.basename(output_dir)
+            assert f"{name}/{name}.bin" in names
+            with open(os.path.join(output_dir, f"{name}.bin"), "rb") as f:
+                assert tar.extractfile(f"{name}/{name}.bin").read() == f.read()
+
+
+@pytest.mark.parametrize("compression", [Compression.GZIP, Compression.ZSTD])
+def test_stream_tar_to_s3_aborts_on_failure(compression, output_dirs):
+    if compression == Compression.ZSTD and shutil.which("zstd") is None:
+        pytest.skip("zstd not installed")
+    s3 = FakeS3Client(fail_part_number=2)
+    assert not stream_tar_to_s3(
+        s3, BUCKET, KEY, output_dirs, MIN_PART_SIZE, 2, compression
+    )
+    assert s3.aborted == [KEY]
+    assert (BUCKET, KEY) not in s3.objects
+
+
+def test_stream_tar_to_s3_missing_input(tmp_path):
+    s3 = FakeS3Client()
+    missing = os.path.join(tmp_path, "missing")
+    assert not stream_tar_to_s3(s3, BUCKET, KEY, [missing], MIN_PART_SIZE, 2)
+    assert s3.aborted == [KEY]
+
+
+@pytest.mark.parametrize("data_size", [0, 10, MIN_PART_SIZE, 2 * MIN_PART_SIZE + 1])
+def test_multipart_upload_writer(data_size):
+    s3 = FakeS3Client()
+    data = os.urandom(data_size)
+    with MultipartUploadWriter(s3, BUCKET, KEY, MIN_PART_SIZE, 2) as writer:
+        for i in range(0, data_size, 100000):
+            writer.write(data[i : i + 100000])
+    assert s3.objects[(BUCKET, KEY)] == data
+    assert writer.bytes_written == data_size
+
+
+class FakeS3Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive, so connections can be reused
+
+    def do_PUT(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.send_response(200)
+        self.send_header("ETag", '"etag"')
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+def test_pooled_s3_client_reuses_connections(monkeypatch):
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "test")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "test")
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeS3Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    endpoint_url = f"http://127.0.0.1:{server.server_port}"
+    try:
+        s3 = get_pooled_s3_client(endpoint_url, 2)
+        assert get_pooled_s3_client(endpoint_url) is s3  # one per process
+        for i in range(5):
+            s3.client.put_object(Bucket=BUCKET, Key=f"{KEY}.{i}", Body=b"data")
+        assert s3.get_stats() == {
+            "requests": 5,
+            "connections_opened": 1,
+            "connections_reused": 4,
+        }
+    finally:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,124 @@
+import os
+import socket
+import subprocess
+import sys
+
+import pytest
+
+from shard_util import SEALED_SUFFIX, ShardSpool, get_shard_id
+
+# holds the lock on a lease file (argv[1]) until killed
+LEASE_HOLDER = """
+import fcntl, sys, time
+lease_file = open(sys.argv[1], "a")
+fcntl.flock(lease_file, fcntl.LOCK_EX)
+print("locked", flush=True)
+time.sleep(60)
+"""
+
+
+class FakeUploader:
+    def __init__(self):
+        self.objects: dict = {}  # object name -> bytes
+        self.fail = False
+
+    def __call__(self, file_path: str, file_name: str) -> bool:
+        if self.fail:
+            return False
+        with open(file_path, "rb") as f:
+            self.objects[file_name] = f.read()
+        return True
+
+
+@pytest.fixture
+def uploader():
+    return FakeUploader()
+
+
+def write_archives(tmp_path, source_id, sizes):
+    archives = {}
+    for i, size in enumerate(sizes):
+        archives[f"{source_id}_{i}.tar"] = str(tmp_path / f"{source_id}_{i}.tar")
+        with open(archives[f"{source_id}_{i}.tar"], "wb") as f:
+            f.write(os.urandom(size))
+    return archives
+
+
+def read(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def test_append_and_flush_by_size(tmp_path, uploader):
+    spool = ShardSpool(str(tmp_path / "spool"), "s3://b/shards", 1000, 60, uploader)
+    locations = {}
+    for source_id, sizes in [("a", [100, 200]), ("b", [300]), ("c", [500])]:
+        archives = write_archives(tmp_path, source_id, sizes)
+        locations[source_id] = (archives, spool.append(source_id, archives))
+
+    # the 4th archive filled the shard, so it was uploaded
+    assert len(uploader.objects) == 2
+    assert spool.list_shards() == {}
+    for archives, location in locations.values():
+        assert location.uri == locations["a"][1].uri
+        shard = uploader.objects[os.path.basename(location.uri)]
+        for file_name, archive in archives.items():
+            offset = location.archives[file_name]["offset"]
+            length = location.archives[file_name]["length"]
+            assert shard[offset : offset + length] == read(archive)
+    assert locations["c"][1].archives["c_0.tar"] == {"offset": 600, "length": 500}
+
+
+def test_flush_by_age(tmp_path, uploader):
+    spool = ShardSpool(str(tmp_path / "spool"), "s3://b/shards", 1000, 60, uploader)
+    location = spool.append("a", write_archives(tmp_path, "a", [10]))
+    assert spool.flush() == []  # not full, nor old enough
+
+    spool.max_age_s = 0
+    assert spool.flush() == [os.path.basename(location.uri)]
+    assert os.path.basename(location.index_uri) in uploader.objects
+    # the next asset goes into a new shard
+    assert spool.append("b", write_archives(tmp_path, "b", [10])).uri != location.uri
+
+
+def test_failed_upload_is_retried(tmp_path, uploader):
+    spool = ShardSpool(str(tmp_path / "spool"), "s3://b/shards", 1000, 60, uploader)
+    location = spool.append("a", write_archives(tmp_path, "a", [10]))
+    uploader.fail = True
+    assert spool.flush(force=True) == []
+    assert list(spool.list_shards().values()) == [SEALED_SUFFIX]
+
+    uploader.fail = False
+    assert spool.flush() == [os.path.basename(location.uri)]
+
+
+def test_lease_of_dead_uploader_is_released(tmp_path, uploader):
+    spool = ShardSpool(str(tmp_path / "spool"), "s3://b/shards", 1000, 0, uploader)
+    location = spool.append("a", write_archives(tmp_path, "a", [10]))
+    shard_id = get_shard_id(os.path.basename(location.uri))
+    lease_file = tmp_path / "spool" / socket.gethostname() / f"{shard_id}.lease"
+    # another process holds the lease while it's uploading, until it dies
+    uploading_process = subprocess.Popen(
+        [sys.executable, "-c", LEASE_HOLDER, str(lease_file)], stdout=subprocess.PIPE
+    )
+    assert uploading_process.stdout.readline() == b"locked\n"
+    assert spool.flush() == []
+    assert not spool.is_uploaded(location)
+
+    uploading_process.kill()
+    uploading_process.wait()
+    assert spool.flush() == [os.path.basename(location.uri)]
+    assert spool.is_uploaded(location)
+    assert os.listdir(tmp_path / "spool" / socket.gethostname()) == [".lock"]
+
+
+def test_flush_sweeps_the_spools_of_other_hosts(tmp_path, uploader):
+    spool_root = str(tmp_path / "spool")
+    gone = ShardSpool(spool_root, "s3://b/shards", 1000, 60, uploader, "pod-1")
+    location = gone.append("a", write_archives(tmp_path, "a", [10]))
+    spool = ShardSpool(spool_root, "s3://b/shards", 1000, 60, uploader, "pod-2")
+    assert spool.flush(force=True) == []  # only forces its own shards
+
+    spool.max_age_s = 0
+    assert spool.flush() == [os.path.basename(location.uri)]
+    assert spool.is_uploaded(location)
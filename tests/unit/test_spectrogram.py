@@ -0,0 +1,40 @@
+import shutil
+
+import numpy as np
+import pytest
+
+import spectrogram
+from tests.unit import spectrogram_harness
+
+
+requires_ffmpeg = pytest.mark.skipif(
+    shutil.which("ffmpeg") is None, reason="ffmpeg not installed"
+)
+
+
+@pytest.mark.parametrize(
+    "sample_rate, samples", [(24000, 24000), (16000, 16000), (44100, 300)]
+)
+def test_engines_are_equivalent(sample_rate, samples):
+    pytest.importorskip("python_speech_features")  # the reference engine
+    wav_bit = np.random.default_rng(0).integers(-(2**15), 2**15, samples, np.int16)
+    expected = spectrogram.get_spec(wav_bit, sample_rate)
+    for get_spectrogram in spectrogram.SPECTROGRAM_ENGINES.values():
+        spec = get_spectrogram(wav_bit, sample_rate)
+        assert spec.shape == expected.shape and spec.dtype == expected.dtype
+        np.testing.assert_allclose(spec, expected, atol=1e-5)
+
+
+@requires_ffmpeg
+@pytest.mark.parametrize("engine", list(spectrogram.SPECTROGRAM_ENGINES))
+def test_engine_matches_golden_output(engine, tmp_path):
+    pytest.importorskip("ffmpeg")  # ffmpeg-python, to decode the audio
+    if engine == spectrogram.REFERENCE_ENGINE:
+        pytest.importorskip("python_speech_features")
+    spectrograms = spectrogram_harness.extract_spectrograms(engine, str(tmp_path))
+    assert (
+        spectrogram_harness.get_max_abs_diff(
+            spectrograms, spectrogram_harness.load_golden()
+        )
+        <= spectrogram_harness.TOLERANCE
+    )
@@ -0,0 +1,118 @@
+import os
+import shutil
+import subprocess
+import time
+
+import pytest
+
+from models import MediaFile, OutputType, ScenedetectOutput
+import scenedetect_util
+import split_util
+from split_util import SplitJob, TimeRange, TimeRangeJob
+
+COLORS = ["red", "green", "blue", "yellow", "white", "black", "orange", "purple"]
+
+
+@pytest.mark.parametrize(
+    "frame_count, frame_rate, range_duration_ms, ranges",
+    [
+        (100, 10, 20000, [(0, -1)]),
+        (100, 10, 5000, [(0, 50), (50, -1)]),
+        (101, 10, 5000, [(0, 50), (50, 100), (100, -1)]),
+        (0, 25, 5000, [(0, -1)]),
+    ],
+)
+def test_plan_time_ranges(frame_count, frame_rate, range_duration_ms, ranges):
+    assert split_util.plan_time_ranges(frame_count, frame_rate, range_duration_ms) == [
+        TimeRange(i, start, end) for i, (start, end) in enumerate(ranges)
+    ]
+
+
+@pytest.mark.parametrize(
+    "cuts_per_range, end_frame, shots",
+    [
+        ([[], []], 100, []),
+        ([[30], []], 100, [(0, 30), (30, 100)]),  # shot 30-100 crosses the boundary
+        ([[30], [50, 80]], 90, [(0, 30), (30, 50), (50, 80), (80, 90)]),
+        ([[30], [30]], 90, [(0, 30), (30, 90)]),  # reported twice after a takeover
+    ],
+)
+def test_merge_cuts(cuts_per_range, end_frame, shots):
+    results = [{"cuts": cuts, "end_frame": end_frame} for cuts in cuts_per_range]
+    assert split_util.merge_cuts(results) == shots
+
+
+def test_stale_claims_are_taken_over(tmp_path):
+    job = SplitJob("id", "in.mp4", "out", False, 0, 60, [TimeRange(0, 0, -1)])
+    first = TimeRangeJob.create(str(tmp_path / "id"), job)
+    second = TimeRangeJob(str(tmp_path / "id"))  # e.g. on another node
+
+    assert first.claim_next([split_util.DETECT]) == (split_util.DETECT, 0)
+    assert second.claim_next([split_util.DETECT]) is None  # claimed by first
+    claim_file = tmp_path / "id" / "detect_0.claim"
+    os.utime(claim_file, (time.time() - 61, time.time() - 61))  # first died
+    assert second.claim_next([split_util.DETECT]) == (split_util.DETECT, 0)
+    assert second.claim_next([split_util.DETECT]) is None
+
+
+# a video of solid colored shots, with cuts every 1-3 seconds (at 10 fps)
+@pytest.fixture
+def shots_video(tmp_path) -> str:
+    video_file = str(tmp_path / "shots.mp4")
+    inputs, streams = [], ""
+    for i, color in enumerate(COLORS):
+        inputs += ["-f", "lavfi", "-i", f"color=c={color}:s=64x48:r=10:d={i % 3 + 1}"]
+        streams += f"[{i}:v]"
+    subprocess.run(
+        ["ffmpeg", "-v", "error", *inputs]
+        + ["-filter_complex", f"{streams}concat=n={len(COLORS)}:v=1:a=0[v]"]
+        + ["-map", "[v]", "-c:v", "libx264", "-g", "5", "-pix_fmt", "yuv420p"]
+        + [video_file],
+        check=True,
+    )
+    return video_file
+
+
+def make_output_dir(path) -> str:
+    for output_type in [OutputType.METADATA, OutputType.KEYFRAMES]:
+        os.makedirs(os.path.join(path, output_type.value))
+    return str(path)
+
+
+def read_output(output_dir: str):
+    metadata = [
+        open(os.path.join(output_dir, OutputType.METADATA.value, output.value)).read()
+        for output in ScenedetectOutput
+    ]
+    keyframes = os.listdir(os.path.join(output_dir, OutputType.KEYFRAMES.value))
+    return metadata, sorted(keyframes)
+
+
+@pytest.mark.skipif(shutil.which("ffmpeg") is None, reason="ffmpeg not installed")
+@pytest.mark.parametrize("range_duration_ms", [3000, 6000, 50000])
+def test_split_output_equals_whole_video_output(
+    shots_video, tmp_path, range_duration_ms
+):
+    whole_dir = make_output_dir(tmp_path / "whole")
+    scenedetect_util.run(MediaFile(shots_video, "shots"), whole_dir, True)
+
+    # other processes sharing the jobs dir work on the ranges as well
+    jobs_dir = str(tmp_path / "jobs")
+    helpers = split_util.start_helper_processes(2, jobs_dir, 20)
+    try:
+        split_dir = make_output_dir(tmp_path / "split")
+        media_file = MediaFile(
+            shots_video, "shots", duration_ms=15000, fps=10, frame_count=150
+        )
+        provenance = split_util.run(
+            media_file, split_dir, True, jobs_dir, range_duration_ms, 2000, 60
+        )
+    finally:
+        for helper in helpers:
+            helper.terminate()
+
+    assert read_output(split_dir) == read_output(whole_dir)
+    assert read_output(split_dir)[1]  # keyframes were extracted
+    time_ranges = provenance.parameters["time_ranges"]
+    assert len(provenance.steps or []) == 2 * time_ranges  # shots & keyframes
+    assert not os.listdir(jobs_dir)  # cleaned up
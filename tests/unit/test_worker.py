@@ -0,0 +1,119 @@
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+
+import dane.base_classes
+from dane.base_classes import base_worker
+from dane.config import cfg
+import pytest
+
+from base_util import validate_config
+from tests.unit.fake_amqp import FakeChannel, FakeConnection
+from worker import VideoSegmentationWorker
+
+TASK_DURATION_S = 2
+
+
+# runs in the worker's process pool, so it must be importable
+def slow_task(input_file_path: str):
+    start_time = time.time()
+    time.sleep(TASK_DURATION_S)
+    return {
+        "state": 200,
+        "message": json.dumps([os.getpid(), start_time, time.time()]),
+    }, None
+
+
+def to_queue_message(i: int) -> str:
+    return json.dumps(
+        {
+            "task": {"key": "VISXP_PREP", "_id": f"task{i}"},
+            "document": {
+                "target": {
+                    "id": f"doc{i}",
+                    "url": f"http://x/{i}.mp4",
+                    "type": "Video",
+                },
+                "creator": {"id": "test", "type": "Organization"},
+                "_id": f"doc{i}",
+            },
+        }
+    )
+
+
+@pytest.fixture
+def unfrozen_cfg():
+    cfg.defrost()
+    yield cfg
+    cfg.freeze()
+
+
+@pytest.fixture
+def worker_config(unfrozen_cfg, monkeypatch):
+    monkeypatch.setenv("DW_VISXP_PREP_UNIT_TESTING", "1")
+    monkeypatch.setattr(dane.base_classes, "cwd_is_git", lambda: False)
+    monkeypatch.setattr(cfg.WORKER, "PROCESS_POOL_SIZE", 2)
+    monkeypatch.setattr(cfg.WORKER, "PREFETCH_COUNT", 2)
+    return cfg
+
+
+def test_concurrent_tasks_keep_connection_responsive(worker_config, monkeypatch):
+    channel = FakeChannel([to_queue_message(i) for i in range(4)])
+
+    def fake_connect(self):
+        self.channel, self.connection = channel, FakeConnection(channel)
+        self._connected, self._is_interrupted = True, False
+
+    monkeypatch.setattr(base_worker, "connect", fake_connect)
+    worker = VideoSegmentationWorker(worker_config, slow_task)
+    worker.handler = object()  # base_worker refuses tasks without one
+    worker.save_to_dane_index = lambda *args, **kwargs: None
+    worker.connect()
+    assert channel.prefetch_count == 2
+
+    consumer = threading.Thread(target=worker.run, daemon=True)
+    consumer.start()
+    deadline = time.time() + 60
+    while len(channel.acked) < 4 and time.time() < deadline:
+        time.sleep(0.1)
+    worker.stop()
+    consumer.join()
+
+    assert sorted(channel.acked) == [1, 2, 3, 4]
+    results = [json.loads(json.loads(reply)["message"]) for reply in channel.replies]
+    assert all(pid != os.getpid() for pid, _, _ in results)
+    start_times = sorted(start for _, start, _ in results)
+    assert start_times[1] < start_times[0] + TASK_DURATION_S  # ran in parallel
+    # the consumer thread kept handling connection events (e.g. heartbeats)
+    assert max(b - a for a, b in zip(channel.poll_times, channel.poll_times[1:])) < 1.5
+
+
+# cold start: the media processing libraries are only loaded once there is work
+def test_import_does_not_load_heavy_modules():
+    heavy_modules = ["cv2", "scenedetect", "numpy", "matplotlib", "boto3"]
+    result = subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            f"import sys, worker; print([m for m in {heavy_modules} if m in sys.modules])",
+        ],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    assert result.stdout.strip() == "[]"
+
+
+@pytest.mark.parametrize(
+    "pool_size, prefetch_count, valid",
+    [(0, 1, True), (0, 2, False), (2, 2, True)],
+)
+def test_prefetch_needs_a_process_pool(
+    worker_config, monkeypatch, pool_size, prefetch_count, valid
+):
+    monkeypatch.setattr(cfg.WORKER, "PROCESS_POOL_SIZE", pool_size)
+    monkeypatch.setattr(cfg.WORKER, "PREFETCH_COUNT", prefetch_count)
+    assert validate_config(worker_config, False) is valid
@@ -0,0 +1,44 @@
+import threading
+
+import pytest
+
+from writer_util import AsyncFileWriter
+
+
+@pytest.mark.parametrize("threads", [0, 2])
+def test_write_files(tmp_path, threads):
+    with AsyncFileWriter(threads, 4) as writer:
+        for i in range(10):
+            writer.write(str(tmp_path / f"{i}.bin"), bytes([i]) * (i + 1))
+        writer.write(str(tmp_path / "encoded.bin"), lambda: b"encoded")
+    assert [(tmp_path / f"{i}.bin").read_bytes() for i in range(10)] == [
+        bytes([i]) * (i + 1) for i in range(10)
+    ]
+    assert (tmp_path / "encoded.bin").read_bytes() == b"encoded"
+    assert writer.stats.files == 11
+    assert writer.stats.bytes_written == 55 + 7
+
+
+def test_full_queue_stalls_the_stage(tmp_path):
+    release = threading.Event()
+
+    def slow_buffer():
+        release.wait()
+        return b"slow"
+
+    writer = AsyncFileWriter(1, 1)
+    writer.write(str(tmp_path / "slow.bin"), slow_buffer)
+    threading.Timer(0.2, release.set).start()
+    writer.write(str(tmp_path / "next.bin"), b"next")  # waits for the slow write
+    stats = writer.close()
+    assert stats.stall_time_ms >= 100
+    assert stats.max_queue_depth == 1
+    assert (tmp_path / "next.bin").read_bytes() == b"next"
+
+
+@pytest.mark.parametrize("threads", [0, 2])
+def test_errors_propagate_to_the_stage(tmp_path, threads):
+    with pytest.raises(FileNotFoundError):
+        with AsyncFileWriter(threads, 4) as writer:
+            writer.write(str(tmp_path / "missing_dir" / "0.bin"), b"0")
+            writer.write(str(tmp_path / "1.bin"), b"1")
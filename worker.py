@@ -2,26 +2,36 @@ import logging
 import os
 from pika.exceptions import ChannelClosedByBroker
 import sys
-from typing import Optional
+import threading
+from typing import Optional, Tuple
 
-from base_util import validate_config
+from base_util import LOG_FORMAT, validate_config
+from cpu_util import apply_cpu_budget
 from dane import Document, Task, Result
 from dane.base_classes import base_worker
 from dane.config import cfg
 from dane.provenance import Provenance
+import metrics_util
 from models import CallbackResponse
+from prefork_util import WarmProcessPool
 from io_util import (
+    flush_output_shards,
+    get_shard_location,
     get_source_id,
+    get_split_jobs_dir,
     get_s3_output_file_uri,
+    start_shard_flusher,
+    wait_for_shard_upload,
 )
-import main_data_processor
+import split_util
 
 
 logger = logging.getLogger()
 
 
 class VideoSegmentationWorker(base_worker):
-    def __init__(self, config):
+    # process_task: (input_file_path) -> (processing result, full provenance chain)
+    def __init__(self, config, process_task=None):
         logger.info(config)
         self.UNIT_TESTING = os.getenv("DW_VISXP_PREP_UNIT_TESTING", False)
 
@@ -39,6 +49,46 @@ class VideoSegmentationWorker(base_worker):
         if not self.UNIT_TESTING:
             logger.warning("Need to initialize the VISXP_PREP service")
 
+        # with a process pool, tasks run outside of this process, so the thread
+        # consuming the queue (and sending heartbeats) is never starved by the work.
+        # The pool's processes are started (and import the heavy modules) up front
+        self.process_task = process_task or run_task
+        self.prefetch_count = config.WORKER.PREFETCH_COUNT
+        self.process_pool: Optional[WarmProcessPool] = None
+        if config.WORKER.PROCESS_POOL_SIZE > 0:
+            logger.info(
+                f"Running at most {config.WORKER.PROCESS_POOL_SIZE} tasks in parallel "
+                f"(prefetch={self.prefetch_count})"
+            )
+            self.process_pool = WarmProcessPool(
+                config.WORKER.PROCESS_POOL_SIZE,
+                list(config.WORKER.PRELOAD_MODULES),
+                config.WORKER.MAX_TASKS_PER_PROCESS,
+                config.WORKER.MAX_PROCESS_RSS_BYTES,
+                initializer=init_task_process,
+                initargs=(logger.getEffectiveLevel(),),
+            )
+
+        if config.WORKER.METRICS_PORT > 0:
+            metrics_util.start_metrics_server(config.WORKER.METRICS_PORT)
+
+        # uploads the shards of small assets (of all processes) once due
+        self.shard_upload = (
+            config.OUTPUT.TRANSFER_ON_COMPLETION and config.OUTPUT.SHARD_UPLOAD
+        )
+        self.shard_flusher_stop = threading.Event()
+        if self.shard_upload:
+            start_shard_flusher(
+                self.shard_flusher_stop, config.OUTPUT.SHARD_MAX_AGE_S / 10
+            )
+
+        # processes helping with the time ranges of long assets, of any worker
+        self.split_helpers = split_util.start_helper_processes(
+            config.SPLIT.HELPER_PROCESSES,
+            get_split_jobs_dir(),
+            logger.getEffectiveLevel(),
+        )
+
         super().__init__(
             self.__queue_name,
             self.__binding_key,
@@ -60,6 +110,22 @@ class VideoSegmentationWorker(base_worker):
 
     """----------------------------------INTERACTION WITH DANE SERVER ---------------------------------"""
 
+    def connect(self):
+        super().connect()
+        # each prefetched task is processed in a separate thread (see base_worker),
+        # which waits for the task's result in the process pool
+        self.channel.basic_qos(prefetch_count=self.prefetch_count)
+
+    def stop(self):
+        super().stop()
+        if self.process_pool:  # unacknowledged tasks are redelivered by the broker
+            self.process_pool.shutdown(wait=False, cancel_futures=True)
+        for helper in self.split_helpers:  # claimed ranges are taken over by others
+            helper.terminate()
+        if self.shard_upload:
+            self.shard_flusher_stop.set()
+            flush_output_shards(force=True)  # no task will append to them anymore
+
     # DANE callback function, called whenever there is a job for this worker
     def callback(self, task: Task, doc: Document) -> CallbackResponse:
         logger.info("Receiving a task from the DANE server!")
@@ -70,21 +136,48 @@ class VideoSegmentationWorker(base_worker):
         logger.info(f"Input file path is: {input_file_path} ")
 
         # now run the main process!
-        processing_result, full_provenance_chain = main_data_processor.run(
-            input_file_path
-        )
+        processing_result, full_provenance_chain = None, None
+        metrics_util.TASKS_IN_FLIGHT.inc()
+        try:
+            if self.process_pool:
+                processing_result, full_provenance_chain = self.process_pool.submit(
+                    self.process_task, input_file_path
+                ).result()
+                logger.info(f"Process pool stats: {self.process_pool.get_stats()}")
+            else:
+                processing_result, full_provenance_chain = self.process_task(
+                    input_file_path
+                )
+        finally:
+            metrics_util.TASKS_IN_FLIGHT.dec()
+            metrics_util.record_task(processing_result, full_provenance_chain)
 
         # if results are fine, save something to the DANE index
         if processing_result.get("state", 500) == 200:
             logger.info(
                 "applying IO on output went well, now finally saving to DANE index"
             )
+            # small output is in a shard, which is uploaded later: the task is only
+            # done (and acked) once it is, so the saved location is readable
+            shard_location = get_shard_location(full_provenance_chain)
+            if shard_location and not wait_for_shard_upload(
+                shard_location, cfg.OUTPUT.SHARD_UPLOAD_TIMEOUT_S
+            ):
+                return {
+                    "state": 500,
+                    "message": f"Failed to upload the shard {shard_location.uri}",
+                }
             try:
                 self.save_to_dane_index(
                     doc,
                     task,
-                    get_s3_output_file_uri(get_source_id(input_file_path)),
+                    (
+                        shard_location.uri
+                        if shard_location
+                        else get_s3_output_file_uri(get_source_id(input_file_path))
+                    ),
                     provenance=full_provenance_chain,
+                    s3_shard=shard_location.to_json() if shard_location else None,
                 )
             except Exception as e:
                 logger.exception(f"Failed to save to DANE index: {e}")
@@ -96,6 +189,7 @@ class VideoSegmentationWorker(base_worker):
         task: Task,
         s3_location: str,
         provenance: Optional[Provenance],
+        s3_shard: Optional[dict] = None,  # the byte range of each archive
     ) -> None:
         logger.info("saving results to DANE, task id={0}".format(task._id))
         # TODO figure out the multiple lines per transcript (refresh my memory)
@@ -107,6 +201,7 @@ class VideoSegmentationWorker(base_worker):
                 "doc_target_id": doc.target["id"],
                 "doc_target_url": doc.target["url"],
                 "s3_location": s3_location,
+                **({"s3_shard": s3_shard} if s3_shard else {}),
                 # "provenance": provenance.to_json()
                 # if provenance
                 # else {"error": "something is off"},
@@ -116,11 +211,24 @@ class VideoSegmentationWorker(base_worker):
         r.save(task._id)
 
 
+# main_data_processor (and with it OpenCV & scenedetect) is only imported once the
+# first task arrives, or up front in the warm processes (WORKER.PRELOAD_MODULES)
+def run_task(input_file_path: str) -> Tuple[CallbackResponse, Optional[Provenance]]:
+    import main_data_processor
+
+    return main_data_processor.run(input_file_path)
+
+
+# sets up the logging of the (spawned) processes in the worker's process pool
+def init_task_process(log_level: int) -> None:
+    logging.basicConfig(stream=sys.stdout, format=LOG_FORMAT)
+    logger.setLevel(log_level)
+
+
 # Start the worker
 # passing --run-test-file will run the whole process on the file defined in cfg.VISXP_PREP.TEST_FILE
 if __name__ == "__main__":
     from argparse import ArgumentParser
-    from base_util import LOG_FORMAT
     import json
 
     # first read the CLI arguments
@@ -128,6 +236,27 @@ if __name__ == "__main__":
     parser.add_argument(
         "--run-test-file", action="store", dest="run_test_file", default="n", nargs="?"
     )
+    parser.add_argument(
+        "--time-range-helper",
+        action="store_true",
+        dest="time_range_helper",
+        help="only help with the time ranges of long assets (see SPLIT)",
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store",
+        dest="dry_run",
+        metavar="MANIFEST",
+        help="only estimate the runtime & output size of the inputs in the manifest",
+    )
+    parser.add_argument(
+        "--calibrate",
+        action="store",
+        dest="calibrate",
+        nargs="+",
+        metavar="MEDIA_FILE",
+        help="fit ESTIMATE.CALIBRATION_FILE on runs with these (local) media files",
+    )
     parser.add_argument("--log", action="store", dest="loglevel", default="INFO")
     args = parser.parse_args()
 
@@ -143,11 +272,14 @@ if __name__ == "__main__":
     logger.info(f"Logger initialized (log level: {log_level})")
     logger.info(f"Got the following CMD line arguments: {args}")
 
+    # before any of the media libraries is imported (by this or a child process)
+    apply_cpu_budget(cfg.WORKER.CPU_THREADS_PER_JOB, list(cfg.WORKER.CPU_AFFINITY))
+
     # see if the test file must be run
     if args.run_test_file != "n":
         logger.info("Running main_data_processor with VISXP_PREP.TEST_INPUT_FILE ")
         if cfg.VISXP_PREP and cfg.VISXP_PREP.TEST_INPUT_FILE:
-            processing_result, full_provenance_chain = main_data_processor.run(
+            processing_result, full_provenance_chain = run_task(
                 cfg.VISXP_PREP.TEST_INPUT_FILE
             )
             logger.info("Results after applying desired I/O")
@@ -161,6 +293,35 @@ if __name__ == "__main__":
         else:
             logger.error("Please configure an input file in VISXP_PREP.TEST_INPUT_FILE")
             sys.exit()
+    elif args.dry_run:
+        import estimate_util
+        import main_data_processor
+
+        calibration = estimate_util.load_calibration(cfg.ESTIMATE.CALIBRATION_FILE)
+        estimates = [
+            main_data_processor.estimate(input_file_path, calibration)
+            for input_file_path in estimate_util.read_manifest(args.dry_run)
+        ]
+        print(
+            json.dumps(
+                {
+                    "estimates": [estimate.to_json() for estimate in estimates],
+                    "totals": estimate_util.summarize(estimates),
+                    "calibration": calibration.hardware,
+                },
+                indent=4,
+            )
+        )
+    elif args.calibrate:
+        import tempfile
+        import estimate_util
+
+        with tempfile.TemporaryDirectory() as work_dir:
+            calibration = estimate_util.calibrate(args.calibrate, work_dir)
+        estimate_util.save_calibration(calibration, cfg.ESTIMATE.CALIBRATION_FILE)
+    elif args.time_range_helper:
+        logger.info("Starting a time range helper")
+        split_util.run_helper(get_split_jobs_dir())
     else:
         logger.info("Starting the worker")
         # start the worker
@@ -0,0 +1,140 @@
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
+import logging
+import os
+import threading
+from time import time
+from typing import Callable, List, Optional, Set, Union
+
+from dane.config import cfg
+from manifest_util import ManifestRecorder
+
+
+logger = logging.getLogger(__name__)
+# the finished buffer, or a function that produces it (e.g. encodes an image),
+# which then also runs in the background
+FileData = Union[bytes, bytearray, memoryview, Callable[[], bytes]]
+
+
+@dataclass
+class WriterStats:
+    files: int = 0
+    bytes_written: int = 0
+    max_queue_depth: int = 0  # most writes pending at once
+    stall_time_ms: float = 0  # time the stage waited for room in the queue
+    flush_time_ms: float = 0  # time the stage waited in close() for the last writes
+
+
+class AsyncFileWriter:
+    """Writes the files of a stage in a few background threads, so the compute loop
+    does not wait for (network) storage. At most queue_size writes are pending:
+    write() blocks (stalls) until there is room again. close() waits for the
+    remaining writes and fsyncs them. An error of a write is raised in the stage by
+    the next write() or close(). With a recorder, the size & checksum of each file
+    are recorded for the output manifest as well, also in the background"""
+
+    def __init__(
+        self,
+        threads: int,
+        queue_size: int,
+        fsync: bool = True,
+        recorder: Optional[ManifestRecorder] = None,
+    ):
+        self.stats = WriterStats()
+        self._fsync = fsync
+        self._recorder = recorder
+        self._pool = (
+            ThreadPoolExecutor(max_workers=threads, thread_name_prefix="file-writer")
+            if threads > 0
+            else None  # write synchronously, in the calling thread
+        )
+        self._slots = threading.BoundedSemaphore(max(queue_size, 1))
+        self._lock = threading.Lock()
+        self._pending: List[Future] = []
+        self._dirs: Set[str] = set()
+
+    def __enter__(self) -> "AsyncFileWriter":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        if exc_type:  # the stage failed already: do not mask its error
+            self.abort()
+        else:
+            self.close()
+
+    def write(self, path: str, data: FileData) -> None:
+        self._raise_failed_writes()
+        self._dirs.add(os.path.dirname(path))
+        if not self._pool:
+            self._write(path, data)
+            return
+        start_time = time()
+        self._slots.acquire()
+        self.stats.stall_time_ms += (time() - start_time) * 1000
+        future = self._pool.submit(self._write, path, data)
+        future.add_done_callback(lambda _: self._slots.release())
+        self._pending.append(future)
+        depth = len([f for f in self._pending if not f.done()])
+        self.stats.max_queue_depth = max(self.stats.max_queue_depth, depth)
+
+    # waits for all writes & makes them durable, returns the stats of this stage
+    def close(self) -> WriterStats:
+        start_time = time()
+        try:
+            self._raise_failed_writes(wait=True)
+        finally:
+            if self._pool:
+                self._pool.shutdown()
+        if self._fsync:
+            for dir_path in self._dirs:  # so the new directory entries are durable
+                _fsync_path(dir_path)
+        if self._recorder:
+            self._recorder.save()
+        self.stats.flush_time_ms = (time() - start_time) * 1000
+        logger.info(f"Wrote {self.stats.files} files: {self.stats}")
+        return self.stats
+
+    # drops the pending writes, e.g. when the stage failed
+    def abort(self) -> None:
+        if self._pool:
+            self._pool.shutdown(cancel_futures=True)
+
+    def _write(self, path: str, data: FileData) -> None:
+        buffer = data() if callable(data) else data
+        with open(path, "wb") as f:
+            f.write(buffer)
+            f.flush()
+            if self._fsync:
+                os.fsync(f.fileno())
+        if self._recorder:
+            self._recorder.add(path, buffer)
+        with self._lock:
+            self.stats.files += 1
+            self.stats.bytes_written += memoryview(buffer).nbytes
+
+    def _raise_failed_writes(self, wait: bool = False) -> None:
+        pending = []
+        for future in self._pending:
+            if wait or future.done():
+                future.result()  # raises the error of a failed write
+            else:
+                pending.append(future)
+        self._pending = pending
+
+
+# a writer for one stage, configured by OUTPUT.WRITER_THREADS & WRITER_QUEUE_SIZE
+def get_file_writer(recorder: Optional[ManifestRecorder] = None) -> AsyncFileWriter:
+    return AsyncFileWriter(
+        cfg.OUTPUT.WRITER_THREADS,
+        cfg.OUTPUT.WRITER_QUEUE_SIZE,
+        cfg.OUTPUT.FSYNC,
+        recorder,
+    )
+
+
+def _fsync_path(path: str) -> None:
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)